@@ -1,7 +1,8 @@
 import sys
-sys.path.insert(0, './lib/hangups')
-sys.path.insert(0, './lib/xmpp')
 import os
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), 'lib/hangups'))
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), 'lib/xmpp'))
+import jh_stats  # First, so that the startup timeline begins with the process.
 import logging
 import logging.handlers
 import signal
@@ -15,9 +16,14 @@ import debug as debug_module
 import config
 import jh_hangups
 from jh_hangups import HangupsManager
+from jh_shards import ShardedHangupsManager
 import jh_xmpp
+import jh_queue
+import jh_cluster
 from jh_xmpp import Transport, XMPPQueueThread, xmpp_lock
 
+jh_stats.startup.mark('modules imported')
+
 
 def load_config():
     """Look for files to load the configuration from."""
@@ -87,6 +93,7 @@ if __name__ == '__main__':
         sys.exit(1)
 
     debug_module.setup_logging()
+    jh_stats.startup.mark('configuration loaded')
 
     if config.pidFile:
         write_pid_file(config.pidFile)
@@ -113,15 +120,30 @@ if __name__ == '__main__':
     logger = logging.getLogger(__name__)
     logger.info("Jabber Hangouts transport is starting.")
 
+    jh_xmpp.xmpp_queue = jh_queue.MessageQueue(int(config.queueShedThreshold), int(config.typingMaxAge),
+                                               int(config.userQueueLimit), int(config.queueQuantum) / 1000,
+                                               jh_queue.parse_weights(config.userWeights))
     logging.debug("Starting Hangouts thread manager.")
-    jh_hangups.hangups_manager = HangupsManager()
-    jh_xmpp.userfile = shelve.open(config.spoolFile)
+    if int(config.hangoutsWorkers) > 0:
+        jh_hangups.hangups_manager = ShardedHangupsManager(int(config.hangoutsWorkers), jh_xmpp.xmpp_queue)
+    else:
+        jh_hangups.hangups_manager = HangupsManager()
+    if config.clusterNode:
+        jh_xmpp.userfile = jh_cluster.UserStore(config.clusterStore)
+    else:
+        jh_xmpp.userfile = shelve.open(config.spoolFile)
 
     logging.debug("Starting transport.")
     transport = Transport(connection, jh_xmpp.userfile)
+    if config.clusterNode:
+        transport.cluster = jh_cluster.Cluster(transport, jh_xmpp.userfile, config.clusterNode, config.clusterAddress,
+                                               int(config.clusterLeaseTime), xmpp_lock)
     if not transport.xmpp_connect():
         logging.error("Could not connect to server, or password mismatch!")
         sys.exit(1)
+    jh_stats.startup.mark('component connected')
+    if transport.cluster is not None:
+        transport.cluster.start()
 
     signal.signal(signal.SIGINT, sig_handler)
     signal.signal(signal.SIGTERM, sig_handler)
@@ -133,7 +155,8 @@ if __name__ == '__main__':
         try:
             xmpp_lock.acquire()
             try:
-                connection.Process(0.01)
+                jh_stats.run_profiled(connection.Process, 0.01)
+                transport.expire_file_transfers()
             finally:
                 xmpp_lock.release()
         except KeyboardInterrupt:
@@ -147,7 +170,9 @@ if __name__ == '__main__':
             transport.xmpp_disconnect()
 
     if connection.isConnected():
-        transport.xmpp_disconnect()
+        transport.shutdown()
+    if transport.cluster is not None:
+        transport.cluster.stop()
     jh_xmpp.userfile.close()
     connection.disconnect()
 
@@ -157,6 +182,8 @@ if __name__ == '__main__':
         logger.warning('Tranport terminated, but Hangouts threads are still active.')
         for jid in jh_hangups.hangups_manager.hangouts_threads:
             jh_hangups.hangups_manager.send_message(jid, {'what': 'disconnect'})
+    if isinstance(jh_hangups.hangups_manager, ShardedHangupsManager):
+        jh_hangups.hangups_manager.stop()
 
     if config.pidFile:
         delete_pid_file(config.pidFile)
@@ -0,0 +1,346 @@
+"""Microbenchmark of the messages sent by the Hangouts threads to the transport.
+
+Replays a mix of events through both versions of the protocol:
+- dicts: messages are dicts keyed by 'what', routed by a chain of string comparisons, the handlers looking the
+  session of the user up in the user list each time they need it (the transport before jh_messages);
+- records: messages are jh_messages records, routed by a table of handlers keyed by class, the handlers receiving the
+  session of the user already resolved (the transport now).
+
+Each event is built, optionally pickled and unpickled like through the pipe of a worker process (--pickle; records
+are packed as tuples first), then handled. The handlers do the lookups and updates of the session state the transport's handlers do, but send nothing.
+
+The mix is read from a JSON file of {kind: count} (--mix), by default the one below, modeled on a user with about 500
+contacts in a few busy conversations: presence and typing notifications far outnumber the chat messages.
+
+Usage: python3 benchmarks/bench_messages.py [--events N] [--repeat N] [--pickle] [--mix file.json]"""
+import argparse
+import json
+import os
+import pickle
+import random
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+import jh_messages  # noqa: E402
+
+DEFAULT_MIX = {
+    'presence': 450,
+    'typing_notification': 300,
+    'chat_message': 150,
+    'chat_message_error': 5,
+    'conversation_rename': 5,
+    'conversation_membership_change': 10,
+    'file_transfer_ack': 40,
+    'memory_usage': 20,
+    'presence_stats': 20,
+}
+JID = 'user@example.net'
+CONTACTS = 500
+CONVERSATIONS = 10
+
+
+def make_session():
+    """Return the session state of a user, as the transport keeps it."""
+    user_list = {str(index): {'gaia_id': str(index), 'status': 'online', 'status_message': ''}
+                 for index in range(CONTACTS)}
+    conv_list = {'conv%d' % (index,): {'conv_id': 'conv%d' % (index,), 'topic': 'Conversation %d' % (index,),
+                                       'user_list': {str(member): 'Contact %d' % (member,)
+                                                     for member in range(index, index + 20)},
+                                       'connected_jids': {JID + '/phone': True}, 'invited_jids': {}}
+                 for index in range(CONVERSATIONS)}
+    return {'user_list': user_list, 'conv_list': conv_list, 'connected_jids': {JID + '/phone': True},
+            'memory': None, 'presence_stats': None}
+
+
+def make_fields(kind, rng):
+    """Return the fields of an event of a kind."""
+    gaia_id = str(rng.randrange(CONTACTS))
+    conv_id = 'conv%d' % (rng.randrange(CONVERSATIONS),)
+    if kind == 'presence':
+        return {'gaia_id': gaia_id, 'status': rng.choice(['online', 'away', 'offline']), 'status_message': ''}
+    if kind == 'typing_notification':
+        return {'type': 'one_to_one', 'gaia_id': gaia_id, 'state': rng.choice(['started', 'paused', 'stopped'])}
+    if kind == 'chat_message':
+        if rng.random() < 0.5:
+            return {'type': 'one_to_one', 'gaia_id': gaia_id, 'message': 'Hello there'}
+        return {'type': 'group', 'gaia_id': gaia_id, 'conv_id': conv_id, 'message': 'Hello everyone'}
+    if kind == 'chat_message_error':
+        return {'type': 'one_to_one', 'gaia_id': gaia_id, 'message': 'Failed to send message.',
+                'recipient_jid': JID + '/phone'}
+    if kind == 'conversation_rename':
+        return {'conv_id': conv_id, 'new_name': 'Renamed %d' % (rng.randrange(100),)}
+    if kind == 'conversation_membership_change':
+        return {'conv_id': conv_id, 'new_members': {gaia_id: 'Contact ' + gaia_id}}
+    if kind == 'file_transfer_ack':
+        return {'transfer_id': 'transfer%d' % (rng.randrange(4),)}
+    if kind == 'memory_usage':
+        return {'size': rng.randrange(1 << 20, 1 << 24)}
+    if kind == 'presence_stats':
+        return {'forwarded': rng.randrange(1000), 'suppressed': rng.randrange(1000)}
+    raise ValueError('Unknown kind of event: %s' % (kind,))
+
+
+DICTS = {
+    'presence': lambda f: {'what': 'presence', 'gaia_id': f['gaia_id'], 'status': f['status'],
+                           'status_message': f['status_message']},
+    'typing_notification': lambda f: {'what': 'typing_notification', 'type': f['type'], 'gaia_id': f['gaia_id'],
+                                      'state': f['state']},
+    'chat_message': lambda f: {'what': 'chat_message', 'type': f['type'], 'gaia_id': f['gaia_id'],
+                               'message': f['message'], 'conv_id': f.get('conv_id')},
+    'chat_message_error': lambda f: {'what': 'chat_message_error', 'type': f['type'], 'message': f['message'],
+                                     'recipient_jid': f['recipient_jid'], 'gaia_id': f['gaia_id']},
+    'conversation_rename': lambda f: {'what': 'conversation_rename', 'conv_id': f['conv_id'],
+                                      'new_name': f['new_name']},
+    'conversation_membership_change': lambda f: {'what': 'conversation_membership_change', 'conv_id': f['conv_id'],
+                                                 'new_members': f['new_members']},
+    'file_transfer_ack': lambda f: {'what': 'file_transfer_ack', 'transfer_id': f['transfer_id']},
+    'memory_usage': lambda f: {'what': 'memory_usage', 'size': f['size']},
+    'presence_stats': lambda f: {'what': 'presence_stats', 'forwarded': f['forwarded'],
+                                 'suppressed': f['suppressed']},
+}
+
+RECORDS = {
+    'presence': lambda f: jh_messages.ContactPresence(f['gaia_id'], f['status'], f['status_message']),
+    'typing_notification': lambda f: jh_messages.TypingNotification(f['type'], f['gaia_id'], f['state']),
+    'chat_message': lambda f: jh_messages.ChatMessage(f['type'], f['gaia_id'], f['message'],
+                                                      conv_id=f.get('conv_id')),
+    'chat_message_error': lambda f: jh_messages.ChatMessageError(f['type'], f['message'], f['recipient_jid'],
+                                                                 gaia_id=f['gaia_id']),
+    'conversation_rename': lambda f: jh_messages.ConversationRename(f['conv_id'], f['new_name']),
+    'conversation_membership_change': lambda f: jh_messages.ConversationMembershipChange(
+        f['conv_id'], new_members=f['new_members']),
+    'file_transfer_ack': lambda f: jh_messages.FileTransferAck(f['transfer_id']),
+    'memory_usage': lambda f: jh_messages.MemoryUsage(f['size']),
+    'presence_stats': lambda f: jh_messages.PresenceStats(f['forwarded'], f['suppressed']),
+}
+
+
+def make_events(mix, count, seed=0):
+    """Return count (kind, fields) events, drawn from the mix."""
+    rng = random.Random(seed)
+    kinds = list(mix)
+    weights = [mix[kind] for kind in kinds]
+    total = sum(weights)
+    events = []
+    for n in range(count):
+        target = rng.random() * total
+        for kind, weight in zip(kinds, weights):
+            target -= weight
+            if target < 0:
+                break
+        events.append((kind, make_fields(kind, rng)))
+    return events
+
+
+def build_dicts(events):
+    """Build the events as dicts, like the threads did."""
+    messages = []
+    for kind, fields in events:
+        message = DICTS[kind](fields)
+        message['jid'] = JID
+        messages.append(message)
+    return messages
+
+
+def build_records(events):
+    """Build the events as records, like the threads do."""
+    messages = []
+    for kind, fields in events:
+        message = RECORDS[kind](fields)
+        message.jid = JID
+        messages.append(message)
+    return messages
+
+
+class DictTransport:
+    """The routing of the transport before jh_messages."""
+    def __init__(self):
+        self.userlist = {JID: make_session()}
+        self.composing = {}  # {gaia_id: whether the contact is composing}, instead of sending a chat state.
+
+    def handle_message(self, message):
+        fromjid = message['jid']
+        if fromjid not in self.userlist:
+            return
+        if message['what'] == 'connected':
+            pass
+        elif message['what'] == 'disconnected':
+            pass
+        elif message['what'] == 'login_queued':
+            pass
+        elif message['what'] == 'auth_failed':
+            pass
+        elif message['what'] == 'user_list':
+            pass
+        elif message['what'] == 'conv_list':
+            pass
+        elif message['what'] == 'presence':
+            if message['gaia_id'] in self.userlist[fromjid]['user_list']:
+                self.userlist[fromjid]['user_list'][message['gaia_id']]['status'] = message['status']
+                self.userlist[fromjid]['user_list'][message['gaia_id']]['status_message'] = message['status_message']
+        elif message['what'] == 'chat_message':
+            if message['type'] == 'group' and message['conv_id'] in self.userlist[fromjid]['conv_list']:
+                conv = self.userlist[fromjid]['conv_list'][message['conv_id']]
+                if message['gaia_id'] in conv['user_list']:
+                    for ajid in self.userlist[fromjid]['connected_jids']:
+                        if ajid not in conv['connected_jids'] and ajid not in conv['invited_jids']:
+                            conv['invited_jids'][ajid] = True
+        elif message['what'] == 'typing_notification':
+            if message['type'] == 'one_to_one':
+                self.composing[message['gaia_id']] = message['state'] == 'started'
+        elif message['what'] == 'conversation_history':
+            pass
+        elif message['what'] == 'conversation_rename':
+            if message['conv_id'] in self.userlist[fromjid]['conv_list']:
+                conv = self.userlist[fromjid]['conv_list'][message['conv_id']]
+                conv['topic'] = message['new_name']
+        elif message['what'] == 'conversation_add':
+            pass
+        elif message['what'] == 'conversation_membership_change':
+            if message['conv_id'] in self.userlist[fromjid]['conv_list']:
+                conv = self.userlist[fromjid]['conv_list'][message['conv_id']]
+                if 'new_members' in message:
+                    for gaia_id in message['new_members']:
+                        conv['user_list'][gaia_id] = message['new_members'][gaia_id]
+        elif message['what'] == 'chat_message_error':
+            if message['gaia_id'] not in self.userlist[fromjid]['user_list']:
+                return
+        elif message['what'] == 'file_transfer_ack':
+            pass
+        elif message['what'] == 'memory_usage':
+            self.userlist[fromjid]['memory'] = {'hangups': message['size']}
+        elif message['what'] == 'presence_stats':
+            self.userlist[fromjid]['presence_stats'] = {'forwarded': message['forwarded'],
+                                                        'suppressed': message['suppressed']}
+
+
+class RecordTransport:
+    """The routing of the transport now."""
+    def __init__(self):
+        self.userlist = {JID: make_session()}
+        self.composing = {}  # {gaia_id: whether the contact is composing}, instead of sending a chat state.
+
+    def handle_message(self, message):
+        fromjid = message.jid
+        if fromjid not in self.userlist:
+            return
+        handler = self.handlers.get(type(message))
+        if handler is not None:
+            handler(self, message, fromjid, self.userlist[fromjid])
+
+    def handle_presence(self, message, fromjid, hobj):
+        if message.gaia_id in hobj['user_list']:
+            hobj['user_list'][message.gaia_id]['status'] = message.status
+            hobj['user_list'][message.gaia_id]['status_message'] = message.status_message
+
+    def handle_chat_message(self, message, fromjid, hobj):
+        if message.type == 'group' and message.conv_id in hobj['conv_list']:
+            conv = hobj['conv_list'][message.conv_id]
+            if message.gaia_id in conv['user_list']:
+                for ajid in hobj['connected_jids']:
+                    if ajid not in conv['connected_jids'] and ajid not in conv['invited_jids']:
+                        conv['invited_jids'][ajid] = True
+
+    def handle_typing_notification(self, message, fromjid, hobj):
+        if message.type == 'one_to_one':
+            self.composing[message.gaia_id] = message.state == 'started'
+
+    def handle_conversation_rename(self, message, fromjid, hobj):
+        if message.conv_id in hobj['conv_list']:
+            hobj['conv_list'][message.conv_id]['topic'] = message.new_name
+
+    def handle_conversation_membership_change(self, message, fromjid, hobj):
+        if message.conv_id in hobj['conv_list']:
+            conv = hobj['conv_list'][message.conv_id]
+            if message.new_members is not None:
+                for gaia_id in message.new_members:
+                    conv['user_list'][gaia_id] = message.new_members[gaia_id]
+
+    def handle_chat_message_error(self, message, fromjid, hobj):
+        if message.gaia_id not in hobj['user_list']:
+            return
+
+    def handle_file_transfer_ack(self, message, fromjid, hobj):
+        pass
+
+    def handle_memory_usage(self, message, fromjid, hobj):
+        hobj['memory'] = {'hangups': message.size}
+
+    def handle_presence_stats(self, message, fromjid, hobj):
+        hobj['presence_stats'] = {'forwarded': message.forwarded, 'suppressed': message.suppressed}
+
+    handlers = {
+        jh_messages.ContactPresence: handle_presence,
+        jh_messages.ChatMessage: handle_chat_message,
+        jh_messages.TypingNotification: handle_typing_notification,
+        jh_messages.ConversationRename: handle_conversation_rename,
+        jh_messages.ConversationMembershipChange: handle_conversation_membership_change,
+        jh_messages.ChatMessageError: handle_chat_message_error,
+        jh_messages.FileTransferAck: handle_file_transfer_ack,
+        jh_messages.MemoryUsage: handle_memory_usage,
+        jh_messages.PresenceStats: handle_presence_stats,
+    }
+
+
+def transfer_dicts(messages):
+    """Send the dicts through a pipe, like the workers did."""
+    return [pickle.loads(pickle.dumps(('message', message), pickle.HIGHEST_PROTOCOL))[1] for message in messages]
+
+
+def transfer_records(messages):
+    """Send the records through a pipe, like the workers do."""
+    return [jh_messages.unpack(pickle.loads(pickle.dumps(('message', message.pack()), pickle.HIGHEST_PROTOCOL))[1])
+            for message in messages]
+
+
+def replay(events, build, transfer, transport, use_pickle):
+    """Replay the events through a version, and return the seconds spent building, pickling and handling them."""
+    start = time.perf_counter()
+    messages = build(events)
+    built = time.perf_counter()
+    if use_pickle:
+        messages = transfer(messages)
+    pickled = time.perf_counter()
+    handle_message = transport.handle_message
+    for message in messages:
+        handle_message(message)
+    handled = time.perf_counter()
+    return built - start, pickled - built, handled - pickled
+
+
+def get_size(messages):
+    """Return the bytes used by the messages themselves, not counting the values shared with the events."""
+    return sum(sys.getsizeof(message) for message in messages) / len(messages)
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Replay a mix of Hangouts events through both message protocols.')
+    parser.add_argument('--events', type=int, default=100000, help='number of events to replay')
+    parser.add_argument('--repeat', type=int, default=5, help='number of replays, the best one is reported')
+    parser.add_argument('--pickle', action='store_true', help='pickle the messages, like the worker processes')
+    parser.add_argument('--mix', help='JSON file of the number of events of each kind')
+    args = parser.parse_args()
+
+    mix = DEFAULT_MIX
+    if args.mix:
+        with open(args.mix) as mix_file:
+            mix = json.load(mix_file)
+    events = make_events(mix, args.events)
+
+    print('%d events, best of %d replays, in microseconds per event:' % (args.events, args.repeat))
+    print('%-8s %8s %8s %8s %8s %12s' % ('version', 'build', 'pickle', 'handle', 'total', 'bytes/event'))
+    for name, build, transfer, transport_class in (('dicts', build_dicts, transfer_dicts, DictTransport),
+                                                   ('records', build_records, transfer_records, RecordTransport)):
+        best = None
+        for n in range(args.repeat):
+            timings = replay(events, build, transfer, transport_class(), args.pickle)
+            if best is None or sum(timings) < sum(best):
+                best = timings
+        micros = [seconds * 1e6 / args.events for seconds in best]
+        print('%-8s %8.3f %8.3f %8.3f %8.3f %12.1f' % ((name,) + tuple(micros) + (sum(micros),
+                                                                                   get_size(build(events)))))
+
+
+if __name__ == '__main__':
+    main()
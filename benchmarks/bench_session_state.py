@@ -0,0 +1,126 @@
+"""Measure the memory the transport keeps for the contacts and conversations of a session.
+
+Builds the state of a session from the UserList and ConvList messages of a Hangouts thread, in both versions:
+- dicts: the contact dicts and the {gaia_id: nickname} dicts of the conversations are kept as sent (the transport
+  before jh_xmpp.Contact);
+- records: the contacts are jh_xmpp.Contact records, and each conversation keeps the tuple of the gaia ids of its
+  members, their nicknames being kept once per session (the transport now).
+
+The messages are pickled and unpickled first, like through the pipe of a worker process, so that they do not share
+their strings. The memory still allocated once the messages are dropped is measured with tracemalloc.
+
+Usage: python3 benchmarks/bench_session_state.py [--contacts N] [--conversations N] [--members N]"""
+import argparse
+import gc
+import os
+import pickle
+import random
+import sys
+import tracemalloc
+
+REPO_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, os.path.join(REPO_DIR, 'lib/hangups'))
+sys.path.insert(0, os.path.join(REPO_DIR, 'lib/xmpp'))
+sys.path.insert(0, REPO_DIR)
+import jh_xmpp  # noqa: E402
+
+# Share of the members of the conversations who are not contacts: their nickname is their gaia id.
+STRANGERS = 0.1
+
+
+def make_messages(contacts, conversations, members, rng):
+    """Return the user list and conversation list sent by a Hangouts thread, as in jh_hangups."""
+    user_list = {}
+    for index in range(contacts):
+        gaia_id = str(100000000000000000000 + index)
+        user_list[gaia_id] = {
+            'chat_id': gaia_id,
+            'gaia_id': gaia_id,
+            'first_name': 'First%d' % (index,),
+            'full_name': 'First%d Last%d' % (index, index),
+            'is_self': index == 0,
+            'emails': ['contact%d@example.net' % (index,)],
+            'phones': ['+1555%07d' % (index,)] if index % 3 == 0 else [],
+            'photo_url': 'https://lh3.googleusercontent.com/photo%d/photo.jpg' % (index,),
+            'status': 'online',
+            'status_message': '',
+        }
+    gaia_ids = list(user_list)
+    conv_list = {}
+    for index in range(conversations):
+        names = {gaia_ids[0]: user_list[gaia_ids[0]]['full_name']}
+        while len(names) < members:
+            if rng.random() < STRANGERS:
+                gaia_id = str(200000000000000000000 + rng.randrange(10 * contacts))
+                names[gaia_id] = gaia_id
+            else:
+                gaia_id = rng.choice(gaia_ids)
+                names[gaia_id] = user_list[gaia_id]['full_name']
+        conv_id = '%040x' % (rng.getrandbits(160),)
+        conv_list[conv_id] = {'conv_id': conv_id, 'topic': 'Conversation %d' % (index,), 'user_list': names,
+                              'self_id': gaia_ids[0]}
+    return user_list, conv_list
+
+
+def transfer(message):
+    """Send a message through a pipe, like the workers do."""
+    return pickle.loads(pickle.dumps(message, pickle.HIGHEST_PROTOCOL))
+
+
+def build_dicts(user_list, conv_list):
+    hobj = {'user_list': user_list, 'conv_list': {}}
+    for conv_id, conv in conv_list.items():
+        conv['connected_jids'] = {}
+        conv['invited_jids'] = {}
+        hobj['conv_list'][conv_id] = conv
+    return hobj
+
+
+def build_records(user_list, conv_list):
+    hobj = {'user_list': {sys.intern(gaia_id): jh_xmpp.Contact.from_dict(user) for gaia_id, user in user_list.items()},
+            'conv_list': {}, 'nicknames': {}}
+    for conv_id, conv in conv_list.items():
+        jh_xmpp.set_members(conv, hobj['nicknames'])
+        conv['connected_jids'] = {}
+        conv['invited_jids'] = {}
+        hobj['conv_list'][conv_id] = conv
+    return hobj
+
+
+def measure(build, messages):
+    """Return the bytes kept by the state of a session built from the messages."""
+    gc.collect()
+    tracemalloc.start()
+    try:
+        user_list, conv_list = (transfer(message) for message in messages)
+        hobj = build(user_list, conv_list)
+        del user_list, conv_list
+        gc.collect()
+        size = tracemalloc.get_traced_memory()[0]
+    finally:
+        tracemalloc.stop()
+    del hobj
+    return size
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Measure the memory kept for the contacts and conversations of a '
+                                                 'session.')
+    parser.add_argument('--contacts', type=int, default=1000, help='number of contacts')
+    parser.add_argument('--conversations', type=int, default=300, help='number of group conversations')
+    parser.add_argument('--members', type=int, default=8, help='number of members of each conversation')
+    parser.add_argument('--seed', type=int, default=0, help='seed of the members drawn at random')
+    args = parser.parse_args()
+
+    messages = make_messages(args.contacts, args.conversations, args.members, random.Random(args.seed))
+    print('%d contacts, %d conversations of %d members:' % (args.contacts, args.conversations, args.members))
+    print('%-8s %12s %8s' % ('version', 'bytes', 'ratio'))
+    reference = None
+    for name, build in (('dicts', build_dicts), ('records', build_records)):
+        size = measure(build, messages)
+        reference = reference or size
+        print('%-8s %12d %7.0f%%' % (name, size, 100 * size / reference))
+
+
+if __name__ == '__main__':
+    main()
@@ -5,6 +5,7 @@ pidFile = ""
 
 jid = "hangups.example.net"
 discoName = "Hangouts Transport"
+admins = []
 
 mainServer = "127.0.0.1"
 mainServerJID = "example.net"
@@ -19,6 +20,40 @@ logFile = ""
 debugXMPP = False
 debugHangouts = False
 debugTransport = False
+profileImports = False
 
 refreshTokenDirectory = "/var/spool/jabberhangouts/refresh_tokens"
 spoolFile = "/var/spool/jabberhangouts/spoolfile"
+sessionCookiesMaxAge = "86400"
+snapshotMaxAge = "86400"
+
+hangoutsWorkers = "0"
+
+clusterNode = ""
+clusterStore = "/var/spool/jabberhangouts/users.sqlite"
+clusterAddress = "127.0.0.1:5350"
+clusterLeaseTime = "30"
+
+loginConcurrency = "10"
+loginRate = "2"
+loginBurst = "10"
+
+hangoutsRequestRate = "10"
+hangoutsRequestBurst = "20"
+
+offlineQueueSize = "200"
+outboxMaxAge = "3600"
+
+presenceDampingWindow = "3"
+
+queueShedThreshold = "1000"
+typingMaxAge = "10"
+userQueueLimit = "200"
+queueQuantum = "20"
+userWeights = []
+
+vcardCacheSize = "4194304"
+sessionMemorySoftQuota = "16777216"
+sessionMemoryHardQuota = "67108864"
+
+fileTransferMaxSize = "20971520"
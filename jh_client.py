@@ -0,0 +1,30 @@
+"""Hangouts client of the sessions, imported with the hangups modules by jh_hangups.load_hangups()."""
+import asyncio
+import time
+
+import config
+import jh_stats
+import hangups
+from hangups import ratelimit
+
+
+class Client(hangups.Client):
+    """Hangouts client recording the latency of its requests, and the time they waited for its rate limiter, in the
+    statistics of the transport."""
+    def __init__(self, cookies, jid):
+        rate_limiter = ratelimit.RateLimiter(ratelimit.Limit(float(config.hangoutsRequestRate),
+                                                             int(config.hangoutsRequestBurst)),
+                                             on_wait=self.record_wait)
+        super().__init__(cookies, rate_limiter=rate_limiter)
+        self.jid = jid
+
+    def record_wait(self, endpoint, seconds):
+        jh_stats.stats.observe('hangouts_request_wait', seconds)
+
+    @asyncio.coroutine
+    def _base_request(self, *args, **kwargs):
+        start = time.monotonic()
+        try:
+            return (yield from super()._base_request(*args, **kwargs))
+        finally:
+            jh_stats.stats.observe('hangouts_request', time.monotonic() - start, self.jid)
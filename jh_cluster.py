@@ -0,0 +1,294 @@
+"""Several transport nodes connected under the same component JID.
+
+The nodes share their registered users in a SQLite database, and each Hangouts session is owned by one node through
+a lease renewed while the session runs. Stanzas of a user received by another node are forwarded to the node owning
+the session of the user."""
+import logging
+import pickle
+import socket
+import socketserver
+import sqlite3
+import struct
+import threading
+import time
+
+import config
+from xmpp.protocol import Presence, NodeProcessed
+from xmpp.simplexml import XML2Node
+
+logger = logging.getLogger(__name__)
+
+# Seconds to wait for the database when another node is writing to it:
+STORE_TIMEOUT_SECS = 10
+# Seconds to connect and send a stanza to another node:
+FORWARD_TIMEOUT_SECS = 5
+# Header of the forwarded stanzas: their length in bytes.
+FRAME_HEADER = struct.Struct('!I')
+
+
+class UserStore:
+    """Registered users and session leases, in a SQLite database shared by the nodes.
+
+    It can be used like the shelve of a single transport: store[bare JID] is a dict of the settings of a user, written
+    back by assigning it. Writes are committed at once, so sync() does nothing."""
+    def __init__(self, filename):
+        self.db = sqlite3.connect(filename, timeout=STORE_TIMEOUT_SECS, isolation_level=None,
+                                  check_same_thread=False)
+        self.lock = threading.Lock()
+        with self.lock:
+            self.db.execute('PRAGMA journal_mode=WAL')
+            self.db.execute('CREATE TABLE IF NOT EXISTS users (jid TEXT PRIMARY KEY, data BLOB)')
+            self.db.execute('CREATE TABLE IF NOT EXISTS leases (jid TEXT PRIMARY KEY, node TEXT, expires REAL)')
+            self.db.execute('CREATE TABLE IF NOT EXISTS nodes (node TEXT PRIMARY KEY, address TEXT, expires REAL)')
+
+    def query(self, sql, *args):
+        with self.lock:
+            return self.db.execute(sql, args).fetchall()
+
+    def __contains__(self, jid):
+        return bool(self.query('SELECT 1 FROM users WHERE jid = ?', jid))
+
+    def __getitem__(self, jid):
+        rows = self.query('SELECT data FROM users WHERE jid = ?', jid)
+        if not rows:
+            raise KeyError(jid)
+        return pickle.loads(rows[0][0])
+
+    def __setitem__(self, jid, conf):
+        self.query('INSERT OR REPLACE INTO users (jid, data) VALUES (?, ?)', jid, pickle.dumps(conf))
+
+    def __delitem__(self, jid):
+        self.query('DELETE FROM users WHERE jid = ?', jid)
+
+    def keys(self):
+        return [row[0] for row in self.query('SELECT jid FROM users')]
+
+    def sync(self):
+        pass
+
+    def close(self):
+        with self.lock:
+            self.db.close()
+
+    def acquire_lease(self, jid, node, seconds):
+        """Take the lease of the session of a user, unless another node holds it. Return the owner of the lease."""
+        now = time.time()
+        with self.lock:
+            self.db.execute('BEGIN IMMEDIATE')
+            try:
+                rows = self.db.execute('SELECT node FROM leases WHERE jid = ? AND expires > ?', (jid, now)).fetchall()
+                if rows and rows[0][0] != node:
+                    return rows[0][0]
+                self.db.execute('INSERT OR REPLACE INTO leases (jid, node, expires) VALUES (?, ?, ?)',
+                                (jid, node, now + seconds))
+                return node
+            finally:
+                self.db.execute('COMMIT')
+
+    def get_lease_owner(self, jid):
+        """Return the node holding the lease of the session of a user, or None."""
+        rows = self.query('SELECT node FROM leases WHERE jid = ? AND expires > ?', jid, time.time())
+        return rows[0][0] if rows else None
+
+    def renew_leases(self, node, jids, seconds):
+        """Extend the leases of a node on the sessions of some users, and take again those nobody holds. Return the
+        users whose lease another node holds: the node lost them."""
+        now = time.time()
+        lost = []
+        with self.lock:
+            self.db.execute('BEGIN IMMEDIATE')
+            try:
+                for jid in jids:
+                    if self.db.execute('UPDATE leases SET expires = ? WHERE jid = ? AND node = ?',
+                                       (now + seconds, jid, node)).rowcount:
+                        continue
+                    if self.db.execute('SELECT 1 FROM leases WHERE jid = ? AND expires > ?', (jid, now)).fetchall():
+                        lost.append(jid)
+                    else:
+                        self.db.execute('INSERT OR REPLACE INTO leases (jid, node, expires) VALUES (?, ?, ?)',
+                                        (jid, node, now + seconds))
+            finally:
+                self.db.execute('COMMIT')
+        return lost
+
+    def release_lease(self, jid, node, expires_before):
+        """Release the lease of a node on the session of a user, if it expires before expires_before: the lease taken
+        again since is kept."""
+        self.query('DELETE FROM leases WHERE jid = ? AND node = ? AND expires < ?', jid, node, expires_before)
+
+    def get_leases(self, node):
+        """Return the users whose sessions a node holds the lease of."""
+        return [row[0] for row in self.query('SELECT jid FROM leases WHERE node = ?', node)]
+
+    def get_expired_leases(self):
+        """Return the users whose sessions were owned by a node that stopped renewing them."""
+        return [row[0] for row in self.query('SELECT jid FROM leases WHERE expires <= ?', time.time())]
+
+    def register_node(self, node, address, seconds):
+        """Announce the address a node receives forwarded stanzas on, for a number of seconds."""
+        self.query('INSERT OR REPLACE INTO nodes (node, address, expires) VALUES (?, ?, ?)',
+                   node, address, time.time() + seconds)
+
+    def unregister_node(self, node):
+        self.query('DELETE FROM nodes WHERE node = ?', node)
+        self.query('DELETE FROM leases WHERE node = ?', node)
+
+    def get_node_address(self, node):
+        """Return the address of a running node, or None."""
+        rows = self.query('SELECT address FROM nodes WHERE node = ? AND expires > ?', node, time.time())
+        return rows[0][0] if rows else None
+
+
+def parse_address(address):
+    """Return the (host, port) of an address like 'host:port'."""
+    host, port = address.rsplit(':', 1)
+    return host, int(port)
+
+
+def read_frame(stream):
+    """Return the next forwarded stanza from a socket file, or None at its end."""
+    header = stream.read(FRAME_HEADER.size)
+    if len(header) < FRAME_HEADER.size:
+        return None
+    data = stream.read(FRAME_HEADER.unpack(header)[0])
+    return data.decode('utf-8')
+
+
+class ForwardHandler(socketserver.StreamRequestHandler):
+    """Receive the stanzas forwarded by another node."""
+    def handle(self):
+        while True:
+            text = read_frame(self.rfile)
+            if text is None:
+                return
+            self.server.cluster.receive(text)
+
+
+class ForwardServer(socketserver.ThreadingMixIn, socketserver.TCPServer):
+    daemon_threads = True
+    allow_reuse_address = True
+
+
+class Cluster:
+    """The node of a transport among the others connected under the same component JID.
+
+    A node takes the lease of the session of a user when it receives the available presence of the user and no other
+    node holds it. The leases of the users with a session on the node are renewed every third of lease_time; the
+    others are released. When a node stops renewing its leases, the other nodes take them and probe the presence of
+    their users, which starts the sessions again. A node that finds another one holding the lease of one of its
+    sessions, having missed its renewals, stops the session."""
+    def __init__(self, transport, store, node, address, lease_time, lock):
+        self.transport = transport
+        self.store = store
+        self.node = node
+        self.address = address
+        self.lease_time = lease_time
+        self.lock = lock  # The XMPP lock, held while dispatching forwarded stanzas.
+        self.acquired = {}  # {bare JID: time} Leases taken before their session started.
+        self.forwarding = False  # True while dispatching a stanza forwarded by another node.
+        self.peers = {}  # {node: socket}
+        self.peers_lock = threading.Lock()
+        self.server = None
+        self.running = False
+
+    def start(self):
+        """Listen for the stanzas forwarded by the other nodes, and start renewing the leases."""
+        self.server = ForwardServer(parse_address(self.address), ForwardHandler)
+        self.server.cluster = self
+        self.store.register_node(self.node, self.address, self.lease_time)
+        self.running = True
+        threading.Thread(target=self.server.serve_forever, name='cluster-server', daemon=True).start()
+        threading.Thread(target=self.renew, name='cluster-leases', daemon=True).start()
+        logger.info("Node %s receiving forwarded stanzas on %s.", self.node, self.address)
+
+    def stop(self):
+        """Release the leases, so that the other nodes take the sessions at once."""
+        self.running = False
+        self.store.unregister_node(self.node)
+        if self.server is not None:
+            self.server.shutdown()
+            self.server.server_close()
+
+    def route_stanza(self, con, event):
+        """Stanza handler called before all the others: forward the stanzas of users whose session is owned by
+        another node."""
+        if self.forwarding or event.getFrom() is None:
+            return
+        fromstripped = event.getFrom().getStripped()
+        if fromstripped in self.transport.userlist:
+            return
+        owner = self.store.get_lease_owner(fromstripped)
+        if owner is None and event.getName() == 'presence' and event.getType() is None:
+            owner = self.store.acquire_lease(fromstripped, self.node, self.lease_time)
+            if owner == self.node:
+                self.acquired[fromstripped] = time.monotonic()
+        if owner is not None and owner != self.node and self.forward(owner, event):
+            raise NodeProcessed
+
+    def forward(self, node, stanza):
+        """Send a stanza to another node. Return False if the node cannot be reached."""
+        data = str(stanza).encode('utf-8')
+        with self.peers_lock:
+            for attempt in range(2):
+                peer = self.peers.get(node)
+                try:
+                    if peer is None:
+                        address = self.store.get_node_address(node)
+                        if address is None:
+                            return False
+                        peer = self.peers[node] = socket.create_connection(parse_address(address),
+                                                                           FORWARD_TIMEOUT_SECS)
+                    peer.sendall(FRAME_HEADER.pack(len(data)) + data)
+                    return True
+                except OSError as e:
+                    logger.warning("Could not forward a stanza to node %s: %s.", node, e)
+                    self.peers.pop(node, None)
+                    if peer is not None:
+                        peer.close()
+        return False
+
+    def receive(self, text):
+        """Dispatch a stanza forwarded by another node as if it was received from the server."""
+        node = XML2Node(text)
+        with self.lock:
+            self.forwarding = True
+            try:
+                self.transport.jabber.Dispatcher.dispatch(node, direct=1)
+            except Exception:
+                logger.exception("Could not dispatch a forwarded stanza.")
+            finally:
+                self.forwarding = False
+
+    def renew(self):
+        """Renew the leases of the sessions of this node, release the others, and take the expired ones."""
+        while self.running:
+            self.store.register_node(self.node, self.address, self.lease_time)
+            # The dispatcher changes the sessions and the leases acquired.
+            with self.lock:
+                snapshot = time.time()
+                sessions = set(self.transport.userlist)
+                now = time.monotonic()
+                for jid, acquired in list(self.acquired.items()):
+                    if jid in sessions or now - acquired > self.lease_time:
+                        del self.acquired[jid]
+                leases = sessions | set(self.acquired)
+            for jid in self.store.get_leases(self.node):
+                if jid not in leases:
+                    # The leases this node took after the snapshot expire later than those it renewed before.
+                    self.store.release_lease(jid, self.node, snapshot + self.lease_time)
+
+            for jid in self.store.renew_leases(self.node, leases, self.lease_time):
+                with self.lock:
+                    self.acquired.pop(jid, None)
+                    if jid in sessions and jid in self.transport.userlist:
+                        logger.warning("Node %s took the lease of the session of %s: stopping it.",
+                                       self.store.get_lease_owner(jid), jid)
+                        self.transport.drop_session(jid)
+
+            for jid in self.store.get_expired_leases():
+                if self.store.acquire_lease(jid, self.node, self.lease_time) == self.node:
+                    logger.info("Taking over the session of %s.", jid)
+                    with self.lock:
+                        self.acquired[jid] = time.monotonic()
+                        self.transport.send(Presence(to=jid, frm=config.jid, typ='probe'))
+            time.sleep(self.lease_time / 3)
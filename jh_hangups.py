@@ -2,20 +2,199 @@ import asyncio
 import sys
 import threading
 import logging
+import heapq
+import itertools
+import time
+import os
+import json
+import base64
+import collections
+import contextlib
 
-from hangups.auth import OAUTH2_LOGIN_URL
-import hangups.hangouts_pb2 as hangouts_pb2
-from hangups.conversation_event import ChatMessageEvent, RenameEvent, MembershipChangeEvent
-from hangups.exceptions import NetworkError
-import hangups
+import requests
+
+import config
+import jh_messages
+import jh_stats
 
 hangups_manager = None
 logger = logging.getLogger(__name__)
 
+# The hangups modules take long to import (protocol buffers, parser tables): they are imported by load_hangups() when
+# the first session starts, so that the transport connects to the server without waiting for them.
+hangups = None
+hangouts_pb2 = None
+ChatMessageEvent = RenameEvent = MembershipChangeEvent = None
+NetworkError = None
+Client = None
+hangups_lock = threading.Lock()
+
+# Priorities of the logins waiting in the LoginScheduler: lower is admitted first.
+LOGIN_PRIORITY_INTERACTIVE = 0  # A resource of the user just came online.
+LOGIN_PRIORITY_BACKGROUND = 1  # The transport restarts a session on its own.
+# Interval in seconds between two notifications of their queue position to the users waiting to log in:
+LOGIN_QUEUE_NOTIFY_SECS = 30
+# Delay in seconds before the sync timestamp of a session is written, grouping the updates in between:
+SYNC_TIMESTAMP_SAVE_SECS = 10
+# Delays in seconds between the attempts to send a chat message to Hangouts, before it is bounced back to XMPP:
+SEND_RETRY_DELAYS = (1, 2, 4, 8, 16, 32)
+# Seconds given to the chat messages being sent when a session stops: those still being sent then are bounced to XMPP
+# rather than saved, since they may have reached Hangouts.
+SEND_DRAIN_SECS = 5
+# Seconds to wait for the next chunk of a file received from XMPP before giving its upload up:
+FILE_TRANSFER_IDLE_SECS = 60
+# Interval in seconds between two reports of the memory used by a session:
+MEMORY_CHECK_SECS = 60
+
+
+def load_hangups():
+    """Import the hangups modules, unless they are already."""
+    global hangups, hangouts_pb2, ChatMessageEvent, RenameEvent, MembershipChangeEvent, NetworkError, Client
+    with hangups_lock:
+        if hangups is not None:
+            return
+        start = time.monotonic()
+        import_profile = jh_stats.ImportProfile()
+        with import_profile if config.profileImports else contextlib.suppress():
+            import hangups.hangouts_pb2
+            from hangups.conversation_event import ChatMessageEvent, RenameEvent, MembershipChangeEvent
+            from hangups.exceptions import NetworkError
+            import jh_client
+        Client = jh_client.Client
+        hangouts_pb2 = hangups.hangouts_pb2
+        logger.info("Hangups modules imported in %.3f s.", time.monotonic() - start)
+        if import_profile.times:
+            logger.info("Slowest imports:\n%s", import_profile.summary())
+        jh_stats.startup.mark('hangups loaded')
+
 
 def get_oauth_url():
     """Return the URL the user must follow to obtain a refresh token"""
-    return OAUTH2_LOGIN_URL
+    load_hangups()
+    return hangups.auth.OAUTH2_LOGIN_URL
+
+
+def get_cookies_filename(refresh_token_filename):
+    """Return the name of the file caching the session cookies of a user."""
+    return refresh_token_filename + '.cookies'
+
+
+def get_snapshot_filename(refresh_token_filename):
+    """Return the name of the file storing the snapshot of the last session of a user."""
+    return refresh_token_filename + '.snapshot'
+
+
+def get_sync_filename(refresh_token_filename):
+    """Return the name of the file storing the timestamp up to which the events of a user were received."""
+    return refresh_token_filename + '.sync'
+
+
+def get_outbox_filename(refresh_token_filename):
+    """Return the name of the file storing the chat messages of a user not sent to Hangouts yet."""
+    return refresh_token_filename + '.outbox'
+
+
+def get_session_filenames(refresh_token_filename):
+    """Return the names of every file storing the session of a user."""
+    return [refresh_token_filename,
+            get_cookies_filename(refresh_token_filename),
+            get_snapshot_filename(refresh_token_filename),
+            get_sync_filename(refresh_token_filename),
+            get_outbox_filename(refresh_token_filename)]
+
+
+def save_sync_timestamp(filename, sync_timestamp):
+    """Write a sync timestamp (datetime) to a file, replacing it atomically."""
+    temp_filename = filename + '.tmp'
+    try:
+        with open(temp_filename, 'w') as f:
+            json.dump({'saved': time.time(), 'sync_timestamp': hangups.parsers.to_timestamp(sync_timestamp)}, f)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(temp_filename, filename)
+    except OSError as e:
+        logger.warning("Failed to save the sync timestamp: %s", e)
+
+
+def load_sync_timestamp(filename, max_age):
+    """Read a sync timestamp (datetime). Return None if it is missing, invalid or older than max_age seconds."""
+    try:
+        with open(filename) as f:
+            data = json.load(f)
+        if data['saved'] + max_age <= time.time():
+            return None
+        return hangups.parsers.from_timestamp(data['sync_timestamp'])
+    except (IOError, ValueError, KeyError, TypeError):
+        return None
+
+
+def save_outbox(filename, messages):
+    """Write the chat messages not sent to Hangouts yet to a file, or remove it if there are none."""
+    try:
+        if not messages:
+            if os.path.exists(filename):
+                os.remove(filename)
+            return
+        # The messages are private: so is the file.
+        fd = os.open(filename, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o600)
+        with open(fd, 'w') as f:
+            json.dump({'saved': time.time(),
+                       'messages': [dict(message, sender_jid=str(message['sender_jid'])) for message in messages]}, f)
+    except OSError as e:
+        logger.warning("Failed to save the unsent messages: %s", e)
+
+
+def load_outbox(filename, max_age):
+    """Read and remove the chat messages left unsent by the previous session. Return an empty list if there are
+       none, or if they are older than max_age seconds."""
+    try:
+        with open(filename) as f:
+            data = json.load(f)
+        os.remove(filename)
+        if data['saved'] + max_age <= time.time():
+            logger.info("Dropping %d unsent messages: they are too old.", len(data['messages']))
+            return []
+        return data['messages']
+    except (IOError, ValueError, KeyError, TypeError):
+        return []
+
+
+def save_session_snapshot(filename, snapshot):
+    """Write a snapshot returned by hangups.snapshot_user_conversation_list to a file."""
+    data = {'created': time.time(),
+            'self_entity': base64.b64encode(snapshot['self_entity']).decode('ascii'),
+            'entities': [base64.b64encode(entity).decode('ascii') for entity in snapshot['entities']],
+            'conv_states': [base64.b64encode(conv_state).decode('ascii') for conv_state in snapshot['conv_states']],
+            'sync_timestamp': snapshot['sync_timestamp']}
+    try:
+        # The snapshot holds the contacts of the user: keep it private.
+        fd = os.open(filename, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o600)
+        with open(fd, 'w') as f:
+            json.dump(data, f)
+    except IOError as e:
+        logger.warning("Failed to save the session snapshot: %s", e)
+
+
+def load_session_snapshot(filename, max_age):
+    """Read and remove a session snapshot. Return None if it is missing, invalid or older than max_age seconds."""
+    try:
+        with open(filename) as f:
+            data = json.load(f)
+        os.remove(filename)
+    except (IOError, ValueError):
+        return None
+
+    if data.get('created', 0) + max_age <= time.time():
+        logger.info("Session snapshot is too old: ignoring it.")
+        return None
+    try:
+        return {'self_entity': base64.b64decode(data['self_entity']),
+                'entities': [base64.b64decode(entity) for entity in data['entities']],
+                'conv_states': [base64.b64decode(conv_state) for conv_state in data['conv_states']],
+                'sync_timestamp': data['sync_timestamp']}
+    except (KeyError, TypeError, ValueError) as e:
+        logger.warning("Invalid session snapshot: %s", e)
+        return None
 
 
 def presence_to_status(presence):
@@ -29,20 +208,191 @@ def presence_to_status(presence):
     return status
 
 
-class HangupAuthError(Exception):
+class LoginScheduler(threading.Thread):
+    """Admit the Hangouts threads waiting to log in.
+
+    Logging in means authenticating and fetching the contacts and conversations. At most max_concurrent threads can be
+    logging in at the same time, and logins are started at most at rate per second, with bursts of burst logins, so
+    that a restart of the transport does not log every user in at once. Interactive logins are admitted before
+    background ones."""
+    def __init__(self, max_concurrent, rate, burst):
+        super().__init__(daemon=True)
+        self.max_concurrent = max_concurrent
+        self.rate = rate
+        self.burst = burst
+        self.tokens = burst
+        self.last_refill = time.time()
+        self.condition = threading.Condition()
+        self.sequence = itertools.count()
+        self.waiting = []  # Heap of (priority, sequence, thread)
+        self.queued = {}  # {thread: time queued}, the threads waiting to be started.
+        self.unnotified = set()  # Threads that have not been told their position yet.
+        self.next_notify = 0
+        self.logging_in = {}  # {thread: time started}
+        self.stats = {'logins': 0,
+                      'queue_wait_total': 0.0,
+                      'queue_wait_max': 0.0,
+                      'bootstraps': 0,
+                      'bootstrap_total': 0.0,
+                      'bootstrap_max': 0.0}
+
+    def submit(self, thread, priority=LOGIN_PRIORITY_INTERACTIVE):
+        """Queue a thread: it will be started when admitted."""
+        with self.condition:
+            heapq.heappush(self.waiting, (priority, next(self.sequence), thread))
+            self.queued[thread] = time.time()
+            self.unnotified.add(thread)
+            self.condition.notify()
+
+    def cancel(self, thread):
+        """Remove a thread from the queue. Return True if it was still waiting."""
+        with self.condition:
+            self.unnotified.discard(thread)
+            return self.queued.pop(thread, None) is not None
+
+    def finish(self, thread):
+        """A thread has logged in, or given up: let another one in."""
+        with self.condition:
+            started = self.logging_in.pop(thread, None)
+            if started is None:
+                return
+            duration = time.time() - started
+            self.stats['bootstraps'] += 1
+            self.stats['bootstrap_total'] += duration
+            self.stats['bootstrap_max'] = max(self.stats['bootstrap_max'], duration)
+            logger.info("Login of %s took %.1f s.", thread.jid, duration)
+            self.condition.notify()
+
+    def get_stats(self):
+        """Return the counters of the scheduler."""
+        with self.condition:
+            stats = dict(self.stats)
+            stats['waiting'] = len(self.queued)
+            stats['logging_in'] = len(self.logging_in)
+            return stats
+
+    def refill(self, now):
+        """Add the tokens earned since the last refill to the bucket."""
+        self.tokens = min(self.burst, self.tokens + (now - self.last_refill) * self.rate)
+        self.last_refill = now
+
+    def admit(self, now):
+        """Start as many waiting threads as the limits allow."""
+        while self.waiting and len(self.logging_in) < self.max_concurrent and self.tokens >= 1:
+            priority, sequence, thread = heapq.heappop(self.waiting)
+            queued = self.queued.pop(thread, None)
+            if queued is None:
+                # The login was cancelled.
+                continue
+            self.unnotified.discard(thread)
+            self.tokens -= 1
+            self.logging_in[thread] = now
+
+            wait = now - queued
+            self.stats['logins'] += 1
+            self.stats['queue_wait_total'] += wait
+            self.stats['queue_wait_max'] = max(self.stats['queue_wait_max'], wait)
+            logger.debug("Starting the login of %s after %.1f s in queue.", thread.jid, wait)
+            thread.start()
+
+    def notify_positions(self, now):
+        """Tell the users waiting to log in their position in the queue."""
+        if now >= self.next_notify:
+            self.unnotified.update(self.queued)
+            self.next_notify = now + LOGIN_QUEUE_NOTIFY_SECS
+        if not self.unnotified:
+            return
+        waiting = [thread for priority, sequence, thread in sorted(self.waiting) if thread in self.queued]
+        for position, thread in enumerate(waiting, 1):
+            if thread in self.unnotified:
+                thread.send_message_to_xmpp(jh_messages.LoginQueued(position))
+        self.unnotified.clear()
+
+    def run(self):
+        while True:
+            with self.condition:
+                now = time.time()
+                self.refill(now)
+                self.admit(now)
+                self.notify_positions(now)
+
+                # Sleep until there is something to do.
+                timeout = None
+                if self.queued:
+                    timeout = LOGIN_QUEUE_NOTIFY_SECS
+                    if self.tokens < 1 and self.rate > 0:
+                        timeout = min(timeout, (1 - self.tokens) / self.rate)
+                self.condition.wait(timeout)
+
+
+class PresenceDamper:
+    """Damp the presence changes of the contacts before forwarding them.
+
+    A change is forwarded once the presence of the contact did not change for window seconds. Changes replaced
+    within the window are suppressed, and so are the ones reverting to the presence already forwarded."""
+    def __init__(self, loop, window, forward):
+        self.loop = loop
+        self.window = window
+        self.forward = forward
+        self.forwarded_presences = {}  # {gaia_id: (status, status_message)}
+        self.pending = {}  # {gaia_id: (message, timer handle)}
+        self.stats = {'forwarded': 0, 'suppressed': 0}
+
+    @staticmethod
+    def get_presence(message):
+        return message.status, message.status_message
 
-    """Exception raised when auth fails."""
+    def push(self, message):
+        """Receive a presence message of a contact."""
+        gaia_id = message.gaia_id
+        if gaia_id in self.pending:
+            # The previous change did not last: drop it.
+            self.pending.pop(gaia_id)[1].cancel()
+            self.stats['suppressed'] += 1
+
+        if self.forwarded_presences.get(gaia_id) == self.get_presence(message):
+            # Back to the presence already forwarded.
+            self.stats['suppressed'] += 1
+        elif self.window <= 0:
+            self.flush(gaia_id, message)
+        else:
+            self.pending[gaia_id] = (message, self.loop.call_later(self.window, self.flush, gaia_id, message))
+
+    def flush(self, gaia_id, message):
+        """Forward a presence message which lasted the whole window."""
+        self.pending.pop(gaia_id, None)
+        self.forwarded_presences[gaia_id] = self.get_presence(message)
+        self.stats['forwarded'] += 1
+        self.forward(message)
+
+    def set_forwarded(self, message):
+        """Record a presence message forwarded without damping."""
+        if message.gaia_id in self.pending:
+            self.pending.pop(message.gaia_id)[1].cancel()
+        self.forwarded_presences[message.gaia_id] = self.get_presence(message)
+
+    def get_stats(self):
+        """Return the number of presence changes forwarded and suppressed."""
+        return dict(self.stats)
 
 
 class HangupsManager:
     """Manage the different Hangouts threads."""
     hangouts_threads = {}
 
-    def spawn_thread(self, jid, xmpp_queue, refresh_token_filename, oauth_code=""):
-        """Create a new Hangouts connection"""
+    def __init__(self):
+        self.login_scheduler = LoginScheduler(int(config.loginConcurrency),
+                                              float(config.loginRate),
+                                              int(config.loginBurst))
+        self.login_scheduler.start()
+
+    def spawn_thread(self, jid, xmpp_queue, refresh_token_filename, oauth_code="",
+                     priority=LOGIN_PRIORITY_INTERACTIVE):
+        """Create a new Hangouts connection. It is started when the login scheduler admits it."""
         thread = HangupsThread(jid, xmpp_queue, refresh_token_filename, oauth_code=oauth_code)
+        thread.login_scheduler = self.login_scheduler
         self.hangouts_threads[jid] = thread
-        thread.start()
+        self.login_scheduler.submit(thread, priority)
 
     def get_thread(self, jid):
         """Get a specific Hangouts thread."""
@@ -59,8 +409,21 @@ class HangupsManager:
         """Send work to a thread."""
         thread = self.get_thread(jid)
         if thread is not None:
+            if message['what'] == 'disconnect' and self.login_scheduler.cancel(thread):
+                # The thread was still waiting to log in: it will never be started.
+                self.remove_thread(jid)
+                thread.finish()
+                return
             thread.call_soon_thread_safe(message)
 
+    def get_login_stats(self):
+        """Return the counters of the login scheduler."""
+        return self.login_scheduler.get_stats()
+
+    def count_unsent_messages(self):
+        """Return the number of chat messages from XMPP not sent to Hangouts yet."""
+        return sum(len(thread.get_unsent_messages()) for thread in list(self.hangouts_threads.values()))
+
 
 class HangupsThread(threading.Thread):
     """Represent a connection with Hangouts."""
@@ -70,13 +433,27 @@ class HangupsThread(threading.Thread):
 
         self.jid = jid
         self.refresh_token_filename = refresh_token_filename
+        self.cookies_filename = get_cookies_filename(refresh_token_filename)
+        self.snapshot_filename = get_snapshot_filename(refresh_token_filename)
+        self.sync_filename = get_sync_filename(refresh_token_filename)
+        self.sync_timestamp = None
+        self.sync_timestamp_handle = None
+        self.outbox_filename = get_outbox_filename(refresh_token_filename)
+        self.outbox = {}  # Chat messages not sent yet, by conversation ID, in order.
+        self.outbox_loaded = False  # Whether the chat messages left unsent by the previous session were read.
+        self.sending = {}  # {id of a chat message of the outbox: future of the request sending it}
+        self.early_messages = []  # Chat messages received before the conversations were known.
+        self.file_uploads = {}  # {transfer ID: asyncio.Queue of the chunks of a file received from XMPP}
+        self.memory_check_handle = None
+        self.oauth_code = oauth_code
         self.xmpp_queue = xmpp_queue
 
-        try:
-            self.cookies = hangups.auth.get_auth(lambda: oauth_code, self.refresh_token_filename)
-        except hangups.GoogleAuthError as e:
-            raise HangupAuthError('Login failed ({})'.format(e))
-
+        self.cookies = None
+        self.login_scheduler = None
+        self.stop_requested = False
+        self.stopping = False  # The chat messages are not sent anymore, but saved for the next session.
+        self.connected_once = False
+        self.finished = False
         self.conv_list = None
         self.user_list = None
         self.show = None
@@ -84,80 +461,286 @@ class HangupsThread(threading.Thread):
         self.client = None
         self.type = None
         self.known_conservations = set()  # Maintain a list of conversations sent to XMPP
+        self.presence_damper = None
+        self.messages_lock = threading.Lock()
+        self.waiting_messages = []  # Messages from XMPP received before the loop was created.
 
     def run(self):
-        """Start the main loop."""
+        """Authenticate and start the main loop."""
+        # Authentication makes several HTTP requests (unless the session cookies are cached): it is done in this
+        # thread so that it does not block the XMPP dispatcher.
+        load_hangups()
+        try:
+            self.cookies = hangups.auth.get_auth(lambda: self.oauth_code,
+                                                 self.refresh_token_filename,
+                                                 cookies_filename=self.cookies_filename,
+                                                 cookies_max_age=int(config.sessionCookiesMaxAge))
+        except (hangups.GoogleAuthError, requests.RequestException) as e:
+            self.login_done()
+            self.finish()
+            self.send_message_to_xmpp(jh_messages.AuthFailed('Login failed ({})'.format(e)))
+            logger.info("Hangouts thread stopped: authentication failed.")
+            return
+        if self.stop_requested:
+            self.login_done()
+            self.finish()
+            logger.info("Hangouts thread stopped before connecting.")
+            return
+
         policy = asyncio.get_event_loop_policy()
-        self.loop = policy.new_event_loop()
-        policy.set_event_loop(self.loop)
+        loop = policy.new_event_loop()
+        policy.set_event_loop(loop)
 
-        self.client = hangups.Client(self.cookies)
+        self.client = Client(self.cookies, self.jid)
         self.client.on_connect.add_observer(self.on_connect)
         self.client.on_disconnect.add_observer(self.on_disconnect)
         self.client.on_reconnect.add_observer(self.on_reconnect)
 
+        with self.messages_lock:
+            # The messages received while logging in are handled once the loop runs.
+            self.loop = loop
+            for message in self.waiting_messages:
+                self.loop.call_soon_threadsafe(asyncio.async, self.on_message(message))
+            self.waiting_messages = []
+
         self.loop.run_until_complete(self.client.connect())
-        self.send_message_to_xmpp({'what': 'disconnected'})
+        if not self.stop_requested:
+            # The session stopped on its own: the next one sends the chat messages it did not.
+            self.loop.run_until_complete(self.save_unsent_messages())
+        self.login_done()
+        if not self.connected_once and not self.stop_requested:
+            # The channel could never be opened: the cached cookies may have been revoked, do not reuse them.
+            hangups.auth.clear_session_cookies(self.cookies_filename)
+        self.finish()
+        self.send_message_to_xmpp(jh_messages.Disconnected(final=True))
         logger.info("Hangouts thread stopped.")
 
+    def login_done(self):
+        """Tell the login scheduler that this thread does not need to be counted as logging in anymore."""
+        if self.login_scheduler is not None:
+            self.login_scheduler.finish(self)
+
+    def finish(self):
+        """The thread stops: bounce the chat messages it will not send."""
+        with self.messages_lock:
+            self.finished = True
+            waiting, self.waiting_messages = self.waiting_messages, []
+        for message in waiting:
+            if message['what'] == 'chat_message':
+                self.bounce_chat_message(message, 'the Hangouts session stopped')
+
     def call_soon_thread_safe(self, message):
         """Allow self.on_message to be called inside the asyncio loop.
-           Can be called from a different thread."""
-        if self.loop is not None:
-            self.loop.call_soon_threadsafe(asyncio.async, self.on_message(message))
+           Can be called from a different thread. Messages received before the loop is created are kept until
+           then, and chat messages received once the thread finished are bounced."""
+        if message['what'] == 'disconnect':
+            self.stop_requested = True
+        with self.messages_lock:
+            if self.finished:
+                if message['what'] == 'chat_message':
+                    self.bounce_chat_message(message, 'the Hangouts session stopped')
+            elif self.loop is None:
+                self.waiting_messages.append(message)
+            else:
+                self.loop.call_soon_threadsafe(asyncio.async, self.on_message(message))
 
     def send_message_to_xmpp(self, message):
         """Push a message to the XMPP message queue."""
-        message['jid'] = self.jid
+        message.jid = self.jid
         self.xmpp_queue.put(message)
 
     def set_presence(self, typ, show):
         self.type = typ
         self.show = show
 
-    @asyncio.coroutine
     def chat_message(self, message):
-        """Receive a message from XMPP, and forward it to Hangouts."""
+        """Receive a message from XMPP, and queue it to be forwarded to Hangouts."""
         if message['message'] is None:
             return
+        if self.stopping:
+            # The unsent messages were saved already.
+            self.bounce_chat_message(message, 'the Hangouts session stopped')
+            return
+        if self.conv_list is None:
+            # The conversations are not known yet: queue the message once they are.
+            self.early_messages.append(message)
+            return
 
-        # Mark the client as active, so that other clients don't get notifications.
-        future = asyncio.async(self.client.set_active())
-        future.add_done_callback(lambda future: future.result())
+        conv = self.get_message_conversation(message)
+        if conv is None:
+            return
 
-        conv = None
+        # Each conversation has its own queue, sent in order, while the queues of different conversations are sent
+        # concurrently.
+        queue = self.outbox.get(conv.id_)
+        if queue is None:
+            queue = self.outbox[conv.id_] = collections.deque()
+            asyncio.async(self.send_queued_messages(conv, queue))
+        queue.append(message)
 
+    def get_message_conversation(self, message):
+        """Return the conversation a message from XMPP is addressed to, or None."""
         if message['type'] == 'one_to_one':
-            conv = self.conv_list.get_one_to_one_with_user(message['gaia_id'])
-            if conv:
-                segments = hangups.ChatMessageSegment.from_str(message['message'])
-                try:
-                    yield from conv.send_message(segments)
-                except NetworkError as e:
-                    # Hangouts refused our message: warn XMPP.
-                    self.send_message_to_xmpp({'what': 'chat_message_error',
-                                               'type': 'one_to_one',
-                                               'gaia_id': message['gaia_id'],
-                                               'message': 'Failed to send message. Reason: {}.'.format(e),
-                                               'recipient_jid': message['sender_jid']})
+            return self.conv_list.get_one_to_one_with_user(message['gaia_id'])
         elif message['type'] == 'group':
-            conv = self.conv_list.get_from_sha1_id(message['conv_id'])
-            if conv:
-                segments = hangups.ChatMessageSegment.from_str(message['message'])
-                try:
-                    yield from conv.send_message(segments)
-                except NetworkError as e:
+            return self.conv_list.get_from_sha1_id(message['conv_id'])
+        return None
+
+    def get_unsent_messages(self):
+        """Return the chat messages from XMPP not sent to Hangouts yet."""
+        return [message for queue in self.outbox.values() for message in queue] + self.early_messages
+
+    @asyncio.coroutine
+    def save_unsent_messages(self):
+        """Stop sending the chat messages, and save those not sent for the next session. The messages being sent are
+           given SEND_DRAIN_SECS seconds to complete first."""
+        self.stopping = True
+        if self.sending:
+            yield from asyncio.wait(list(self.sending.values()), timeout=SEND_DRAIN_SECS)
+        unsent = []
+        for queue in self.outbox.values():
+            for message in queue:
+                send = self.sending.get(id(message))
+                if send is None or send.cancelled() or (send.done() and send.exception() is not None):
+                    unsent.append(message)
+                elif not send.done():
+                    # Sending it again could duplicate it.
+                    self.bounce_chat_message(message, 'the Hangouts session stopped while sending it, it may not '
+                                                      'have been delivered')
+        if not self.outbox_loaded:
+            # The session stopped before sending the messages left by the previous one: keep them.
+            unsent = load_outbox(self.outbox_filename, int(config.outboxMaxAge)) + unsent
+        save_outbox(self.outbox_filename, unsent + self.early_messages)
+
+    @asyncio.coroutine
+    def send_queued_messages(self, conv, queue):
+        """Send the messages queued for a conversation, one after the other."""
+        try:
+            while queue:
+                if self.stopping or not (yield from self.send_chat_message(conv, queue[0])):
+                    # The session stops: the remaining messages are saved for the next one.
+                    return
+                queue.popleft()
+        finally:
+            if not self.stopping:
+                # The messages left after an unexpected error would never be sent.
+                for message in queue:
+                    self.bounce_chat_message(message, 'the Hangouts session could not send it')
+                self.outbox.pop(conv.id_, None)
+
+    @asyncio.coroutine
+    def send_chat_message(self, conv, message):
+        """Send a chat message to Hangouts, retrying on network errors (the channel may be reconnecting) before
+           bouncing it to XMPP. Return False if the session stopped before the message could be sent."""
+        # Mark the client as active, so that other clients don't get notifications.
+        future = asyncio.async(self.client.set_active())
+        future.add_done_callback(lambda future: future.result())
+
+        segments = hangups.ChatMessageSegment.from_str(message['message']) if message['message'] else []
+        for delay in SEND_RETRY_DELAYS + (None,):
+            # The send is tracked, so that a session stopping meanwhile knows whether the message was sent.
+            send = self.sending[id(message)] = asyncio.async(conv.send_message(segments,
+                                                                               image_id=message.get('image_id')))
+            try:
+                yield from send
+                break
+            except NetworkError as e:
+                if delay is None:
                     # Hangouts refused our message: warn XMPP.
-                    self.send_message_to_xmpp({'what': 'chat_message_error',
-                                               'type': 'group',
-                                               'conv_id': message['conv_id'],
-                                               'message': 'Failed to send message. Reason: {}.'.format(e),
-                                               'recipient_jid': message['sender_jid']})
+                    self.bounce_chat_message(message, e)
+                    return True
+                logger.info("Failed to send a message (%s), retrying in %d seconds.", e, delay)
+            except asyncio.CancelledError:
+                # The session stops: the message is saved for the next one.
+                raise
+            except Exception as e:
+                logger.exception("Could not send a message.")
+                self.bounce_chat_message(message, e)
+                return True
+            finally:
+                del self.sending[id(message)]
+            yield from asyncio.sleep(delay)
+            if self.stopping:
+                return False
 
-        if conv:
-            # Mark the conversation's newest event as read.
-            future = asyncio.async(conv.update_read_timestamp())
-            future.add_done_callback(lambda future: future.result())
+        # Mark the conversation's newest event as read.
+        future = asyncio.async(conv.update_read_timestamp())
+        future.add_done_callback(lambda future: future.result())
+        return True
+
+    def bounce_chat_message(self, message, reason):
+        """Tell XMPP that a chat message could not be sent to Hangouts."""
+        self.send_message_to_xmpp(jh_messages.ChatMessageError(message['type'],
+                                                               'Failed to send message. Reason: {}.'.format(reason),
+                                                               message['sender_jid'],
+                                                               gaia_id=message.get('gaia_id'),
+                                                               conv_id=message.get('conv_id')))
+
+    def file_transfer_start(self, message):
+        """XMPP starts sending a file: upload it to Hangouts while it is received."""
+        if self.conv_list is None or self.get_message_conversation(message) is None:
+            self.file_transfer_error(message, 'the conversation is not available')
+            return
+        chunks = asyncio.Queue()
+        self.file_uploads[message['transfer_id']] = chunks
+        asyncio.async(self.upload_file(message, chunks))
+
+    def file_transfer_data(self, message):
+        """XMPP received a chunk of a file: pass it to its upload."""
+        chunks = self.file_uploads.get(message['transfer_id'])
+        if chunks is not None:
+            chunks.put_nowait(message['data'])
+
+    def file_transfer_end(self, message, aborted=False):
+        """XMPP received a whole file, or gave it up."""
+        chunks = self.file_uploads.get(message['transfer_id'])
+        if chunks is not None:
+            chunks.put_nowait(ValueError('The transfer was aborted.') if aborted else None)
+
+    def file_transfer_error(self, message, reason):
+        """Tell XMPP that a file could not be sent to Hangouts."""
+        text = 'Failed to send file {}. Reason: {}.'.format(message['filename'], reason)
+        self.send_message_to_xmpp(jh_messages.FileTransferError(message['transfer_id'], message['type'], text,
+                                                                message['sender_jid'],
+                                                                gaia_id=message.get('gaia_id'),
+                                                                conv_id=message.get('conv_id')))
+
+    def stream_file(self, transfer_id, chunks):
+        """Generate the chunks of a file received from XMPP, as a streaming request body. Once a chunk is written to
+        the upload, XMPP is asked for the next one: only a few chunks are in memory at any time."""
+        while True:
+            chunk = yield from asyncio.wait_for(chunks.get(), FILE_TRANSFER_IDLE_SECS)
+            if chunk is None:
+                return
+            if isinstance(chunk, Exception):
+                raise chunk
+            yield chunk
+            self.send_message_to_xmpp(jh_messages.FileTransferAck(transfer_id))
+
+    @asyncio.coroutine
+    def upload_file(self, message, chunks):
+        """Upload a file received from XMPP, then queue a message attaching it to its conversation."""
+        try:
+            image_id = yield from self.client.upload_image_stream(self.stream_file(message['transfer_id'], chunks),
+                                                                  message['filename'], message['size'])
+        except (NetworkError, ValueError, KeyError) as e:
+            # The upload failed, was aborted, or Hangouts did not accept the file.
+            logger.info("Failed to upload a file: %s.", e)
+            self.file_transfer_error(message, e)
+            return
+        finally:
+            del self.file_uploads[message['transfer_id']]
+
+        attachment = {'what': 'chat_message',
+                      'type': message['type'],
+                      'sender_jid': message['sender_jid'],
+                      'message': '',
+                      'image_id': image_id}
+        if message['type'] == 'one_to_one':
+            attachment['gaia_id'] = message['gaia_id']
+        else:
+            attachment['conv_id'] = message['conv_id']
+        self.chat_message(attachment)
 
     @asyncio.coroutine
     def typing_notification(self, message):
@@ -214,10 +797,8 @@ class HangupsThread(threading.Thread):
                             })
 
             # Send data to XMPP
-            self.send_message_to_xmpp({'what': 'conversation_history',
-                                       'conv_id': message['conv_id'],
-                                       'history': history,
-                                       'recipient_jid': message['sender_jid']})
+            self.send_message_to_xmpp(jh_messages.ConversationHistory(message['conv_id'], history,
+                                                                      message['sender_jid']))
 
     @asyncio.coroutine
     def conversation_rename(self, message):
@@ -232,14 +813,40 @@ class HangupsThread(threading.Thread):
         logger.debug("Received a message from XMPP: %r.", message)
         try:
             if message['what'] == 'disconnect':
+                if self.user_list is not None and self.conv_list is not None:
+                    # Keep the state of the session, so that the next one does not need to fetch it again.
+                    save_session_snapshot(self.snapshot_filename,
+                                          hangups.snapshot_user_conversation_list(self.user_list, self.conv_list))
+                # The chat messages held while connecting are saved too.
+                yield from self.save_unsent_messages()
+                if self.sync_timestamp_handle is not None:
+                    self.sync_timestamp_handle.cancel()
+                    self.save_sync_timestamp()
+                if self.memory_check_handle is not None:
+                    self.memory_check_handle.cancel()
+                if self.presence_damper is not None:
+                    logger.info("Presence changes of the contacts: %r.", self.presence_damper.get_stats())
                 yield from self.client.disconnect()
+                if self.user_list is not None:
+                    # Free the unique names of the contacts of this session.
+                    self.user_list.close()
                 self.loop.stop()
             elif message['what'] == 'connect':
                 pass
             elif message['what'] == 'set_presence':
                 self.set_presence(message['type'], message['show'])
             elif message['what'] == 'chat_message':
-                yield from self.chat_message(message)
+                self.chat_message(message)
+            elif message['what'] == 'file_transfer_start':
+                self.file_transfer_start(message)
+            elif message['what'] == 'file_transfer_data':
+                self.file_transfer_data(message)
+            elif message['what'] == 'file_transfer_end':
+                self.file_transfer_end(message)
+            elif message['what'] == 'file_transfer_abort':
+                self.file_transfer_end(message, aborted=True)
+            elif message['what'] == 'evict_caches':
+                self.evict_caches()
             elif message['what'] == 'typing_notification':
                 yield from self.typing_notification(message)
             elif message['what'] == 'conversation_history_request':
@@ -252,16 +859,31 @@ class HangupsThread(threading.Thread):
     @asyncio.coroutine
     def on_connect(self):
         """Hangouts is connected."""
-        self.send_message_to_xmpp({'what': 'connected'})
+        self.connected_once = True
+        self.send_message_to_xmpp(jh_messages.Connected())
 
-        # Get the list of users and conversations
-        self.user_list, self.conv_list = (
-            yield from hangups.build_user_conversation_list(self.client)
-        )
+        # Get the list of users and conversations, from the snapshot of the previous session if it is recent enough.
+        snapshot = load_session_snapshot(self.snapshot_filename, int(config.snapshotMaxAge))
+        resync = snapshot is not None
+        if snapshot is not None:
+            logger.info("Resuming the session from its snapshot.")
+            self.user_list, self.conv_list = hangups.build_user_conversation_list_from_snapshot(self.client, snapshot)
+        else:
+            self.user_list, self.conv_list = (
+                yield from hangups.build_user_conversation_list(self.client)
+            )
+            sync_timestamp = load_sync_timestamp(self.sync_filename, int(config.snapshotMaxAge))
+            if sync_timestamp is not None and sync_timestamp < self.conv_list._sync_timestamp:
+                # The previous session stopped without a snapshot: receive the events it missed.
+                self.conv_list._sync_timestamp = sync_timestamp
+                resync = True
 
+        # Presence notifications may arrive as soon as the observer is registered.
+        self.presence_damper = PresenceDamper(self.loop, float(config.presenceDampingWindow), self.send_message_to_xmpp)
         self.user_list.on_presence.add_observer(self.on_presence)
         self.conv_list.on_event.add_observer(self.on_event)
         self.conv_list.on_typing.add_observer(self.on_typing)
+        self.conv_list.on_sync_timestamp_update.add_observer(self.on_sync_timestamp_update)
 
         # Query presence information for user list
         participant_ids = []
@@ -296,7 +918,11 @@ class HangupsThread(threading.Thread):
                 'status': presence_to_status(user.presence),
                 'status_message': user.get_mood_message(),
             }
-        self.send_message_to_xmpp({'what': 'user_list', 'user_list': user_list_dict})
+        self.send_message_to_xmpp(jh_messages.UserList(user_list_dict))
+
+        for user in user_list_dict.values():
+            self.presence_damper.set_forwarded(jh_messages.ContactPresence(user['gaia_id'], user['status'],
+                                                                           user['status_message']))
 
         # Send conversation list to XMPP
         conv_list_dict = {}
@@ -321,34 +947,67 @@ class HangupsThread(threading.Thread):
                     'user_list': user_list,
                     'self_id': self_gaia_id,
                 }
-        self.send_message_to_xmpp({'what': 'conv_list',
-                                   'conv_list': conv_list_dict,
-                                   'self_gaia': self.user_list._self_user.id_.gaia_id})
+        self.send_message_to_xmpp(jh_messages.ConvList(conv_list_dict, self.user_list._self_user.id_.gaia_id))
+        self.login_done()
+
+        # Send the messages left unsent by the previous session, then those received while connecting.
+        early_messages, self.early_messages = self.early_messages, []
+        self.outbox_loaded = True
+        for message in load_outbox(self.outbox_filename, int(config.outboxMaxAge)) + early_messages:
+            self.chat_message(message)
+
+        self.check_memory()
+
+        if resync:
+            # Receive the events that happened since the previous session stopped.
+            yield from self.conv_list._sync()
+
+    def on_sync_timestamp_update(self, sync_timestamp):
+        """Events were received up to sync_timestamp: write it to disk soon."""
+        self.sync_timestamp = sync_timestamp
+        if self.sync_timestamp_handle is None:
+            self.sync_timestamp_handle = self.loop.call_later(SYNC_TIMESTAMP_SAVE_SECS, self.save_sync_timestamp)
+
+    def save_sync_timestamp(self):
+        """Write the sync timestamp to disk, so that the next session can receive the events from there."""
+        self.sync_timestamp_handle = None
+        save_sync_timestamp(self.sync_filename, self.sync_timestamp)
+
+    def check_memory(self):
+        """Report an estimate of the memory used by the session to XMPP, which checks it against the quotas, and the
+        number of presence changes of the contacts forwarded and suppressed."""
+        self.memory_check_handle = self.loop.call_later(MEMORY_CHECK_SECS, self.check_memory)
+        self.send_message_to_xmpp(jh_messages.MemoryUsage(self.user_list.estimate_size()
+                                                          + self.conv_list.estimate_size()))
+        self.send_message_to_xmpp(jh_messages.PresenceStats(**self.presence_damper.get_stats()))
+
+    def evict_caches(self):
+        """Forget the events cached by the conversations, but the latest ones: history is fetched again if needed."""
+        if self.conv_list is not None:
+            logger.info("Evicted %d cached events.", self.conv_list.evict_events())
 
     @asyncio.coroutine
     def on_disconnect(self):
         """Hangouts is disconnected"""
-        self.send_message_to_xmpp({'what': 'disconnected'})
+        self.send_message_to_xmpp(jh_messages.Disconnected())
 
     @asyncio.coroutine
     def on_reconnect(self):
         """Hangouts reconnected"""
-        self.send_message_to_xmpp({'what': 'connected'})
+        self.send_message_to_xmpp(jh_messages.Connected())
 
         # Send presence information for contacts.
         for user in self.user_list.get_all():
-            self.send_message_to_xmpp({'what': 'presence',
-                                       'gaia_id': user.id_.gaia_id,
-                                       'status': presence_to_status(user.presence),
-                                       'status_message': user.get_mood_message()})
+            message = jh_messages.ContactPresence(user.id_.gaia_id, presence_to_status(user.presence),
+                                                  user.get_mood_message())
+            self.presence_damper.set_forwarded(message)
+            self.send_message_to_xmpp(message)
 
     @asyncio.coroutine
     def on_presence(self, user, presence):
-        """Receive presence information from Hangouts, and forward it to XMPP."""
-        self.send_message_to_xmpp({'what': 'presence',
-                                   'gaia_id': user.id_.gaia_id,
-                                   'status': presence_to_status(presence),
-                                   'status_message': user.get_mood_message()})
+        """Receive presence information from Hangouts, and forward it to XMPP once it is stable."""
+        self.presence_damper.push(jh_messages.ContactPresence(user.id_.gaia_id, presence_to_status(presence),
+                                                              user.get_mood_message()))
 
     def on_event(self, conv_event):
         """Receive event from Hangouts."""
@@ -377,46 +1036,37 @@ class HangupsThread(threading.Thread):
                 'user_list': user_list,
                 'self_id': self_gaia_id,
             }
-            self.send_message_to_xmpp({'what': 'conversation_add',
-                                       'conv': conv_dict})
+            self.send_message_to_xmpp(jh_messages.ConversationAdd(conv_dict))
 
         if isinstance(conv_event, hangups.ChatMessageEvent):
             # Event is a chat message: foward it to XMPP.
             if conv._conversation.type == hangouts_pb2.CONVERSATION_TYPE_ONE_TO_ONE:
                 if not user.is_self:
-                    self.send_message_to_xmpp({'what': 'chat_message',
-                                               'type': 'one_to_one',
-                                               'gaia_id': user.id_.gaia_id,
-                                               'message': conv_event.text})
+                    self.send_message_to_xmpp(jh_messages.ChatMessage('one_to_one', user.id_.gaia_id,
+                                                                      conv_event.text))
             elif conv._conversation.type == hangouts_pb2.CONVERSATION_TYPE_GROUP:
-                self.send_message_to_xmpp({'what': 'chat_message',
-                                           'type': 'group',
-                                           'conv_id': conv.id_sha1,
-                                           'gaia_id': user.id_.gaia_id,
-                                           'message': conv_event.text})
+                self.send_message_to_xmpp(jh_messages.ChatMessage('group', user.id_.gaia_id, conv_event.text,
+                                                                  conv_id=conv.id_sha1))
         elif isinstance(conv_event, RenameEvent):
             # Conversation was renamed
             if conv._conversation.type == hangouts_pb2.CONVERSATION_TYPE_GROUP:
-                self.send_message_to_xmpp({'what': 'conversation_rename',
-                                           'conv_id': conv.id_sha1,
-                                           'new_name': conv_event.new_name})
+                self.send_message_to_xmpp(jh_messages.ConversationRename(conv.id_sha1, conv_event.new_name))
         elif isinstance(conv_event, MembershipChangeEvent):
             # Members joined or left a conversation
             if conv._conversation.type == hangouts_pb2.CONVERSATION_TYPE_GROUP:
-                message = {'what': 'conversation_membership_change',
-                           'conv_id': conv.id_sha1}
+                message = jh_messages.ConversationMembershipChange(conv.id_sha1)
 
                 event_users = [conv.get_user(user_id) for user_id in conv_event.participant_ids]
                 if conv_event.type_ == hangups.MEMBERSHIP_CHANGE_TYPE_JOIN:
                     new_members = {}
                     for user in event_users:
                         new_members[user.id_.gaia_id] = user.unique_full_name
-                    message['new_members'] = new_members
+                    message.new_members = new_members
                 elif conv_event.type_ == hangups.MEMBERSHIP_CHANGE_TYPE_LEAVE:
                     old_members = {}
                     for user in event_users:
                         old_members[user.id_.gaia_id] = user.unique_full_name
-                    message['old_members'] = old_members
+                    message.old_members = old_members
 
                 self.send_message_to_xmpp(message)
 
@@ -433,7 +1083,5 @@ class HangupsThread(threading.Thread):
             }
             if conv._conversation.type == hangouts_pb2.CONVERSATION_TYPE_ONE_TO_ONE:
                 if not user.is_self:
-                    self.send_message_to_xmpp({'what': 'typing_notification',
-                                               'type': 'one_to_one',
-                                               'gaia_id': user.id_.gaia_id,
-                                               'state': typing_states[typing_message.status]})
+                    self.send_message_to_xmpp(jh_messages.TypingNotification('one_to_one', user.id_.gaia_id,
+                                                                             typing_states[typing_message.status]))
@@ -0,0 +1,236 @@
+"""Messages sent by the Hangouts threads to the transport.
+
+There is a class for each kind of message. Messages have slots instead of a dict, since a session sends many of them
+(presences, typing notifications), and the transport picks their handler from their class. The bare JID of the session
+is set by the thread when the message is sent. The worker processes send them packed as tuples."""
+
+
+def unpack(packed):
+    """Create a message from the tuple returned by its pack() method."""
+    return kinds[packed[0]](*packed[2], jid=packed[1])
+
+
+class HangupsMessage:
+    """Base class of the messages. what names the kind of message, in logs and statistics.
+
+    The slots of each class are in the order of the arguments of its constructor, the JID of the session aside."""
+    __slots__ = ('jid',)
+    what = None
+
+    def __init__(self, jid=None):
+        self.jid = jid
+
+    def pack(self):
+        """Return the message as a tuple of its kind, JID and the values of its slots, to send it to another process.
+        Pickling the message itself would pickle the name of its class, and unpickling it look the class up."""
+        return self.what, self.jid, tuple([getattr(self, name) for name in self.__slots__])
+
+    def __repr__(self):
+        return '%s(%s)' % (type(self).__name__, ', '.join('%s=%r' % (name, getattr(self, name))
+                                                          for name in ('jid',) + self.__slots__))
+
+
+class Connected(HangupsMessage):
+    """Hangouts is connected."""
+    __slots__ = ()
+    what = 'connected'
+
+
+class Disconnected(HangupsMessage):
+    """Hangouts is disconnected. The session stopped if final is True, otherwise it is reconnecting."""
+    __slots__ = ('final',)
+    what = 'disconnected'
+
+    def __init__(self, final=False, jid=None):
+        self.jid = jid
+        self.final = final
+
+
+class LoginQueued(HangupsMessage):
+    """The session waits for its turn to log in."""
+    __slots__ = ('position',)
+    what = 'login_queued'
+
+    def __init__(self, position, jid=None):
+        self.jid = jid
+        self.position = position
+
+
+class AuthFailed(HangupsMessage):
+    """The session could not log in."""
+    __slots__ = ('reason',)
+    what = 'auth_failed'
+
+    def __init__(self, reason, jid=None):
+        self.jid = jid
+        self.reason = reason
+
+
+class UserList(HangupsMessage):
+    """The {gaia_id: contact dict} of the contacts of the user."""
+    __slots__ = ('user_list',)
+    what = 'user_list'
+
+    def __init__(self, user_list, jid=None):
+        self.jid = jid
+        self.user_list = user_list
+
+
+class ConvList(HangupsMessage):
+    """The {conv_id: conversation dict} of the group conversations of the user, and the user's own gaia id."""
+    __slots__ = ('conv_list', 'self_gaia')
+    what = 'conv_list'
+
+    def __init__(self, conv_list, self_gaia, jid=None):
+        self.jid = jid
+        self.conv_list = conv_list
+        self.self_gaia = self_gaia
+
+
+class ConversationAdd(HangupsMessage):
+    """A group conversation the transport did not know of."""
+    __slots__ = ('conv',)
+    what = 'conversation_add'
+
+    def __init__(self, conv, jid=None):
+        self.jid = jid
+        self.conv = conv
+
+
+class ContactPresence(HangupsMessage):
+    """The presence of a contact changed."""
+    __slots__ = ('gaia_id', 'status', 'status_message')
+    what = 'presence'
+
+    def __init__(self, gaia_id, status, status_message, jid=None):
+        self.jid = jid
+        self.gaia_id = gaia_id
+        self.status = status
+        self.status_message = status_message
+
+
+class ChatMessage(HangupsMessage):
+    """A chat message of a contact. type is 'one_to_one' or 'group', in which case conv_id is set."""
+    __slots__ = ('type', 'gaia_id', 'message', 'conv_id')
+    what = 'chat_message'
+
+    def __init__(self, type, gaia_id, message, conv_id=None, jid=None):
+        self.jid = jid
+        self.type = type
+        self.gaia_id = gaia_id
+        self.conv_id = conv_id
+        self.message = message
+
+
+class TypingNotification(HangupsMessage):
+    """A contact started or stopped typing."""
+    __slots__ = ('type', 'gaia_id', 'state')
+    what = 'typing_notification'
+
+    def __init__(self, type, gaia_id, state, jid=None):
+        self.jid = jid
+        self.type = type
+        self.gaia_id = gaia_id
+        self.state = state
+
+
+class ConversationHistory(HangupsMessage):
+    """The history of a conversation, requested by a resource of the user."""
+    __slots__ = ('conv_id', 'history', 'recipient_jid')
+    what = 'conversation_history'
+
+    def __init__(self, conv_id, history, recipient_jid, jid=None):
+        self.jid = jid
+        self.conv_id = conv_id
+        self.history = history
+        self.recipient_jid = recipient_jid
+
+
+class ConversationRename(HangupsMessage):
+    """A group conversation was renamed."""
+    __slots__ = ('conv_id', 'new_name')
+    what = 'conversation_rename'
+
+    def __init__(self, conv_id, new_name, jid=None):
+        self.jid = jid
+        self.conv_id = conv_id
+        self.new_name = new_name
+
+
+class ConversationMembershipChange(HangupsMessage):
+    """Members joined or left a group conversation: new_members and old_members are {gaia_id: name} dicts, or None."""
+    __slots__ = ('conv_id', 'new_members', 'old_members')
+    what = 'conversation_membership_change'
+
+    def __init__(self, conv_id, new_members=None, old_members=None, jid=None):
+        self.jid = jid
+        self.conv_id = conv_id
+        self.new_members = new_members
+        self.old_members = old_members
+
+
+class ChatMessageError(HangupsMessage):
+    """A chat message from XMPP could not be sent. gaia_id is set for a 'one_to_one' message, conv_id otherwise."""
+    __slots__ = ('type', 'message', 'recipient_jid', 'gaia_id', 'conv_id')
+    what = 'chat_message_error'
+
+    def __init__(self, type, message, recipient_jid, gaia_id=None, conv_id=None, jid=None):
+        self.jid = jid
+        self.type = type
+        self.message = message
+        self.recipient_jid = recipient_jid
+        self.gaia_id = gaia_id
+        self.conv_id = conv_id
+
+
+class FileTransferAck(HangupsMessage):
+    """A chunk of a file transfer was uploaded."""
+    __slots__ = ('transfer_id',)
+    what = 'file_transfer_ack'
+
+    def __init__(self, transfer_id, jid=None):
+        self.jid = jid
+        self.transfer_id = transfer_id
+
+
+class FileTransferError(HangupsMessage):
+    """A file from XMPP could not be uploaded or sent. It has the slots of a ChatMessageError, and its transfer id."""
+    __slots__ = ('transfer_id', 'type', 'message', 'recipient_jid', 'gaia_id', 'conv_id')
+    what = 'file_transfer_error'
+
+    def __init__(self, transfer_id, type, message, recipient_jid, gaia_id=None, conv_id=None, jid=None):
+        self.jid = jid
+        self.transfer_id = transfer_id
+        self.type = type
+        self.message = message
+        self.recipient_jid = recipient_jid
+        self.gaia_id = gaia_id
+        self.conv_id = conv_id
+
+
+class MemoryUsage(HangupsMessage):
+    """An estimate in bytes of the memory used by the session."""
+    __slots__ = ('size',)
+    what = 'memory_usage'
+
+    def __init__(self, size, jid=None):
+        self.jid = jid
+        self.size = size
+
+
+class PresenceStats(HangupsMessage):
+    """The number of presence changes of the contacts forwarded and suppressed by the session."""
+    __slots__ = ('forwarded', 'suppressed')
+    what = 'presence_stats'
+
+    def __init__(self, forwarded, suppressed, jid=None):
+        self.jid = jid
+        self.forwarded = forwarded
+        self.suppressed = suppressed
+
+
+# {kind: message class}
+kinds = {cls.what: cls for cls in (Connected, Disconnected, LoginQueued, AuthFailed, UserList, ConvList,
+                                   ConversationAdd, ContactPresence, ChatMessage, TypingNotification,
+                                   ConversationHistory, ConversationRename, ConversationMembershipChange,
+                                   ChatMessageError, FileTransferAck, FileTransferError, MemoryUsage, PresenceStats)}
@@ -0,0 +1,224 @@
+"""Queue of the messages sent by the Hangouts threads to the transport."""
+import threading
+import time
+import collections
+import itertools
+import queue
+import logging
+
+import jh_stats
+
+logger = logging.getLogger(__name__)
+
+# Classes of messages, served by priority (the lowest first):
+PRIORITY_CONTROL = 0  # State of the sessions: connection, lists of contacts and conversations.
+PRIORITY_MESSAGE = 1  # Chat messages, their errors, history and file transfers.
+PRIORITY_MEMBERSHIP = 2  # Changes of the members or the name of conversations.
+PRIORITY_PRESENCE = 3  # Presence of the contacts, and other periodic reports.
+PRIORITY_TYPING = 4  # Typing notifications.
+PRIORITY_NAMES = ['control', 'message', 'membership', 'presence', 'typing']
+
+# Class of each kind of message. Unknown kinds are PRIORITY_MESSAGE.
+PRIORITIES = {
+    'connected': PRIORITY_CONTROL,
+    'disconnected': PRIORITY_CONTROL,
+    'login_queued': PRIORITY_CONTROL,
+    'auth_failed': PRIORITY_CONTROL,
+    'user_list': PRIORITY_CONTROL,
+    'conv_list': PRIORITY_CONTROL,
+    'conversation_add': PRIORITY_CONTROL,
+    'chat_message': PRIORITY_MESSAGE,
+    'chat_message_error': PRIORITY_MESSAGE,
+    'conversation_history': PRIORITY_MESSAGE,
+    'file_transfer_ack': PRIORITY_MESSAGE,
+    'file_transfer_error': PRIORITY_MESSAGE,
+    'conversation_membership_change': PRIORITY_MEMBERSHIP,
+    'conversation_rename': PRIORITY_MEMBERSHIP,
+    'presence': PRIORITY_PRESENCE,
+    'memory_usage': PRIORITY_PRESENCE,
+    'presence_stats': PRIORITY_PRESENCE,
+    'typing_notification': PRIORITY_TYPING,
+}
+
+
+def is_sheddable(message):
+    """Return whether a message may be dropped under load: a notification that a contact started typing. A pause or
+    a stop is always delivered, or the contact would be left showing as typing."""
+    return message.what == 'typing_notification' and message.state == 'started'
+
+
+def is_invalidated(message):
+    """Return whether a queued message is stale once the session of its user connected or disconnected: the
+    presences, sent again on connection, and the started typing notifications."""
+    return message.what == 'presence' or is_sheddable(message)
+
+
+def get_coalesce_key(message):
+    """Return the key shared by a message and the older messages it supersedes, or None if it supersedes nothing."""
+    if message.what in ('presence', 'typing_notification'):
+        return (message.jid, message.what, message.gaia_id)
+    if message.what in ('memory_usage', 'presence_stats'):
+        return (message.jid, message.what)
+    return None
+
+
+def parse_weights(entries):
+    """Return the {bare jid: weight} of entries like 'user@example.net 4'."""
+    weights = {}
+    for entry in entries:
+        jid, weight = entry.split()
+        weights[jid] = float(weight)
+    return weights
+
+
+class MessageQueue:
+    """Queue of the messages of the Hangouts threads, served by priority class and fairly between the users.
+
+    A class is only served when the classes before it are empty, so that chat messages are not delayed by bursts of
+    presence or typing notifications. Within a class, each user has a sub-queue, and the users are served by deficit
+    round robin: at its turn, a user is served until it spent its quantum of handling time (quantum seconds times its
+    weight, 1 by default), which charge() takes from. A user in busy conversations thus cannot starve the others, and
+    the time it spent over its quantum is owed at its next turns. A user with no message left is forgotten, debt
+    included, as in the usual deficit round robin: the users coming and going do not pile up.
+
+    A presence, typing notification or memory report replaces the one still queued for the same contact, in its place.
+    Since the classes are served out of order, a connected or disconnected message of a user drops the presences and
+    started typing notifications of the user still queued, which would otherwise be handled after it. Once
+    shed_threshold messages are queued, or user_limit messages of a user, new started typing notifications are
+    dropped, and those that waited more than typing_max_age seconds are dropped when they are served.
+
+    It has the put, get and qsize methods of queue.Queue, and can be used from any thread. The handler of a message
+    returned by get() calls charge() once done with it."""
+    def __init__(self, shed_threshold, typing_max_age, user_limit, quantum, weights=None):
+        self.shed_threshold = shed_threshold
+        self.typing_max_age = typing_max_age
+        self.user_limit = user_limit
+        self.quantum = quantum
+        self.weights = weights or {}
+        self.shedding = False
+        self.condition = threading.Condition()
+        # {bare jid: {key: (time queued, message)}} per class, in the order the users are served:
+        self.classes = [collections.OrderedDict() for name in PRIORITY_NAMES]
+        self.sequence = itertools.count()
+        self.size = 0
+        self.pending = collections.Counter()  # {bare jid: number of messages queued}
+        self.deficits = {}  # {bare jid: seconds of handling time left at its turn}
+        self.coalesced = collections.Counter()  # {class name: number of messages superseded by a newer one}
+        self.shed = collections.Counter()  # {class name: number of messages dropped}
+
+    def get_quantum(self, jid):
+        """Return the handling time given to a user at each turn."""
+        return self.quantum * self.weights.get(jid, 1)
+
+    def put(self, message):
+        """Queue a message."""
+        jid = message.jid
+        priority = PRIORITIES.get(message.what, PRIORITY_MESSAGE)
+        key = get_coalesce_key(message)
+        with self.condition:
+            if message.what in ('connected', 'disconnected'):
+                self.invalidate(jid)
+            users = self.classes[priority]
+            messages = users.get(jid)
+            if key is not None and messages is not None and key in messages:
+                messages[key] = (messages[key][0], message)
+                self.coalesced[PRIORITY_NAMES[priority]] += 1
+                return
+            if self.size >= self.shed_threshold and not self.shedding:
+                self.shedding = True
+                logger.warning("%d messages from Hangouts waiting: shedding typing notifications.", self.size)
+            elif self.size < self.shed_threshold // 2 and self.shedding:
+                self.shedding = False
+                logger.info("Messages from Hangouts back under control, shed so far: %s.", dict(self.shed))
+            if is_sheddable(message) and (self.size >= self.shed_threshold or self.pending[jid] >= self.user_limit):
+                self.shed[PRIORITY_NAMES[priority]] += 1
+                return
+            if messages is None:
+                messages = users[jid] = collections.OrderedDict()
+            self.deficits.setdefault(jid, self.get_quantum(jid))
+            messages[key if key is not None else next(self.sequence)] = (time.monotonic(), message)
+            self.size += 1
+            self.pending[jid] += 1
+            self.condition.notify()
+
+    def get(self, block=True, timeout=None):
+        """Remove and return the next message. Raise queue.Empty if there is none after timeout seconds, or at once
+        if block is False."""
+        deadline = time.monotonic() + timeout if timeout is not None else None
+        with self.condition:
+            while True:
+                message = self.pop()
+                if message is not None:
+                    return message
+                remaining = deadline - time.monotonic() if deadline is not None else None
+                if not block or (remaining is not None and remaining <= 0):
+                    raise queue.Empty
+                self.condition.wait(remaining)
+
+    def pop(self):
+        """Remove and return the next message, or None. Must be called with the condition held."""
+        for priority, users in enumerate(self.classes):
+            while users:
+                jid, messages = next(iter(users.items()))
+                if self.deficits[jid] <= 0:
+                    # The user spent its quantum: its next turn comes after the other users.
+                    self.deficits[jid] += self.get_quantum(jid)
+                    users.move_to_end(jid)
+                    continue
+                key, (queued, message) = messages.popitem(last=False)
+                if not messages:
+                    del users[jid]
+                self.size -= 1
+                self.pending[jid] -= 1
+                delay = time.monotonic() - queued
+                if delay > self.typing_max_age and is_sheddable(message):
+                    self.shed[PRIORITY_NAMES[priority]] += 1
+                    self.forget(jid)
+                    continue
+                jh_stats.stats.observe_delay(jid, delay)
+                return message
+        return None
+
+    def invalidate(self, jid):
+        """Drop the queued messages of a user made stale by a change of the connection of its session. Must be called
+        with the condition held."""
+        for priority in (PRIORITY_PRESENCE, PRIORITY_TYPING):
+            messages = self.classes[priority].get(jid)
+            if messages is None:
+                continue
+            for key, (queued, message) in list(messages.items()):
+                if is_invalidated(message):
+                    del messages[key]
+                    self.size -= 1
+                    self.pending[jid] -= 1
+                    self.coalesced[PRIORITY_NAMES[priority]] += 1
+            if not messages:
+                del self.classes[priority][jid]
+
+    def charge(self, message, seconds):
+        """Charge the user of a message returned by get() for the seconds spent handling it."""
+        jid = message.jid
+        with self.condition:
+            if self.pending[jid]:
+                self.deficits[jid] -= seconds
+            else:
+                self.forget(jid)
+
+    def forget(self, jid):
+        """Forget a user with no message queued. Must be called with the condition held."""
+        if not self.pending[jid]:
+            self.pending.pop(jid, None)
+            self.deficits.pop(jid, None)
+
+    def qsize(self):
+        """Return the number of messages queued."""
+        with self.condition:
+            return self.size
+
+    def get_stats(self):
+        """Return the number of messages queued, coalesced and shed, by class name."""
+        with self.condition:
+            return {name: {'queued': sum(len(messages) for messages in self.classes[priority].values()),
+                           'coalesced': self.coalesced[name],
+                           'shed': self.shed[name]}
+                    for priority, name in enumerate(PRIORITY_NAMES)}
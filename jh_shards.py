@@ -0,0 +1,371 @@
+"""Hosting of the Hangouts sessions in worker processes, sharded by user.
+
+The process of the transport keeps the XMPP connection and the Transport, and each worker process runs a
+jh_hangups.HangupsManager for a shard of the users. They exchange the usual messages over pipes."""
+import bisect
+import hashlib
+import logging
+import multiprocessing
+import queue
+import signal
+import threading
+import time
+
+import config
+import xmlconfig
+import debug as debug_module
+import jh_hangups
+import jh_messages
+
+logger = logging.getLogger(__name__)
+
+# Points of each worker on the hash ring:
+RING_REPLICAS = 64
+# Seconds between the statistics reports of the workers:
+WORKER_STATS_SECS = 5
+# Seconds the sessions of a stopping worker get to disconnect and save their state:
+WORKER_STOP_SECS = 10
+
+
+class HashRing:
+    """Consistent hashing of keys to nodes: adding or removing a node only moves the keys of that node."""
+    def __init__(self):
+        self.points = []  # Sorted [(hash, node)]
+
+    @staticmethod
+    def hash(key):
+        return int.from_bytes(hashlib.md5(key.encode('utf-8')).digest()[:8], 'big')
+
+    def add(self, node):
+        for replica in range(RING_REPLICAS):
+            bisect.insort(self.points, (self.hash('%s#%d' % (node, replica)), node))
+
+    def remove(self, node):
+        self.points = [point for point in self.points if point[1] != node]
+
+    def get(self, key):
+        """Return the node of a key, or None if there is no node."""
+        if not self.points:
+            return None
+        index = bisect.bisect(self.points, (self.hash(key),))
+        return self.points[index % len(self.points)][1]
+
+
+class WorkerChannel(threading.Thread):
+    """End of the pipe of a worker process. The Hangouts threads of the worker use it as their XMPP queue.
+
+    Items are sent by this thread, so that the worker keeps reading the commands of the transport even when the
+    transport is slow to read its messages."""
+    def __init__(self, connection):
+        super().__init__(daemon=True)
+        self.connection = connection
+        self.items = queue.Queue()
+        self.migrating = set()  # Bare JIDs of the sessions moving to another worker.
+
+    def put(self, message):
+        if isinstance(message, jh_messages.Disconnected) and message.jid in self.migrating:
+            # The session goes on in another worker.
+            return
+        self.send(('message', message.pack()))
+
+    def send(self, item):
+        self.items.put(item)
+
+    def run(self):
+        while True:
+            item = self.items.get()
+            if item is None:
+                return
+            try:
+                self.connection.send(item)
+            except OSError:
+                logger.debug("The transport stopped, dropping %r.", item)
+
+    def stop(self):
+        """Send the items left, then stop."""
+        self.items.put(None)
+        self.join(WORKER_STOP_SECS)
+
+
+def get_config_options():
+    """Return the {name: value} of the options of the transport, as they are in effect in this process."""
+    return {name: value for name, value in vars(config).items()
+            if not name.startswith('_') and isinstance(value, (str, bool, int, list))}
+
+
+def report_stats(manager, channel):
+    """Send the statistics of the sessions of a worker to the transport, every WORKER_STATS_SECS seconds."""
+    while True:
+        channel.send(('stats', {'login': manager.get_login_stats(),
+                                'unsent': manager.count_unsent_messages(),
+                                'sessions': len(manager.hangouts_threads)}))
+        time.sleep(WORKER_STATS_SECS)
+
+
+def finish_migration(manager, channel, jid, thread):
+    """Wait until the session of a user moving to another worker stopped and saved its state, then tell the
+    transport."""
+    while manager.get_thread(jid) is thread and thread is not None and not thread.finished:
+        time.sleep(0.1)
+    if manager.get_thread(jid) is thread:
+        manager.remove_thread(jid)
+    channel.send(('migrated', jid))
+
+
+def run_worker(connection, options):
+    """Main function of a worker process: run the Hangouts sessions the transport sends, with the configuration
+    options of the transport."""
+    # The transport stops its workers itself.
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    signal.signal(signal.SIGTERM, signal.SIG_IGN)
+    xmlconfig.reloadConfig(options=options)
+    debug_module.setup_logging()
+    jh_hangups.hangups_manager = manager = jh_hangups.HangupsManager()
+    channel = WorkerChannel(connection)
+    channel.start()
+    threading.Thread(target=report_stats, args=(manager, channel), daemon=True).start()
+
+    while True:
+        try:
+            command = connection.recv()
+        except (EOFError, OSError):
+            command = ('stop',)
+        if command[0] == 'stop':
+            break
+        elif command[0] == 'spawn':
+            jid, refresh_token_filename, oauth_code, priority, pending = command[1:]
+            channel.migrating.discard(jid)
+            manager.spawn_thread(jid, channel, refresh_token_filename, oauth_code=oauth_code, priority=priority)
+            # The messages received while the session was moving are handled once its loop runs.
+            for message in pending:
+                manager.send_message(jid, message)
+        elif command[0] == 'message':
+            manager.send_message(command[1], command[2])
+        elif command[0] == 'remove':
+            manager.remove_thread(command[1])
+        elif command[0] == 'migrate_out':
+            jid = command[1]
+            channel.migrating.add(jid)
+            thread = manager.get_thread(jid)
+            manager.send_message(jid, {'what': 'disconnect'})
+            threading.Thread(target=finish_migration, args=(manager, channel, jid, thread), daemon=True).start()
+
+    threads = list(manager.hangouts_threads.values())
+    for jid in list(manager.hangouts_threads):
+        manager.send_message(jid, {'what': 'disconnect'})
+    deadline = time.monotonic() + WORKER_STOP_SECS
+    while time.monotonic() < deadline and not all(thread.finished or not thread.is_alive() for thread in threads):
+        time.sleep(0.1)
+    channel.stop()
+    logger.info("Hangouts worker stopped.")
+
+
+class Worker:
+    """A worker process, seen from the transport."""
+    def __init__(self, index, context):
+        self.index = index
+        self.connection, child_connection = context.Pipe()
+        self.process = context.Process(target=run_worker, args=(child_connection, get_config_options()),
+                                       name='hangouts-worker-%d' % (index,), daemon=True)
+        self.process.start()
+        child_connection.close()
+        self.lock = threading.Lock()
+        self.stats = {'login': {'waiting': 0, 'logging_in': 0}, 'unsent': 0, 'sessions': 0}
+        self.retiring = False
+
+    def send(self, *command):
+        with self.lock:
+            try:
+                self.connection.send(command)
+            except OSError:
+                logger.error("Could not send %s to Hangouts worker %d.", command[0], self.index)
+
+
+class SessionProxy:
+    """A Hangouts session hosted by a worker process, seen from the transport."""
+    def __init__(self, worker, refresh_token_filename):
+        self.worker = worker
+        self.refresh_token_filename = refresh_token_filename
+        self.stop_requested = False
+        self.finished = False
+        self.pending = None  # Messages for the session while it moves to another worker.
+
+
+class ShardedHangupsManager:
+    """Manage the Hangouts sessions hosted by worker processes, so that decoding the traffic of the sessions uses
+    several cores.
+
+    Users are assigned to the workers by consistent hashing of their bare JID. When workers are added or removed,
+    the sessions whose worker changed are moved: they are stopped, which saves their state, then started again on
+    their new worker. Messages for a moving session are held until it is started again.
+
+    It has the methods of jh_hangups.HangupsManager used by the transport. The messages of the sessions are put in
+    xmpp_queue."""
+    def __init__(self, workers, xmpp_queue):
+        self.context = multiprocessing.get_context('forkserver')
+        self.xmpp_queue = xmpp_queue
+        self.lock = threading.RLock()
+        self.ring = HashRing()
+        self.workers = {}  # {index: Worker}
+        self.next_index = 0
+        self.hangouts_threads = {}  # {bare JID: SessionProxy}
+        for _ in range(workers):
+            self.add_worker()
+
+    def add_worker(self):
+        """Start a new worker and move its share of the sessions to it. Return its index."""
+        with self.lock:
+            worker = Worker(self.next_index, self.context)
+            self.next_index += 1
+            self.workers[worker.index] = worker
+            threading.Thread(target=self.read_worker, args=(worker,), daemon=True).start()
+            self.ring.add(worker.index)
+            logger.info("Hangouts worker %d started.", worker.index)
+            self.rebalance()
+            return worker.index
+
+    def remove_worker(self):
+        """Move the sessions of the last worker to the others, then stop it. Return its index, or None if it is the
+        only worker left."""
+        with self.lock:
+            active = [index for index, worker in self.workers.items() if not worker.retiring]
+            if len(active) <= 1:
+                return None
+            worker = self.workers[max(active)]
+            worker.retiring = True
+            self.ring.remove(worker.index)
+            logger.info("Stopping Hangouts worker %d.", worker.index)
+            self.rebalance()
+            self.stop_if_idle(worker)
+            return worker.index
+
+    def rebalance(self):
+        """Move the sessions hosted by another worker than theirs on the ring."""
+        for jid, proxy in self.hangouts_threads.items():
+            target = self.workers.get(self.ring.get(jid))
+            if proxy.worker is not target and proxy.pending is None and not proxy.finished:
+                logger.debug("Moving the session of %s from worker %d.", jid, proxy.worker.index)
+                proxy.pending = []
+                proxy.worker.send('migrate_out', jid)
+
+    def stop_if_idle(self, worker):
+        """Stop a retiring worker once all its sessions moved."""
+        if worker.retiring and worker.index in self.workers and \
+                not any(proxy.worker is worker for proxy in self.hangouts_threads.values()):
+            worker.send('stop')
+
+    def spawn_thread(self, jid, xmpp_queue, refresh_token_filename, oauth_code="",
+                     priority=jh_hangups.LOGIN_PRIORITY_INTERACTIVE):
+        """Create a new Hangouts session on the worker of a user."""
+        with self.lock:
+            worker = self.workers.get(self.ring.get(jid))
+            if worker is None:
+                logger.error("No Hangouts worker to start the session of %s.", jid)
+                self.xmpp_queue.put(jh_messages.AuthFailed('The transport is overloaded', jid=jid))
+                return
+            self.hangouts_threads[jid] = SessionProxy(worker, refresh_token_filename)
+            worker.send('spawn', jid, refresh_token_filename, oauth_code, priority, [])
+
+    def get_thread(self, jid):
+        """Get a specific Hangouts session."""
+        return self.hangouts_threads.get(jid)
+
+    def remove_thread(self, jid):
+        """Remove a specific session from the list."""
+        with self.lock:
+            proxy = self.hangouts_threads.pop(jid, None)
+            if proxy is not None and proxy.pending is None:
+                proxy.worker.send('remove', jid)
+
+    def send_message(self, jid, message):
+        """Send work to a session."""
+        with self.lock:
+            proxy = self.hangouts_threads.get(jid)
+            if proxy is None:
+                return
+            if message['what'] == 'disconnect':
+                proxy.stop_requested = True
+            if proxy.pending is not None:
+                proxy.pending.append(message)
+            else:
+                proxy.worker.send('message', jid, message)
+
+    def get_login_stats(self):
+        """Return the number of sessions waiting to log in and logging in, as last reported by the workers."""
+        workers = list(self.workers.values())
+        return {'waiting': sum(worker.stats['login']['waiting'] for worker in workers),
+                'logging_in': sum(worker.stats['login']['logging_in'] for worker in workers)}
+
+    def count_unsent_messages(self):
+        """Return the number of chat messages not sent to Hangouts yet, as last reported by the workers."""
+        with self.lock:
+            moving = sum(len(proxy.pending) for proxy in self.hangouts_threads.values() if proxy.pending)
+        return moving + sum(worker.stats['unsent'] for worker in list(self.workers.values()))
+
+    def read_worker(self, worker):
+        """Receive the messages of a worker until it stops."""
+        while True:
+            try:
+                item = worker.connection.recv()
+            except (EOFError, OSError):
+                break
+            if item[0] == 'message':
+                message = jh_messages.unpack(item[1])
+                if isinstance(message, jh_messages.AuthFailed) or \
+                        (isinstance(message, jh_messages.Disconnected) and message.final):
+                    with self.lock:
+                        proxy = self.hangouts_threads.get(message.jid)
+                        if proxy is not None and proxy.worker is worker:
+                            proxy.finished = True
+                self.xmpp_queue.put(message)
+            elif item[0] == 'migrated':
+                self.migrated(item[1], worker)
+            elif item[0] == 'stats':
+                worker.stats = item[1]
+
+        with self.lock:
+            if worker.retiring:
+                logger.info("Hangouts worker %d stopped.", worker.index)
+            else:
+                logger.error("Hangouts worker %d stopped unexpectedly.", worker.index)
+                worker.retiring = True
+                self.ring.remove(worker.index)
+            del self.workers[worker.index]
+            for jid, proxy in list(self.hangouts_threads.items()):
+                if proxy.worker is not worker:
+                    continue
+                if proxy.pending is not None:
+                    self.migrated(jid, worker)
+                else:
+                    # The transport starts a new session for the users still connected.
+                    proxy.finished = True
+                    self.xmpp_queue.put(jh_messages.Disconnected(final=True, jid=jid))
+
+    def migrated(self, jid, worker):
+        """A session stopped on its previous worker: start it on its new one."""
+        with self.lock:
+            proxy = self.hangouts_threads.get(jid)
+            if proxy is not None and proxy.worker is worker and proxy.pending is not None:
+                pending, proxy.pending = proxy.pending, None
+                target = self.workers.get(self.ring.get(jid))
+                if proxy.stop_requested:
+                    del self.hangouts_threads[jid]
+                elif target is None:
+                    proxy.finished = True
+                    self.xmpp_queue.put(jh_messages.Disconnected(final=True, jid=jid))
+                else:
+                    proxy.worker = target
+                    target.send('spawn', jid, proxy.refresh_token_filename, '', jh_hangups.LOGIN_PRIORITY_BACKGROUND,
+                                pending)
+                    logger.debug("Session of %s moved to worker %d.", jid, target.index)
+            self.stop_if_idle(worker)
+
+    def stop(self):
+        """Stop the workers, after their sessions disconnected."""
+        with self.lock:
+            workers = list(self.workers.values())
+            for worker in workers:
+                worker.retiring = True
+                worker.send('stop')
+        for worker in workers:
+            worker.process.join(WORKER_STOP_SECS + 1)
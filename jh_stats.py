@@ -0,0 +1,251 @@
+"""Live performance statistics of the transport, shown by its admin commands."""
+import builtins
+import importlib.util
+import sys
+import threading
+import time
+import collections
+import cProfile
+import pstats
+import io
+import os
+import tempfile
+import logging
+
+logger = logging.getLogger(__name__)
+
+# Number of latency samples kept per kind of operation to compute the percentiles:
+LATENCY_SAMPLES = 2048
+# Number of queueing delays kept per session to compute its percentiles:
+DELAY_SAMPLES = 256
+# Window in seconds over which the rates are computed:
+RATE_WINDOW_SECS = 60
+# Number of functions listed in the summary of a profile:
+PROFILE_SUMMARY_LINES = 25
+# Number of modules listed in the summary of an import profile:
+IMPORT_PROFILE_LINES = 25
+
+
+class Stats:
+    """Rates and latencies of the operations of the transport, recorded from any thread.
+
+    Each kind of operation (stanzas, messages from the Hangouts threads, Hangouts requests...) has a rate over the last
+    RATE_WINDOW_SECS seconds and percentiles over its last LATENCY_SAMPLES latencies. The time spent per session is
+    also accumulated, to find the slowest ones."""
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.started = time.time()
+        self.totals = collections.Counter()  # {kind: number of operations since the start}
+        self.buckets = collections.defaultdict(collections.deque)  # {kind: deque of [second, number of operations]}
+        self.latencies = collections.defaultdict(lambda: collections.deque(maxlen=LATENCY_SAMPLES))
+        self.sessions = {}  # {bare jid: [number of operations, total seconds, max seconds]}
+        self.delays = collections.defaultdict(lambda: collections.deque(maxlen=DELAY_SAMPLES))  # {bare jid: seconds}
+
+    def count(self, kind, number=1):
+        """Record operations of a kind."""
+        now = int(time.monotonic())
+        with self.lock:
+            self.totals[kind] += number
+            buckets = self.buckets[kind]
+            if buckets and buckets[-1][0] == now:
+                buckets[-1][1] += number
+            else:
+                buckets.append([now, number])
+            while buckets[0][0] <= now - RATE_WINDOW_SECS:
+                buckets.popleft()
+
+    def observe(self, kind, seconds, session=None):
+        """Record an operation of a kind and how long it took, for the session of the bare jid session if any."""
+        self.count(kind)
+        with self.lock:
+            self.latencies[kind].append(seconds)
+            if session is not None:
+                totals = self.sessions.setdefault(session, [0, 0.0, 0.0])
+                totals[0] += 1
+                totals[1] += seconds
+                totals[2] = max(totals[2], seconds)
+
+    def observe_delay(self, session, seconds):
+        """Record how long a message of the session of the bare jid session waited in the queue of the transport."""
+        self.observe('hangups_queue_delay', seconds)
+        with self.lock:
+            self.delays[session].append(seconds)
+
+    def get_rate(self, kind):
+        """Return the number of operations of a kind per second, over the last RATE_WINDOW_SECS seconds."""
+        now = int(time.monotonic())
+        with self.lock:
+            return sum(number for second, number in self.buckets.get(kind, ())
+                       if second > now - RATE_WINDOW_SECS) / RATE_WINDOW_SECS
+
+    def get_percentiles(self, kind, percentiles=(50, 99)):
+        """Return the given percentiles of the latencies of a kind of operation, in seconds, or None if there are no
+        samples yet."""
+        with self.lock:
+            samples = list(self.latencies.get(kind, ()))
+        return get_percentiles(samples, percentiles)
+
+    def get_kinds(self):
+        """Return the kinds of operations recorded so far."""
+        with self.lock:
+            return sorted(self.totals)
+
+    def get_slowest_sessions(self, number):
+        """Return the (bare jid, number of operations, total seconds, max seconds) of the sessions that spent the
+        most time, slowest first."""
+        with self.lock:
+            sessions = [(jid,) + tuple(totals) for jid, totals in self.sessions.items()]
+        sessions.sort(key=lambda session: session[2], reverse=True)
+        return sessions[:number]
+
+    def get_delayed_sessions(self, number, percentiles=(50, 99)):
+        """Return the (bare jid, number of samples, percentiles of the queueing delays) of the sessions whose messages
+        waited the most, by their last percentile."""
+        with self.lock:
+            sessions = [(jid, list(delays)) for jid, delays in self.delays.items()]
+        sessions = [(jid, len(delays)) + tuple(get_percentiles(delays, percentiles)) for jid, delays in sessions]
+        sessions.sort(key=lambda session: session[-1], reverse=True)
+        return sessions[:number]
+
+    def forget_session(self, session):
+        """Drop the totals of a session that stopped."""
+        with self.lock:
+            self.sessions.pop(session, None)
+            self.delays.pop(session, None)
+
+
+def get_percentiles(samples, percentiles):
+    """Return the given percentiles of samples, or None if there are none."""
+    samples = sorted(samples)
+    if not samples:
+        return None
+    return [samples[min(len(samples) - 1, len(samples) * percentile // 100)] for percentile in percentiles]
+
+
+class ProfileCapture:
+    """Profile the calls made through run() during a number of seconds, then write the profile to a file.
+
+    The XMPP dispatcher and the queue thread both handle stanzas and messages while holding the XMPP lock, so the
+    calls run through one capture never overlap."""
+    def __init__(self, seconds, on_done):
+        self.profiler = cProfile.Profile()
+        self.deadline = time.monotonic() + seconds
+        self.on_done = on_done
+
+    def run(self, func, *args):
+        """Call func(*args) under the profiler."""
+        return self.profiler.runcall(func, *args)
+
+    def is_over(self):
+        """Return True once the capture lasted long enough."""
+        return time.monotonic() >= self.deadline
+
+    def finish(self):
+        """Write the profile to a file and pass its name and a summary of the slowest functions to on_done."""
+        fd, filename = tempfile.mkstemp(prefix='jabberhangouts-', suffix='.prof')
+        os.close(fd)
+        self.profiler.dump_stats(filename)
+        summary = io.StringIO()
+        pstats.Stats(self.profiler, stream=summary).sort_stats('cumulative').print_stats(PROFILE_SUMMARY_LINES)
+        logger.info("Profile written to %s.", filename)
+        self.on_done(filename, summary.getvalue())
+
+
+class ImportProfile:
+    """Time spent importing each module by a thread, while used as a context manager.
+
+    The import function is replaced meanwhile: the imports of the other threads are not timed."""
+    def __init__(self):
+        self.thread = None
+        self.original_import = None
+        self.times = {}  # {module name: [seconds including its own imports, seconds excluding them]}
+        self.stack = []  # Seconds spent in the nested imports of each import in progress.
+
+    def __enter__(self):
+        self.thread = threading.get_ident()
+        self.original_import = builtins.__import__
+        builtins.__import__ = self.timed_import
+        return self
+
+    def __exit__(self, *exc_info):
+        builtins.__import__ = self.original_import
+
+    def timed_import(self, name, globals=None, locals=None, fromlist=(), level=0):
+        if threading.get_ident() != self.thread:
+            return self.original_import(name, globals, locals, fromlist, level)
+        loaded = len(sys.modules)
+        start = time.perf_counter()
+        self.stack.append(0.0)
+        try:
+            return self.original_import(name, globals, locals, fromlist, level)
+        finally:
+            seconds = time.perf_counter() - start
+            nested = self.stack.pop()
+            if self.stack:
+                self.stack[-1] += seconds
+            if len(sys.modules) > loaded:
+                if level:
+                    name = importlib.util.resolve_name('.' * level + name, (globals or {}).get('__package__'))
+                times = self.times.setdefault(name, [0.0, 0.0])
+                times[0] += seconds
+                times[1] += seconds - nested
+
+    def summary(self, lines=IMPORT_PROFILE_LINES):
+        """Return the modules that took the longest to import, one per line."""
+        slowest = sorted(self.times.items(), key=lambda item: item[1][0], reverse=True)[:lines]
+        return '\n'.join('%8.1f ms %8.1f ms self  %s' % (total * 1000, own * 1000, name)
+                         for name, (total, own) in slowest)
+
+
+class Startup:
+    """Time at which each step of the start of the transport was reached, since the start of the process (when this
+    module is first imported)."""
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.started = time.monotonic()
+        self.steps = collections.OrderedDict()  # {step: seconds since the start}
+
+    def mark(self, step):
+        """Record that a step is reached, unless it already was, and log the timeline so far."""
+        with self.lock:
+            if step in self.steps:
+                return
+            self.steps[step] = time.monotonic() - self.started
+            timeline = self.format()
+        logger.info("Startup: %s.", timeline)
+
+    def get_timeline(self):
+        """Return the steps reached so far, with their times."""
+        with self.lock:
+            return self.format()
+
+    def format(self):
+        return ', '.join('%s after %.3f s' % (step, seconds) for step, seconds in self.steps.items())
+
+
+stats = Stats()
+startup = Startup()
+profile_capture = None
+
+
+def start_profile(seconds, on_done):
+    """Start profiling the handling of stanzas and messages. Return False if a capture is already running."""
+    global profile_capture
+    if profile_capture is not None:
+        return False
+    profile_capture = ProfileCapture(seconds, on_done)
+    return True
+
+
+def run_profiled(func, *args):
+    """Call func(*args), under the profiler if a capture is running. Must be called while holding the XMPP lock."""
+    global profile_capture
+    if profile_capture is None:
+        return func(*args)
+    capture = profile_capture
+    try:
+        return capture.run(func, *args)
+    finally:
+        if capture.is_over():
+            profile_capture = None
+            capture.finish()
@@ -1,53 +1,100 @@
+import sys
 import time
 import datetime
 import logging
 import threading
-from multiprocessing import Queue, Lock
+from multiprocessing import Lock
 import queue
 import urllib.request
 import base64
 import hashlib
 import os
 import re
+import collections
+import binascii
 
 import config
 import xmpp
 import xmpp.client
 import xmpp.protocol
 from xmpp.browser import Browser
-from xmpp.protocol import Presence, Message, Error, Iq, NodeProcessed, JID, DataForm
+from xmpp.protocol import Presence, Message, Error, Iq, NodeProcessed, JID, DataForm, DataField
 from xmpp.protocol import NS_REGISTER, NS_PRESENCE, NS_VERSION, NS_COMMANDS, NS_DISCO_INFO, NS_CHATSTATES, NS_ROSTERX, \
-    NS_VCARD, NS_AVATAR, NS_MUC, NS_MUC_UNIQUE, NS_DISCO_ITEMS, NS_DATA
+    NS_VCARD, NS_AVATAR, NS_MUC, NS_MUC_UNIQUE, NS_DISCO_ITEMS, NS_DATA, NS_SI, NS_FILE, NS_FEATURE, NS_IBB
 from xmpp.simplexml import Node
 from toolbox import MucUser
 import jh_hangups
+import jh_messages
+import jh_stats
+import jh_queue
+import jh_shards
 
 NODE_ROSTER = 'roster'
 NODE_VCARDUPDATE = 'vcard-temp:x:update x'
 NODE_COMMANDS = 'http://jabber.org/protocol/commands'
 NODE_SET_ALIAS = 'set_alias'
 NODE_REMOVE_ALIAS = 'remove_alias'
+NODE_MEMORY_USAGE = 'memory_usage'
+NODE_STATS = 'stats'
+NODE_SLOWEST_SESSIONS = 'slowest_sessions'
+NODE_QUEUE_DELAYS = 'queue_delays'
+NODE_PROFILE = 'profile'
+NODE_EVICT_CACHES = 'evict_caches'
+NODE_ADD_WORKER = 'add_worker'
+NODE_REMOVE_WORKER = 'remove_worker'
 NS_CONFERENCE = 'jabber:x:conference'
 NS_DELAY = 'urn:xmpp:delay'
 NS_XMPP_STANZAS = 'urn:ietf:params:xml:ns:xmpp-stanzas'
 
-xmpp_queue = Queue()
+xmpp_queue = None
 xmpp_lock = Lock()
 userfile = None
 
 logger = logging.getLogger(__name__)
 
+# Probes for the same contact received within this number of seconds get a single answer.
+PROBE_COALESCE_SECS = 2
+# Number of chunks of a file transfer that may be received before the previous ones were uploaded to Hangouts.
+FILE_TRANSFER_WINDOW = 4
+# Seconds after which a file transfer neither the sender nor Hangouts went on with is aborted, refusing its chunks
+# not acknowledged. Longer than jh_hangups.FILE_TRANSFER_IDLE_SECS, after which Hangouts gives the upload up itself.
+FILE_TRANSFER_IDLE_SECS = 90
+# Duration in seconds of the profiles captured by the profile admin command:
+PROFILE_CAPTURE_SECS = 30
+# Number of sessions listed by the slowest_sessions admin command:
+SLOWEST_SESSIONS = 10
+# Delay in seconds before trying to reconnect to the server, doubled after each failed attempt up to the maximum:
+RECONNECT_DELAY_SECS = 1
+RECONNECT_MAX_DELAY_SECS = 60
+# Delay in seconds before starting again a session that stopped on its own, doubled at each consecutive stop:
+RESPAWN_DELAY_SECS = 5
+# Number of consecutive stops after which a session is only started again by a new presence of the user:
+RESPAWN_MAX_ATTEMPTS = 6
+# Seconds a session must stay connected for its next stop not to count as consecutive:
+RESPAWN_RESET_SECS = 600
+
 
 class Transport:
     """Represents the connection with the Jabber server"""
     online = 1
     userlist = {}
-    discoresults = {}
+    discoresults = {}  # {full jid: set of the features the resource supports}
 
     def __init__(self, jabber, auserfile):
         self.jabber = jabber
         self.userfile = auserfile
         self.disco = None
+        self.vcard_cache = VCardCache(int(config.vcardCacheSize))
+        self.connected = False
+        self.presence_cache = {}  # {bare jid: {destination jid: {contact jid: (type, show, status)}}}
+        self.probe_answers = {}  # {bare jid: {(probing jid, contact jid): time of the last answer to a probe}}
+        self.outbox = {}  # {bare jid: deque of the stanzas that could not be sent while disconnected}
+        self.file_transfers = {}  # {transfer ID: state of a file being received from a user}
+        self.next_file_transfer_check = 0
+        self.cluster = None  # jh_cluster.Cluster, when several nodes run the transport.
+        # The default disconnect handler raises IOError from whatever call noticed the loss of the connection.
+        self.jabber.UnregisterDisconnectHandler(self.jabber.DisconnectHandler)
+        self.jabber.RegisterDisconnectHandler(self.xmpp_disconnected)
 
     def xmpp_connect(self):
         connected = self.jabber.connect((config.mainServer, config.port))
@@ -61,22 +108,74 @@ class Transport:
         logger.debug("Transport is going to auth with the server.")
         connected = self.jabber.auth(config.saslUsername, config.secret)
         logger.debug("Auth returned: %r.", connected)
+        self.connected = bool(connected)
         return connected
 
+    def xmpp_disconnected(self):
+        """The connection to the server was lost: the stanzas are kept until it is reconnected by xmpp_disconnect."""
+        if self.connected:
+            logger.warning("Connection to the server lost: keeping the stanzas until the transport reconnects.")
+        self.connected = False
+
+    def send(self, stanza):
+        """Send a stanza to the server, or keep it for later if the transport is disconnected."""
+        if self.connected:
+            self.jabber.send(stanza)
+            if self.connected:
+                return
+
+        if (isinstance(stanza, Presence) and stanza.getType() in (None, 'unavailable')
+                and not JID(stanza.getFrom()).getResource()):
+            # The presence of the transport and of the contacts is sent again from the state of the users once
+            # reconnected. Subscriptions, probes and presences in group chats are kept.
+            return
+        jid = JID(stanza.getTo()).getStripped()
+        if jid not in self.outbox:
+            self.outbox[jid] = collections.deque(maxlen=int(config.offlineQueueSize))
+        if len(self.outbox[jid]) == self.outbox[jid].maxlen:
+            logger.warning("Offline queue of %s is full: dropping its oldest stanza.", jid)
+        self.outbox[jid].append(stanza)
+
+    def send_batch(self, stanzas):
+        """Send several stanzas to the server, one after the other. Each one goes through Dispatcher.send (ID,
+        route wrapping, namespace); xmpppy leaves Nagle's algorithm enabled on its socket, so the kernel coalesces
+        the small writes of a burst into full segments."""
+        for stanza in stanzas:
+            self.send(stanza)
+
     def register_handlers(self):
-        self.jabber.RegisterHandler('presence', self.xmpp_presence)
-        self.jabber.RegisterHandler('message', self.xmpp_message)
-        self.jabber.RegisterHandler('iq', self.xmpp_iq_discoinfo_results, typ='result', ns=NS_DISCO_INFO)
-        self.jabber.RegisterHandler('iq', self.xmpp_iq_register_get, typ='get', ns=NS_REGISTER)
-        self.jabber.RegisterHandler('iq', self.xmpp_iq_register_set, typ='set', ns=NS_REGISTER)
-        self.jabber.RegisterHandler('iq', self.xmpp_iq_vcard, typ='get', ns=NS_VCARD)
-        self.jabber.RegisterHandler('iq', self.xmpp_iq_command, typ='set', ns=NS_COMMANDS)
+        if self.cluster is not None:
+            # Stanzas of the users whose session runs on another node are forwarded before being handled.
+            for name in ('presence', 'message', 'iq'):
+                self.jabber.RegisterHandler(name, self.cluster.route_stanza, makefirst=1)
+        self.jabber.RegisterHandler('presence', self.timed(self.xmpp_presence))
+        self.jabber.RegisterHandler('message', self.timed(self.xmpp_message))
+        self.jabber.RegisterHandler('iq', self.timed(self.xmpp_iq_discoinfo_results), typ='result', ns=NS_DISCO_INFO)
+        self.jabber.RegisterHandler('iq', self.timed(self.xmpp_iq_discoinfo_results), typ='error', ns=NS_DISCO_INFO)
+        self.jabber.RegisterHandler('iq', self.timed(self.xmpp_iq_register_get), typ='get', ns=NS_REGISTER)
+        self.jabber.RegisterHandler('iq', self.timed(self.xmpp_iq_register_set), typ='set', ns=NS_REGISTER)
+        self.jabber.RegisterHandler('iq', self.timed(self.xmpp_iq_vcard), typ='get', ns=NS_VCARD)
+        self.jabber.RegisterHandler('iq', self.timed(self.xmpp_iq_command), typ='set', ns=NS_COMMANDS)
+        self.jabber.RegisterHandler('iq', self.timed(self.xmpp_iq_si), typ='set', ns=NS_SI)
+        self.jabber.RegisterHandler('iq', self.timed(self.xmpp_iq_ibb), typ='set', ns=NS_IBB)
 
         self.disco = Browser()
         self.disco.PlugIn(self.jabber)
         self.disco.setDiscoHandler(self.xmpp_base_disco, node='', jid=config.jid)
         self.disco.setDiscoHandler(self.xmpp_base_disco, node='', jid='')
 
+    def timed(self, handler):
+        """Wrap a stanza handler to record the stanzas it handles and their latency in the statistics."""
+        def timed_handler(con, event):
+            start = time.monotonic()
+            try:
+                handler(con, event)
+            finally:
+                fromstripped = event.getFrom().getStripped() if event.getFrom() is not None else None
+                jh_stats.stats.observe('xmpp_' + event.getName(), time.monotonic() - start,
+                                       fromstripped if fromstripped in self.userlist else None)
+        return timed_handler
+
     # Disco Handlers
     def xmpp_base_disco(self, con, event, ev_type):
         fromstripped = event.getFrom().getStripped()
@@ -96,6 +195,16 @@ class Transport:
                         {'name': config.discoName + ' group chats', 'jid': 'conf@%s' % (config.jid,)},
                     ]
                     return alist
+            elif node == NODE_COMMANDS:
+                if ev_type == 'items':
+                    # List the commands of the transport: only its administrators can run them.
+                    alist = []
+                    if fromstripped in config.admins:
+                        for command_node in sorted(self.admin_commands):
+                            alist.append({'jid': config.jid,
+                                          'node': command_node,
+                                          'name': self.admin_commands[command_node][0]})
+                    return alist
             elif node == NODE_ROSTER:
                 if ev_type == 'info':
                     return {'ids': [], 'features': []}
@@ -105,10 +214,10 @@ class Transport:
                     if fromstripped in self.userlist:
                         for user in self.userlist[fromstripped]['user_list']:
                             alist.append({'jid': '%s@%s' % (user, config.jid),
-                                          'name': self.userlist[fromstripped]['user_list'][user]['full_name']})
+                                          'name': self.userlist[fromstripped]['user_list'][user].full_name})
                     return alist
             else:
-                self.jabber.send(Error(event, xmpp.protocol.ERRS['ERR_ITEM_NOT_FOUND']))
+                self.send(Error(event, xmpp.protocol.ERRS['ERR_ITEM_NOT_FOUND']))
                 raise NodeProcessed
 
         elif to.getDomain() == config.jid:
@@ -138,10 +247,10 @@ class Transport:
                     # JID of a contact.
                     if ev_type == 'info':
                         # Contact exists, declare it as being chatable and also declare that it has a VCard.
-                        features = [NS_VCARD, NS_VERSION, NS_CHATSTATES]
+                        features = [NS_VCARD, NS_VERSION, NS_CHATSTATES, NS_SI, NS_FILE, NS_IBB]
                         return {'ids': [{'category': 'client',
                                          'type': 'hangouts',
-                                         'name': self.userlist[fromstripped]['user_list'][gaia_id]['full_name']}],
+                                         'name': self.userlist[fromstripped]['user_list'][gaia_id].full_name}],
                                 'features': features}
                     elif ev_type == 'items':
                         # Contact nodes don't have children.
@@ -156,10 +265,10 @@ class Transport:
                             result = {'ids': [{'category': 'conference',
                                                'type': 'text',
                                                'name': gaia_id}],
-                                      'features': [NS_MUC, NS_VCARD, NS_COMMANDS]}
+                                      'features': [NS_MUC, NS_VCARD, NS_COMMANDS, NS_SI, NS_FILE, NS_IBB]}
                             data = {'muc#roominfo_description': conv['topic'],
                                     'muc#roominfo_subject': conv['topic'],
-                                    'muc#roominfo_occupants': len(conv['user_list']),
+                                    'muc#roominfo_occupants': len(conv['members']),
                                     'muc#roomconfig_changesubject': 1}
                             info = DataForm(typ='result', data=data)
                             field = info.setField('FORM_TYPE')
@@ -171,9 +280,10 @@ class Transport:
                             # List the participants of the conversation.
                             alist = []
                             conv = self.userlist[fromstripped]['conv_list'][gaia_id]
-                            for user in conv['user_list']:
+                            nicknames = self.userlist[fromstripped]['nicknames']
+                            for user in conv['members']:
                                 alist.append({'jid': '%s@%s' % (user, config.jid),
-                                              'name': conv['user_list'][user]})
+                                              'name': nicknames[user]})
                             return alist
 
                     #
@@ -214,7 +324,7 @@ class Transport:
 
                             m = event.buildReply('result')
                             m.setQueryPayload(reply_payload)
-                            self.jabber.send(m)
+                            self.send(m)
                     elif node == NODE_REMOVE_ALIAS:
                         if ev_type == 'info':
                             reply_payload = [Node('identify', {'name': 'Remove alias',
@@ -225,17 +335,17 @@ class Transport:
 
                             m = event.buildReply('result')
                             m.setQueryPayload(reply_payload)
-                            self.jabber.send(m)
+                            self.send(m)
 
                     else:
-                        self.jabber.send(Error(event, xmpp.protocol.ERRS['ERR_ITEM_NOT_FOUND']))
+                        self.send(Error(event, xmpp.protocol.ERRS['ERR_ITEM_NOT_FOUND']))
                         raise NodeProcessed
                 else:
                     # User/Conversation does not exist.
-                    self.jabber.send(Error(event, xmpp.protocol.ERRS['ERR_NOT_ACCEPTABLE']))
+                    self.send(Error(event, xmpp.protocol.ERRS['ERR_NOT_ACCEPTABLE']))
 
         else:
-            self.jabber.send(Error(event, xmpp.protocol.ERRS['MALFORMED_JID']))
+            self.send(Error(event, xmpp.protocol.ERRS['MALFORMED_JID']))
             raise NodeProcessed
 
     # XMPP Handlers
@@ -269,18 +379,19 @@ class Transport:
                                                                      'sender_jid': fromjid})
 
                             # According to the protocol, the self-user should the last to be sent.
+                            nicknames = self.userlist[fromstripped]['nicknames']
                             self_user = None
-                            for user in conv['user_list']:
+                            for user in conv['members']:
                                 if user == conv['self_id']:
                                     self_user = user
                                 else:
                                     # User is not self, send presence
-                                    p = Presence(frm='%s@%s/%s' % (conv_id, config.jid, conv['user_list'][user]),
+                                    p = Presence(frm='%s@%s/%s' % (conv_id, config.jid, nicknames[user]),
                                                  to=event.getFrom(),
                                                  payload=[MucUser(role='participant',
                                                                   affiliation='member',
                                                                   jid='%s@%s' % (user, config.jid))])
-                                    self.jabber.send(p)
+                                    self.send(p)
 
                             if self_user is not None:
                                 # Send self user presence
@@ -291,10 +402,10 @@ class Transport:
                                 # Code 210 means that we renamed the self user.
                                 muc_user.addChild('status', {'code': 110})
                                 muc_user.addChild('status', {'code': 210})
-                                p = Presence(frm='%s@%s/%s' % (conv_id, config.jid, conv['user_list'][self_user]),
+                                p = Presence(frm='%s@%s/%s' % (conv_id, config.jid, nicknames[self_user]),
                                              to=event.getFrom(),
                                              payload=[muc_user])
-                                self.jabber.send(p)
+                                self.send(p)
 
                     elif event.getType() == 'unavailable':
                         # Resource left the conversation:
@@ -302,7 +413,7 @@ class Transport:
                         if event.getFrom() in conv['connected_jids']:
                             del conv['connected_jids'][event.getFrom()]
                     else:
-                        self.jabber.send(Error(event, xmpp.protocol.ERRS['ERR_FEATURE_NOT_IMPLEMENTED']))
+                        self.send(Error(event, xmpp.protocol.ERRS['ERR_FEATURE_NOT_IMPLEMENTED']))
 
                 else:
                     # Message is about the transport.
@@ -311,35 +422,41 @@ class Transport:
                             if event.getTo() == config.jid and not self.userfile[fromstripped]['subscribed']:
                                 conf = self.userfile[fromstripped]
                                 conf['subscribed'] = True
+                                # The roster of the user is new: none of the contacts are in it yet.
+                                conf['roster'] = {}
                                 self.userfile[fromstripped] = conf
                                 self.userfile.sync()
 
                                 # User has subscribed to the transport: send the list of contacts:
-                                for user in self.userlist[fromstripped]['user_list']:
-                                    self.jabber.send(Presence(frm='%s@%s' % (user, config.jid),
-                                                              to=fromjid,
-                                                              typ='subscribe'))
+                                self.provision_roster(fromstripped)
 
                                 m = Presence(to=fromjid, frm=config.jid)
-                                self.jabber.send(m)
+                                self.send(m)
                         else:
-                            self.jabber.send(Error(event, xmpp.protocol.ERRS['ERR_NOT_ACCEPTABLE']))
+                            self.send(Error(event, xmpp.protocol.ERRS['ERR_NOT_ACCEPTABLE']))
 
                     elif event.getType() == 'subscribe':
                         if fromstripped in self.userlist:
                             if event.getTo() == config.jid:
                                 # Resource subscribed to the transport: send reply.
                                 m = Presence(to=fromjid, frm=config.jid, typ='subscribed')
-                                self.jabber.send(m)
+                                self.send(m)
+                            elif event.getTo().getNode() in self.userlist[fromstripped]['user_list']:
+                                # Resource subscribed to a Hangouts contact, after a roster item exchange.
+                                self.send(Presence(frm=event.getTo(), to=fromjid, typ='subscribed'))
                             else:
                                 # User tries to add a new contact.
                                 # This is currently unsupported.
                                 # See: XEP-0100: Gateway Interaction -> 5. Legacy User Use Cases -> 5.1 Add Contact
                                 # -> 5.1.2 Alternate Flows -> Example 49. Jabber User Denies Subscription Request:
                                 # http://www.xmpp.org/extensions/xep-0100.html#usecases-legacy-add-alt
-                                self.jabber.send(Presence(frm=event.getTo(), to=event.getFrom(), typ='unsubscribed'))
+                                self.send(Presence(frm=event.getTo(), to=event.getFrom(), typ='unsubscribed'))
                         else:
-                            self.jabber.send(Error(event, xmpp.protocol.ERRS['ERR_NOT_ACCEPTABLE']))
+                            self.send(Error(event, xmpp.protocol.ERRS['ERR_NOT_ACCEPTABLE']))
+
+                    elif event.getType() == 'probe':
+                        # The server asks for the presence of the transport or of a contact.
+                        self.xmpp_presence_probe(event, fromstripped)
 
                     elif event.getType() == 'unsubscribed':
                         # should do something more elegant here
@@ -364,27 +481,30 @@ class Transport:
                                 # Remove from the main list
                                 if fromjid in self.userlist[fromstripped]['connected_jids']:
                                     del self.userlist[fromstripped]['connected_jids'][fromjid]
+                                    self.forget_presences(fromjid)
+                                    self.discoresults.pop(str(fromjid), None)
                                     if len(self.userlist[fromstripped]['connected_jids']) == 0:
                                         # Removed resource was the last one:
                                         # disconnect Hangout and delete the associated thread.
                                         jh_hangups.hangups_manager.send_message(fromstripped, {'what': 'disconnect'})
                                         hobj = self.userlist[fromstripped]
                                         del self.userlist[fromstripped]
+                                        self.forget_presences(fromstripped)
                                         del hobj
                             else:
-                                self.jabber.send(Presence(to=fromjid, frm=config.jid, typ='unavailable'))
+                                self.send(Presence(to=fromjid, frm=config.jid, typ='unavailable'))
 
         else:
             # Need to add auto-unsubscribe on probe events here.
             if event.getType() == 'probe':
-                self.jabber.send(Presence(to=event.getFrom(), frm=event.getTo(), typ='unsubscribe'))
-                self.jabber.send(Presence(to=event.getFrom(), frm=event.getTo(), typ='unsubscribed'))
+                self.send(Presence(to=event.getFrom(), frm=event.getTo(), typ='unsubscribe'))
+                self.send(Presence(to=event.getFrom(), frm=event.getTo(), typ='unsubscribed'))
             elif event.getType() == 'unsubscribed':
                 pass
             elif event.getType() == 'unsubscribe':
-                self.jabber.send(Presence(frm=event.getTo(), to=event.getFrom(), typ='unsubscribed'))
+                self.send(Presence(frm=event.getTo(), to=event.getFrom(), typ='unsubscribed'))
             else:
-                self.jabber.send(Error(event, xmpp.protocol.ERRS['ERR_REGISTRATION_REQUIRED']))
+                self.send(Error(event, xmpp.protocol.ERRS['ERR_REGISTRATION_REQUIRED']))
 
     @staticmethod
     def get_refresh_token_filename(jid):
@@ -402,20 +522,30 @@ class Transport:
         if fromstripped in self.userlist:
             # Another resource is already connected:
             # add the new resource to the list.
-            self.userlist[fromstripped]['connected_jids'][fromjid] = True
+            batch = None
+            if fromjid not in self.userlist[fromstripped]['connected_jids']:
+                # The resource does not know any presence yet: send them all at once.
+                self.userlist[fromstripped]['connected_jids'][fromjid] = True
+                self.query_features(fromjid)
+                self.forget_presences(fromjid)
+                batch = []
             # Send presence information of connected contacts.
-            for user in self.userlist[fromstripped]['user_list']:
+            for user in self.userlist[fromstripped]['user_list'].values():
                 self.send_presence_from_status(fromjid,
-                                               '%s@%s' % (user, config.jid),
-                                               self.userlist[fromstripped]['user_list'][user]['status'])
+                                               '%s@%s' % (user.gaia_id, config.jid),
+                                               user.status,
+                                               user.status_message,
+                                               batch=batch)
+            if batch:
+                self.send_batch(batch)
         else:
             # No other resource of this user are already connected:
             # check that the user is registered and create a hangout client thread.
             if fromstripped not in self.userfile:
-                self.jabber.send(Message(to=fromstripped,
-                                         subject='Transport Configuration Error',
-                                         body='The transport has found that your configuration could'
-                                              ' not be loaded. Please re-register with the transport'))
+                self.send(Message(to=fromstripped,
+                                  subject='Transport Configuration Error',
+                                  body='The transport has found that your configuration could'
+                                       ' not be loaded. Please re-register with the transport'))
                 del self.userfile[fromstripped]
                 self.userfile.sync()
                 return
@@ -425,28 +555,103 @@ class Transport:
                 self.userfile[fromstripped]['oauth_code'] if 'oauth_code' in self.userfile[fromstripped] else ''
 
             # Spawn a new Hangout client and initialize a new userlist entry.
-            try:
-                jh_hangups.hangups_manager.spawn_thread(fromstripped,
-                                                        xmpp_queue,
-                                                        refresh_token_filename,
-                                                        oauth_code=oauth_code)
-                hobj = {'user_list': {},
-                        'conv_list': {},
-                        'connected_jids': {fromjid: True}}
-                self.userlist[fromstripped] = hobj
-
-                # Send presence transport information.
-                self.jabber.send(Presence(frm=config.jid, to=fromjid))
-
-            except jh_hangups.HangupAuthError as e:
-                # Auth failed: warn the user.
-                error_node = Node('error', {'type': 'auth'})
-                error_node.addChild('not-authorized', namespace=NS_XMPP_STANZAS)
-
-                p = Presence(frm=config.jid, to=fromjid, typ='error', payload=[error_node])
-                m = Message(typ='error', frm=config.jid, to=fromjid, body='{}'.format(e), payload=[error_node])
-                self.jabber.send(p)
-                self.jabber.send(m)
+            # The client authenticates in its own thread, and reports back with either 'connected' or 'auth_failed'.
+            jh_hangups.hangups_manager.spawn_thread(fromstripped,
+                                                    xmpp_queue,
+                                                    refresh_token_filename,
+                                                    oauth_code=oauth_code)
+            hobj = {'user_list': {},
+                    'conv_list': {},
+                    'nicknames': {},  # {gaia_id: nickname} of the members of the conversations.
+                    'connected_jids': {fromjid: True},
+                    'connected_at': None,  # Time the session last connected.
+                    'respawns': 0}  # Consecutive times the session was started again.
+            self.userlist[fromstripped] = hobj
+            self.query_features(fromjid)
+
+    def query_features(self, jid):
+        """Ask a resource which features it supports. The answer is handled by xmpp_iq_discoinfo_results."""
+        self.send(Iq(typ='get', queryNS=NS_DISCO_INFO, to=jid, frm=config.jid))
+
+    def provision_roster(self, fromjid):
+        """Update the Hangouts contacts in the roster of the user.
+
+        The contacts already provisioned, with their nickname, are recorded in the 'roster' entry of the user file:
+        only the contacts added, removed or renamed since then are sent. If a resource supports roster item exchange
+        (XEP-0144), they are sent in a single message. Otherwise each contact asks for a subscription, or cancels it."""
+        hobj = self.userlist[fromjid]
+        provisioned = self.userfile[fromjid].get('roster', {})
+        contacts = {user.gaia_id: user.full_name for user in hobj['user_list'].values()}
+
+        changes = []  # [(action, gaia_id, nickname)]
+        for gaia_id, nickname in contacts.items():
+            if gaia_id not in provisioned:
+                changes.append(('add', gaia_id, nickname))
+            elif provisioned[gaia_id] != nickname:
+                changes.append(('modify', gaia_id, nickname))
+        for gaia_id, nickname in provisioned.items():
+            if gaia_id not in contacts:
+                changes.append(('delete', gaia_id, nickname))
+        if not changes or not self.connected:
+            # While disconnected, the roster is provisioned again by replay_sessions once reconnected.
+            return
+
+        for ajid in hobj['connected_jids']:
+            if NS_ROSTERX in self.discoresults.get(str(ajid), ()):
+                x = Node('x')
+                x.setNamespace(NS_ROSTERX)
+                for action, gaia_id, nickname in changes:
+                    x.addChild('item', {'action': action,
+                                        'jid': '%s@%s' % (gaia_id, config.jid),
+                                        'name': nickname})
+                self.send(Message(frm=config.jid, to=ajid, payload=[x]))
+                break
+        else:
+            for action, gaia_id, nickname in changes:
+                contact_jid = '%s@%s' % (gaia_id, config.jid)
+                if action == 'delete':
+                    self.send(Presence(frm=contact_jid, to=fromjid, typ='unsubscribe'))
+                    self.send(Presence(frm=contact_jid, to=fromjid, typ='unsubscribed'))
+                else:
+                    p = Presence(frm=contact_jid,
+                                 to=fromjid,
+                                 typ='subscribe',
+                                 status='Hangouts contact')
+                    p.addChild(node=Node(NODE_VCARDUPDATE, payload=[Node('nickname', payload=nickname)]))
+                    self.send(p)
+
+        if not self.connected:
+            # The connection was lost while sending: the changes are sent again once reconnected.
+            return
+        conf = self.userfile[fromjid]
+        conf['roster'] = contacts
+        self.userfile[fromjid] = conf
+        self.userfile.sync()
+
+    def xmpp_presence_probe(self, event, fromstripped):
+        """Answer a presence probe from what the transport knows, without asking Hangouts. Probes from the same JID
+        for the same contact are answered once per PROBE_COALESCE_SECS: each resource probing gets its answer."""
+        contact_jid = event.getTo().getStripped()
+        key = (str(event.getFrom()), contact_jid)
+        answered = self.probe_answers.setdefault(fromstripped, {})
+        now = time.time()
+        if answered.get(key, 0) + PROBE_COALESCE_SECS > now:
+            return
+        answered[key] = now
+
+        p = Presence(frm=contact_jid, to=event.getFrom(), typ='unavailable')
+        if fromstripped in self.userlist:
+            if contact_jid == config.jid:
+                # The session of the user is running.
+                p = Presence(frm=config.jid, to=event.getFrom())
+            else:
+                user = self.userlist[fromstripped]['user_list'].get(event.getTo().getNode())
+                if user is not None and user.status != 'offline':
+                    p = Presence(frm=contact_jid,
+                                 to=event.getFrom(),
+                                 show='xa' if user.status == 'away' else None,
+                                 status=user.status_message or None)
+        self.send(p)
 
     def xmpp_presence_do_update(self, event, fromstripped):
         jh_hangups.hangups_manager.send_message(fromstripped, {'what': 'set_presence',
@@ -509,7 +714,7 @@ class Transport:
                                                                                        'message': event.getBody()})
                             else:
                                 # Unknown type
-                                self.jabber.send(Error(event, xmpp.protocol.ERRS['ERR_BAD_REQUEST']))
+                                self.send(Error(event, xmpp.protocol.ERRS['ERR_BAD_REQUEST']))
                     else:
                         # User or conversation was not found: reply with an error message.
                         error_node = Node('error', {'type': 'cancel', 'code': 503})
@@ -518,17 +723,168 @@ class Transport:
                                     frm='%s@%s' % (gaia_id, config.jid),
                                     to=from_jid,
                                     body='User/Conversation does not exist.', payload=[error_node])
-                        self.jabber.send(m)
+                        self.send(m)
             else:
                 # A message was received from someone who was not registered
-                self.jabber.send(Error(event, xmpp.protocol.ERRS['ERR_REGISTRATION_REQUIRED']))
+                self.send(Error(event, xmpp.protocol.ERRS['ERR_REGISTRATION_REQUIRED']))
         else:
-            self.jabber.send(Error(event, xmpp.protocol.ERRS['ERR_BAD_REQUEST']))
+            self.send(Error(event, xmpp.protocol.ERRS['ERR_BAD_REQUEST']))
 
     def xmpp_iq_discoinfo_results(self, con, event):
-        self.discoresults[event.getFrom().getStripped().encode('utf8')] = event
+        # Remember the features of the resource, to know which extensions it supports.
+        features = set()
+        if event.getType() == 'result':
+            for node in event.getQueryChildren() or []:
+                if node.getName() == 'feature':
+                    features.add(node.getAttr('var'))
+        self.discoresults[str(event.getFrom())] = features
         raise NodeProcessed
 
+    def get_file_transfer_target(self, to, fromstripped):
+        """Return the conversation a file sent to the JID to should be posted in, in the format of the chat messages
+        sent to the Hangouts thread, or None."""
+        if fromstripped not in self.userlist or to.getDomain() != config.jid:
+            return None
+        if to.getNode() in self.userlist[fromstripped]['user_list']:
+            return {'type': 'one_to_one', 'gaia_id': to.getNode()}
+        if to.getNode() in self.userlist[fromstripped]['conv_list']:
+            return {'type': 'group', 'conv_id': self.conv_alias_to_gaia_id(to.getNode(), fromstripped)}
+        return None
+
+    def xmpp_iq_si(self, con, event):
+        """A user offers a file to a contact or a conversation (XEP-0096): accept it over in-band bytestreams, whose
+        chunks are uploaded to Hangouts as they arrive."""
+        fromjid = event.getFrom()
+        si = event.getTag('si', namespace=NS_SI)
+        file_node = si.getTag('file', namespace=NS_FILE)
+        target = self.get_file_transfer_target(event.getTo(), fromjid.getStripped())
+        if target is None or si.getAttr('profile') != NS_FILE or file_node is None or not si.getAttr('id'):
+            self.send(Error(event, xmpp.protocol.ERRS['ERR_BAD_REQUEST']))
+            raise NodeProcessed
+        try:
+            size = int(file_node.getAttr('size'))
+        except (TypeError, ValueError):
+            self.send(Error(event, xmpp.protocol.ERRS['ERR_BAD_REQUEST']))
+            raise NodeProcessed
+        if size <= 0 or size > int(config.fileTransferMaxSize):
+            self.send(Error(event, xmpp.protocol.ERRS['ERR_NOT_ACCEPTABLE']))
+            raise NodeProcessed
+
+        methods = []
+        form = si.getTag('feature', namespace=NS_FEATURE)
+        if form is not None and form.getTag('x', namespace=NS_DATA) is not None:
+            field = DataForm(node=form.getTag('x', namespace=NS_DATA)).getField('stream-method')
+            if field is not None:
+                methods = [value for label, value in field.getOptions()]
+        if NS_IBB not in methods:
+            # Only in-band bytestreams let the transport slow the sender down to the pace of the upload.
+            error = Error(event, xmpp.protocol.ERRS['ERR_BAD_REQUEST'])
+            error.getTag('error').addChild('no-valid-streams', namespace=NS_SI)
+            self.send(error)
+            raise NodeProcessed
+
+        transfer_id = '%s %s' % (fromjid, si.getAttr('id'))
+        self.file_transfers[transfer_id] = {'target': target,
+                                            'jid': fromjid,
+                                            'contact': event.getTo().getStripped(),
+                                            'sid': si.getAttr('id'),
+                                            'filename': file_node.getAttr('name') or 'image',
+                                            'size': size,
+                                            'received': 0,
+                                            'seq': 0,
+                                            'opened': False,
+                                            'acks': collections.deque(),
+                                            'active': time.monotonic()}
+        reply = event.buildReply('result')
+        form = DataForm(typ='submit')
+        form.setField('stream-method').setValue(NS_IBB)
+        reply.addChild('si', namespace=NS_SI).addChild('feature', namespace=NS_FEATURE).addChild(node=form)
+        self.send(reply)
+        raise NodeProcessed
+
+    def xmpp_iq_ibb(self, con, event):
+        """Receive the data of a file transfer (XEP-0047). Each chunk is acknowledged once the Hangouts thread has
+        uploaded it, so that at most FILE_TRANSFER_WINDOW chunks are held in memory."""
+        fromjid = event.getFrom()
+        fromstripped = fromjid.getStripped()
+        node = event.getTag('open', namespace=NS_IBB) or event.getTag('data', namespace=NS_IBB) \
+            or event.getTag('close', namespace=NS_IBB)
+        transfer_id = '%s %s' % (fromjid, node.getAttr('sid'))
+        transfer = self.file_transfers.get(transfer_id)
+        if transfer is None:
+            self.send(Error(event, xmpp.protocol.ERRS['ERR_ITEM_NOT_FOUND']))
+            raise NodeProcessed
+
+        transfer['active'] = time.monotonic()
+        if node.getName() == 'open':
+            if transfer['opened'] or node.getAttr('stanza') not in (None, 'iq'):
+                # Data sent in messages is not acknowledged: nothing would keep it from piling up.
+                self.send(Error(event, xmpp.protocol.ERRS['ERR_FEATURE_NOT_IMPLEMENTED']))
+                del self.file_transfers[transfer_id]
+                raise NodeProcessed
+            transfer['opened'] = True
+            self.send(event.buildReply('result'))
+            message = dict(transfer['target'])
+            message.update({'what': 'file_transfer_start',
+                            'transfer_id': transfer_id,
+                            'filename': transfer['filename'],
+                            'size': transfer['size'],
+                            'sender_jid': fromjid})
+            jh_hangups.hangups_manager.send_message(fromstripped, message)
+        elif node.getName() == 'data':
+            try:
+                seq = int(node.getAttr('seq'))
+                data = base64.b64decode(node.getData())
+            except (TypeError, ValueError, binascii.Error):
+                seq, data = None, b''
+            if (not transfer['opened'] or seq != transfer['seq'] or not data
+                    or transfer['received'] + len(data) > transfer['size']
+                    or len(transfer['acks']) >= FILE_TRANSFER_WINDOW):
+                self.send(Error(event, xmpp.protocol.ERRS['ERR_UNEXPECTED_REQUEST']))
+                self.abort_file_transfer(transfer_id)
+                raise NodeProcessed
+            transfer['seq'] = (seq + 1) % 65536
+            transfer['received'] += len(data)
+            transfer['acks'].append(event)
+            jh_hangups.hangups_manager.send_message(fromstripped, {'what': 'file_transfer_data',
+                                                                   'transfer_id': transfer_id,
+                                                                   'data': data})
+        else:
+            self.send(event.buildReply('result'))
+            if transfer['received'] == transfer['size']:
+                del self.file_transfers[transfer_id]
+                jh_hangups.hangups_manager.send_message(fromstripped, {'what': 'file_transfer_end',
+                                                                       'transfer_id': transfer_id})
+            else:
+                self.abort_file_transfer(transfer_id)
+        raise NodeProcessed
+
+    def expire_file_transfers(self):
+        """Abort the file transfers idle for more than FILE_TRANSFER_IDLE_SECS: the sender stopped sending, or the
+        Hangouts session stopped acknowledging the chunks. Called regularly by the main loop."""
+        now = time.monotonic()
+        if now < self.next_file_transfer_check:
+            return
+        self.next_file_transfer_check = now + FILE_TRANSFER_IDLE_SECS / 10
+        for transfer_id, transfer in list(self.file_transfers.items()):
+            if now - transfer['active'] > FILE_TRANSFER_IDLE_SECS:
+                logger.info("Aborting the idle file transfer %s.", transfer_id)
+                self.abort_file_transfer(transfer_id)
+
+    def abort_file_transfer(self, transfer_id, notify_hangups=True):
+        """Stop receiving a file: refuse the chunks not acknowledged yet and close the bytestream."""
+        transfer = self.file_transfers.pop(transfer_id, None)
+        if transfer is None:
+            return
+        for event in transfer['acks']:
+            self.send(Error(event, xmpp.protocol.ERRS['ERR_NOT_ACCEPTABLE']))
+        if transfer['opened']:
+            self.send(Iq(typ='set', to=transfer['jid'], frm=transfer['contact'],
+                         payload=[Node('close', {'xmlns': NS_IBB, 'sid': transfer['sid']})]))
+            if notify_hangups:
+                jh_hangups.hangups_manager.send_message(transfer['jid'].getStripped(),
+                                                        {'what': 'file_transfer_abort', 'transfer_id': transfer_id})
+
     def xmpp_iq_vcard(self, con, event):
         fromjid = event.getFrom()
         fromstripped = fromjid.getStripped()
@@ -540,7 +896,7 @@ class Transport:
                 v = m.addChild(name='vCard', namespace=NS_VCARD)
                 v.setTagData(tag='FN', val='Hangouts Transport')
                 v.setTagData(tag='NICKNAME', val='Hangouts Transport')
-                self.jabber.send(m)
+                self.send(m)
 
             elif event.getTo().getDomain() == config.jid:
                 gaia_id = event.getTo().getNode()
@@ -554,51 +910,60 @@ class Transport:
                         v = m.addChild(name='vCard', namespace=NS_VCARD)
                         v.setTagData(tag='FN', val=conv['topic'])
                         v.setTagData(tag='NICKNAME', val=conv['topic'])
-                        self.jabber.send(m)
+                        self.send(m)
 
                     elif gaia_id in self.userlist[fromstripped]['user_list']:
                         # JID of a regular chat user
-                        nick = self.userlist[fromstripped]['user_list'][gaia_id]['full_name']
+                        user = self.userlist[fromstripped]['user_list'][gaia_id]
+
+                        # Rendering the card means downloading and encoding the photo: reuse it when possible.
+                        vcard = self.vcard_cache.get(user)
+                        if vcard is None:
+                            vcard = self.vcard_cache.put(user, self.build_contact_vcard(user))
 
                         m = Iq(to=event.getFrom(), frm=event.getTo(), typ='result')
                         m.setID(event.getID())
-                        v = m.addChild(name='vCard', namespace=NS_VCARD)
-                        v.setTagData(tag='FN', val=nick)
-                        v.setTagData(tag='NICKNAME', val=nick)
-
-                        # Try to add more information into the card.
-                        if self.userlist[fromstripped]['user_list'][gaia_id]['photo_url'] != '':
-                            p = v.addChild(name='PHOTO')
-                            p.setTagData(tag='TYPE', val='image/jpeg')
-                            photo = download_url(self.userlist[fromstripped]['user_list'][gaia_id]['photo_url'])
-                            p.setTagData(tag='BINVAL',
-                                         val=base64.b64encode(photo).decode())
-                        if len(self.userlist[fromstripped]['user_list'][gaia_id]['phones']) > 0:
-                            p = v.addChild(name='TEL')
-                            p.addChild(name='HOME')
-                            p.addChild(name='VOICE')
-                            p.addChild(name='NUMBER',
-                                       payload=self.userlist[fromstripped]['user_list'][gaia_id]['phones'][0])
-                        if len(self.userlist[fromstripped]['user_list'][gaia_id]['emails']) > 0:
-                            p = v.addChild(name='EMAIL')
-                            p.addChild(name='INTERNET')
-                            p.addChild(name='USERID',
-                                       payload=self.userlist[fromstripped]['user_list'][gaia_id]['emails'][0])
-
-                        self.jabber.send(m)
+                        m.addChild(node=SerializedNode('vCard', NS_VCARD, vcard))
+                        self.send(m)
 
                     else:
                         # User/Conversation was not found.
-                        self.jabber.send(Error(event, xmpp.protocol.ERRS['ERR_ITEM_NOT_FOUND']))
+                        self.send(Error(event, xmpp.protocol.ERRS['ERR_ITEM_NOT_FOUND']))
                         raise NodeProcessed
 
             else:
-                self.jabber.send(Error(event, xmpp.protocol.ERRS['ERR_ITEM_NOT_FOUND']))
+                self.send(Error(event, xmpp.protocol.ERRS['ERR_ITEM_NOT_FOUND']))
                 raise NodeProcessed
         else:
-            self.jabber.send(Error(event, xmpp.protocol.ERRS['ERR_ITEM_NOT_FOUND']))
+            self.send(Error(event, xmpp.protocol.ERRS['ERR_ITEM_NOT_FOUND']))
         raise NodeProcessed
 
+    @staticmethod
+    def build_contact_vcard(user):
+        """Render the vCard node of a contact."""
+        v = Node('vCard')
+        v.setNamespace(NS_VCARD)
+        v.setTagData(tag='FN', val=user.full_name)
+        v.setTagData(tag='NICKNAME', val=user.full_name)
+
+        # Try to add more information into the card.
+        if user.photo_url != '':
+            p = v.addChild(name='PHOTO')
+            p.setTagData(tag='TYPE', val='image/jpeg')
+            photo = download_url(user.photo_url)
+            p.setTagData(tag='BINVAL',
+                         val=base64.b64encode(photo).decode())
+        if len(user.phones) > 0:
+            p = v.addChild(name='TEL')
+            p.addChild(name='HOME')
+            p.addChild(name='VOICE')
+            p.addChild(name='NUMBER', payload=user.phones[0])
+        if len(user.emails) > 0:
+            p = v.addChild(name='EMAIL')
+            p.addChild(name='INTERNET')
+            p.addChild(name='USERID', payload=user.emails[0])
+        return v
+
     def xmpp_iq_register_get(self, con, event):
         if event.getTo() == config.jid:
             # See: XEP-0100: Gateway Interaction -> 4. Jabber User Use Cases -> 4.1 Register -> 4.1.1 Primary Flow:
@@ -621,9 +986,9 @@ class Transport:
             m = event.buildReply('result')
             m.setQueryNS(NS_REGISTER)
             m.setQueryPayload(query_payload)
-            self.jabber.send(m)
+            self.send(m)
         else:
-            self.jabber.send(Error(event, xmpp.protocol.ERRS['ERR_BAD_REQUEST']))
+            self.send(Error(event, xmpp.protocol.ERRS['ERR_BAD_REQUEST']))
         raise NodeProcessed
 
     def xmpp_iq_register_set(self, con, event):
@@ -656,7 +1021,7 @@ class Transport:
 
                 # Acknowledge event.
                 m = event.buildReply('result')
-                self.jabber.send(m)
+                self.send(m)
 
                 # If user is connected, disconnect them.
                 if fromstripped in self.userlist:
@@ -667,13 +1032,14 @@ class Transport:
 
                     # Remove the user from the user list.
                     del self.userlist[fromstripped]
+                    self.forget_presences(fromstripped)
 
                 # Handle new resources subscription.
                 self.xmpp_resource_join(fromjid)
 
                 # Subscribe to user's presence.
                 m = Presence(to=fromjid, frm=config.jid, typ='subscribe')
-                self.jabber.send(m)
+                self.send(m)
 
             elif remove:
                 # User unregisters from the gateway.
@@ -689,35 +1055,37 @@ class Transport:
 
                     # Remove the user from the user list.
                     del self.userlist[fromstripped]
+                    self.forget_presences(fromstripped)
 
                 # Remove the user from the account file.
                 if fromstripped in self.userfile:
                     del self.userfile[fromstripped]
                     self.userfile.sync()
 
-                # Delete the refresh token file.
+                # Delete the refresh token and session cookies files.
                 refresh_token_filename = self.get_refresh_token_filename(fromstripped)
-                try:
-                    os.remove(refresh_token_filename)
-                except OSError:
-                    pass
+                for filename in jh_hangups.get_session_filenames(refresh_token_filename):
+                    try:
+                        os.remove(filename)
+                    except OSError:
+                        pass
 
                 # Acknowledge event.
                 m = event.buildReply('result')
-                self.jabber.send(m)
+                self.send(m)
 
                 # Send presence information.
                 m = Presence(to=fromjid, frm=config.jid, typ='unsubscribe')
-                self.jabber.send(m)
+                self.send(m)
                 m = Presence(to=fromjid, frm=config.jid, typ='unsubscribed')
-                self.jabber.send(m)
+                self.send(m)
                 m = Presence(to=fromjid, frm=config.jid, typ='unavailable')
-                self.jabber.send(m)
+                self.send(m)
 
             else:
-                self.jabber.send(Error(event, xmpp.protocol.ERRS['ERR_BAD_REQUEST']))
+                self.send(Error(event, xmpp.protocol.ERRS['ERR_BAD_REQUEST']))
         else:
-            self.jabber.send(Error(event, xmpp.protocol.ERRS['ERR_BAD_REQUEST']))
+            self.send(Error(event, xmpp.protocol.ERRS['ERR_BAD_REQUEST']))
         raise NodeProcessed
 
     def xmpp_iq_command(self, con, event):
@@ -725,7 +1093,10 @@ class Transport:
         # See: XEP-0050: Ad-Hoc Commands -> 2. Use Cases -> 2.4 Executing Commands -> 2.4.2 Multiple Stages:
         # http://xmpp.org/extensions/xep-0050.html#execute-multiple
         #
-        if event.getTo().getDomain() == config.jid:
+        if event.getTo() == config.jid:
+            # Commands of the transport itself.
+            self.xmpp_admin_command(event)
+        elif event.getTo().getDomain() == config.jid:
             fromjid = event.getFrom()
             fromstripped = fromjid.getStripped()
             node = event.getQuerynode()
@@ -757,7 +1128,7 @@ class Transport:
                         session_id = 'set_conv_alias:%s' % (datetime.datetime.now().isoformat(),)
                         command.setAttr('session_id', session_id)
                         m.setQueryPayload([actions, form])
-                        self.jabber.send(m)
+                        self.send(m)
 
                     elif action == 'executing':
                         form = DataForm(node=event.getTag('command').getTag('x', namespace=NS_DATA))
@@ -787,7 +1158,7 @@ class Transport:
                             command.setAttr('status', 'completed')
                             command.setAttr('session_id', event.getQuery().getAttr('session'))
                             command.addChild('note', {'type': 'info'}, payload='Alias was added.')
-                            self.jabber.send(m)
+                            self.send(m)
                         else:
                             # Reply with an error.
                             m = event.buildReply('result')
@@ -796,7 +1167,7 @@ class Transport:
                             command.setAttr('status', 'completed')
                             command.setAttr('session_id', event.getQuery().getAttr('session'))
                             command.addChild('note', {'type': 'error'}, payload='Alias contains invalid characters.')
-                            self.jabber.send(m)
+                            self.send(m)
 
                     elif action == 'cancel':
                         m = event.buildReply('result')
@@ -804,7 +1175,7 @@ class Transport:
                         command.setAttr('node', NODE_SET_ALIAS)
                         command.setAttr('status', 'canceled')
                         command.setAttr('session_id', event.getQuery().getAttr('session'))
-                        self.jabber.send(m)
+                        self.send(m)
 
                 elif node == NODE_REMOVE_ALIAS:
                     if action is None:
@@ -841,7 +1212,7 @@ class Transport:
                         command.setAttr('status', 'completed')
                         command.setAttr('session_id', event.getQuery().getAttr('session'))
                         command.addChild('note', {'type': 'info'}, payload='Alias was removed.')
-                        self.jabber.send(m)
+                        self.send(m)
 
                     elif action == 'cancel':
                         m = event.buildReply('result')
@@ -849,17 +1220,238 @@ class Transport:
                         command.setAttr('node', NODE_SET_ALIAS)
                         command.setAttr('status', 'canceled')
                         command.setAttr('session_id', event.getQuery().getAttr('session'))
-                        self.jabber.send(m)
+                        self.send(m)
             else:
-                self.jabber.send(Error(event, xmpp.protocol.ERRS['ERR_BAD_REQUEST']))
+                self.send(Error(event, xmpp.protocol.ERRS['ERR_BAD_REQUEST']))
         else:
-            self.jabber.send(Error(event, xmpp.protocol.ERRS['ERR_BAD_REQUEST']))
+            self.send(Error(event, xmpp.protocol.ERRS['ERR_BAD_REQUEST']))
         raise NodeProcessed
 
+    def xmpp_admin_command(self, event):
+        """Execute a single-stage command of the transport JID. They are reserved to the JIDs listed in config.admins."""
+        if event.getFrom().getStripped() not in config.admins:
+            self.send(Error(event, xmpp.protocol.ERRS['ERR_FORBIDDEN']))
+            return
+        node = event.getQuerynode()
+        if node not in self.admin_commands:
+            self.send(Error(event, xmpp.protocol.ERRS['ERR_ITEM_NOT_FOUND']))
+            return
+
+        m = event.buildReply('result')
+        command = m.getTag('command')
+        command.setAttr('node', node)
+        command.setAttr('sessionid', '%s:%s' % (node, datetime.datetime.now().isoformat()))
+        if event.getQuery().getAttr('action') == 'cancel':
+            command.setAttr('status', 'canceled')
+        else:
+            command.setAttr('status', 'completed')
+            m.setQueryPayload([self.admin_commands[node][1](self, event)])
+        self.send(m)
+
+    def admin_stats(self, event):
+        """Return a form with the sessions, the depths of the queues, and the rate and latencies of each kind of
+        operation."""
+        login_stats = jh_hangups.hangups_manager.get_login_stats()
+        fields = [DataField('uptime', str(int(time.time() - jh_stats.stats.started)), label='Uptime (s)'),
+                  DataField('startup', jh_stats.startup.get_timeline(), label='Startup'),
+                  DataField('users', str(len(self.userlist)), label='Users online'),
+                  DataField('threads', str(len(jh_hangups.hangups_manager.hangouts_threads)), label='Hangouts threads'),
+                  DataField('logins_waiting', str(login_stats['waiting']), label='Logins waiting'),
+                  DataField('logging_in', str(login_stats['logging_in']), label='Logins in progress'),
+                  DataField('hangups_queue', str(xmpp_queue.qsize()), label='Messages from Hangouts waiting'),
+                  DataField('offline_queue', str(sum(len(stanzas) for stanzas in self.outbox.values())),
+                            label='Stanzas waiting for the server'),
+                  DataField('outbound_queue', str(jh_hangups.hangups_manager.count_unsent_messages()),
+                            label='Chat messages waiting to be sent to Hangouts')]
+        if isinstance(jh_hangups.hangups_manager, jh_shards.ShardedHangupsManager):
+            fields.append(DataField('workers', str(len(jh_hangups.hangups_manager.workers)), label='Hangouts workers'))
+        presence_stats = [hobj['presence_stats'] for hobj in list(self.userlist.values()) if 'presence_stats' in hobj]
+        fields.append(DataField('presence_changes',
+                                '%d forwarded, %d suppressed' % (sum(stats['forwarded'] for stats in presence_stats),
+                                                                 sum(stats['suppressed'] for stats in presence_stats)),
+                                label='Presence changes of the contacts of the running sessions'))
+        queue_stats = xmpp_queue.get_stats()
+        for name in jh_queue.PRIORITY_NAMES:
+            fields.append(DataField('hangups_queue_' + name,
+                                    '%(queued)d waiting, %(coalesced)d coalesced, %(shed)d shed' % queue_stats[name],
+                                    label='Messages from Hangouts (%s)' % (name,)))
+        for kind in jh_stats.stats.get_kinds():
+            p50, p99 = jh_stats.stats.get_percentiles(kind)
+            fields.append(DataField(kind, '%.2f/s, p50 %.1f ms, p99 %.1f ms'
+                                    % (jh_stats.stats.get_rate(kind), p50 * 1000, p99 * 1000), label=kind))
+        return DataForm(typ='result', data=fields, title='Statistics of the transport')
+
+    def admin_slowest_sessions(self, event):
+        """Return a form listing the sessions whose stanzas, messages and requests took the most time."""
+        fields = []
+        for fromjid, number, total, longest in jh_stats.stats.get_slowest_sessions(SLOWEST_SESSIONS):
+            fields.append(DataField(fromjid, '%.1f s in %d operations, %.1f ms at most'
+                                    % (total, number, longest * 1000), label=fromjid))
+        return DataForm(typ='result', data=fields, title='Slowest sessions')
+
+    def admin_queue_delays(self, event):
+        """Return a form listing the sessions whose messages from Hangouts waited the most before being handled."""
+        fields = []
+        for fromjid, number, p50, p99 in jh_stats.stats.get_delayed_sessions(SLOWEST_SESSIONS):
+            fields.append(DataField(fromjid, 'p50 %.1f ms, p99 %.1f ms over %d messages'
+                                    % (p50 * 1000, p99 * 1000, number), label=fromjid))
+        return DataForm(typ='result', data=fields, title='Queueing delays of the sessions')
+
+    def admin_profile(self, event):
+        """Profile the handling of the stanzas and Hangouts messages for PROFILE_CAPTURE_SECS seconds. The result
+        is sent to the admin by message."""
+        admin = event.getFrom()
+
+        def send_profile(filename, summary):
+            self.send(Message(to=admin, frm=config.jid, body='Profile written to %s.\n\n%s' % (filename, summary)))
+
+        if jh_stats.start_profile(PROFILE_CAPTURE_SECS, send_profile):
+            text = 'Profiling for %d seconds: the result will be sent by message.' % (PROFILE_CAPTURE_SECS,)
+        else:
+            text = 'A profile is already being captured.'
+        return Node('note', {'type': 'info'}, payload=[text])
+
+    def admin_evict_caches(self, event):
+        """Evict the cached events of every session and the rendered vCards."""
+        for fromjid in self.userlist:
+            jh_hangups.hangups_manager.send_message(fromjid, {'what': 'evict_caches'})
+        self.vcard_cache.clear()
+        return Node('note', {'type': 'info'}, payload=['Caches of %d sessions evicted.' % (len(self.userlist),)])
+
+    def admin_memory_usage(self, event):
+        """Return a form listing the estimated memory used by each session, largest first."""
+        rows = []
+        for fromjid, hobj in self.userlist.items():
+            hangups_size = hobj.get('memory', {}).get('hangups', 0)
+            transport_size = self.estimate_session_size(fromjid)
+            rows.append((hangups_size + transport_size, fromjid, hangups_size, transport_size))
+        rows.sort(reverse=True)
+
+        fields = [DataField('soft_quota', config.sessionMemorySoftQuota, label='Soft quota (bytes)'),
+                  DataField('hard_quota', config.sessionMemoryHardQuota, label='Hard quota (bytes)'),
+                  DataField('total', str(sum(row[0] for row in rows)), label='All sessions (bytes)')]
+        for total, fromjid, hangups_size, transport_size in rows:
+            fields.append(DataField(fromjid, '%d (Hangouts %d, transport %d)' % (total, hangups_size, transport_size),
+                                    label=fromjid))
+        return DataForm(typ='result', data=fields, title='Memory used by the sessions')
+
+    def admin_add_worker(self, event):
+        """Start a new Hangouts worker process, and move its share of the sessions to it."""
+        if not isinstance(jh_hangups.hangups_manager, jh_shards.ShardedHangupsManager):
+            text = 'The Hangouts sessions run in the transport process (hangoutsWorkers is 0).'
+        else:
+            text = 'Hangouts worker %d started.' % (jh_hangups.hangups_manager.add_worker(),)
+        return Node('note', {'type': 'info'}, payload=[text])
+
+    def admin_remove_worker(self, event):
+        """Move the sessions of the last Hangouts worker process to the others, then stop it."""
+        if not isinstance(jh_hangups.hangups_manager, jh_shards.ShardedHangupsManager):
+            text = 'The Hangouts sessions run in the transport process (hangoutsWorkers is 0).'
+        else:
+            index = jh_hangups.hangups_manager.remove_worker()
+            if index is None:
+                text = 'The last Hangouts worker cannot be removed.'
+            else:
+                text = 'Hangouts worker %d is stopping.' % (index,)
+        return Node('note', {'type': 'info'}, payload=[text])
+
+    # Commands of the transport JID, by node: (name, method returning the payload of the result).
+    admin_commands = {
+        NODE_STATS: ('Statistics', admin_stats),
+        NODE_SLOWEST_SESSIONS: ('Slowest sessions', admin_slowest_sessions),
+        NODE_QUEUE_DELAYS: ('Queueing delays of the sessions', admin_queue_delays),
+        NODE_MEMORY_USAGE: ('Memory usage of the sessions', admin_memory_usage),
+        NODE_PROFILE: ('Capture a profile', admin_profile),
+        NODE_EVICT_CACHES: ('Evict the caches', admin_evict_caches),
+        NODE_ADD_WORKER: ('Add a Hangouts worker', admin_add_worker),
+        NODE_REMOVE_WORKER: ('Remove a Hangouts worker', admin_remove_worker),
+    }
+
+    def estimate_session_size(self, fromjid):
+        """Return an estimate of the bytes retained by the transport for the session of a user."""
+        seen = set()
+        return sum(estimate_size(state, seen) for state in (self.userlist.get(fromjid),
+                                                            self.presence_cache.get(fromjid),
+                                                            self.probe_answers.get(fromjid),
+                                                            self.outbox.get(fromjid)))
+
+    def alert_admins(self, text):
+        """Log a problem, and tell the administrators of the transport about it."""
+        logger.warning(text)
+        for admin in config.admins:
+            self.send(Message(to=admin, frm=config.jid, body=text))
+
     def xmpp_disconnect(self):
-        # Transport was disconnected:
-        # stop and remove all the Hangouts threads,
-        # and try to reconnect.
+        """Transport was disconnected: keep the Hangouts threads running, buffering what they send, and reconnect,
+        waiting longer after each failed attempt. The sessions are replayed once the transport is connected again."""
+        self.connected = False
+        logger.warning("Transport disconnected from the server: reconnecting.")
+        handlers = self.jabber.Dispatcher.dumpHandlers()
+        delay = RECONNECT_DELAY_SECS
+        while self.online:
+            time.sleep(delay)
+            if self.xmpp_reconnect(handlers):
+                break
+            delay = min(delay * 2, RECONNECT_MAX_DELAY_SECS)
+            logger.warning("Could not reconnect to the server: retrying in %d s.", delay)
+        else:
+            return
+
+        xmpp_lock.acquire()
+        try:
+            self.connected = True
+            self.replay_sessions()
+        finally:
+            xmpp_lock.release()
+        logger.info("Transport reconnected to the server.")
+
+    def xmpp_reconnect(self, handlers):
+        """Try once to connect and authenticate to the server again, then restore the stanza handlers. Return True
+        on success."""
+        try:
+            connected = self.jabber.reconnectAndReauth()
+        except AttributeError:
+            # The previous attempt failed before the stream was opened: there is no stream to reset.
+            connected = (self.jabber.connect((config.mainServer, config.port))
+                         and self.jabber.auth(config.saslUsername, config.secret))
+        if not connected:
+            return False
+        self.jabber.Dispatcher.restoreHandlers(handlers)
+        return True
+
+    def replay_sessions(self):
+        """Send the state of the Hangouts sessions again after a reconnection, then the stanzas kept meanwhile. If the
+        connection is lost again meanwhile, the stanzas not sent are kept and the next reconnection replays the
+        sessions."""
+        for jid in list(self.userlist.keys()):
+            if not self.connected:
+                return
+
+            # Presence of the transport and of the contacts.
+            self.forget_presences(jid)
+            self.send(Presence(frm=config.jid, to=jid))
+            for user in self.userlist[jid]['user_list'].values():
+                self.send_presence_from_status(jid, '%s@%s' % (user.gaia_id, config.jid), user.status,
+                                               user.status_message)
+
+            # Messages received while disconnected.
+            for stanza in self.outbox.pop(jid, ()):
+                self.send(stanza)
+
+            # Contacts added, removed or renamed while disconnected.
+            if self.userlist[jid]['user_list']:
+                self.provision_roster(jid)
+
+            # The server may have lost the resources of the user: ask for them again.
+            self.send(Presence(frm=config.jid, to=jid, typ='probe'))
+
+        # Stanzas for users that left meanwhile are dropped.
+        for jid in set(self.outbox) - set(self.userlist):
+            del self.outbox[jid]
+
+    def shutdown(self):
+        # Transport is stopping:
+        # stop and remove all the Hangouts threads.
         for jid in list(self.userlist.keys()):
             # Send presence information.
             self.send_disconnected_presence_events(jid)
@@ -872,21 +1464,28 @@ class Transport:
             hobj = self.userlist[jid]
             del self.userlist[jid]
             del hobj
-        time.sleep(5)
-        if not self.jabber.reconnectAndReauth():
-            time.sleep(5)
-            self.xmpp_connect()
+            self.forget_presences(jid)
+
+    def drop_session(self, jid):
+        """Stop the Hangouts session of a user without telling its resources: another node of the cluster runs it."""
+        jh_hangups.hangups_manager.send_message(jid, {'what': 'disconnect'})
+        jh_hangups.hangups_manager.remove_thread(jid)
+        for transfer_id, transfer in list(self.file_transfers.items()):
+            if transfer['jid'].getStripped() == jid:
+                self.abort_file_transfer(transfer_id, notify_hangups=False)
+        del self.userlist[jid]
+        self.outbox.pop(jid, None)
+        self.forget_presences(jid)
+        jh_stats.stats.forget_session(jid)
 
     def send_disconnected_presence_events(self, jid):
         # Send presence information of the transport.
-        self.jabber.send(Presence(frm=config.jid, to=jid, typ="unavailable"))
+        self.send(Presence(frm=config.jid, to=jid, typ="unavailable"))
 
         # Send presence information of all users, to prevent from still showing as connected in the clients.
         if jid in self.userlist:
             for user in self.userlist[jid]['user_list']:
-                self.jabber.send(Presence(frm='%s@%s' % (user, config.jid),
-                                          to=jid,
-                                          typ="unavailable"))
+                self.send_presence(jid, '%s@%s' % (user, config.jid), typ='unavailable')
 
     def create_conv_alias_dict_if_not_exist(self, fromstripped):
         if 'conv_aliases' not in self.userfile[fromstripped]:
@@ -916,284 +1515,450 @@ class Transport:
 
         return gaia_id  # No alias found.
 
-    def send_presence(self, fromjid, jid, typ=None, show=None):
-        self.jabber.send(Presence(frm=jid, to=fromjid, typ=typ, show=show))
+    def send_presence(self, fromjid, jid, typ=None, show=None, status=None, batch=None):
+        """Send the presence of the contact jid to fromjid, unless fromjid already received it.
+        If batch is a list, the stanza is appended to it instead of being sent."""
+        presence = (typ, show, status)
+        fromstripped = JID(fromjid).getStripped()
+        sent = self.presence_cache.setdefault(fromstripped, {})
+        if sent.get(str(fromjid), {}).get(jid) == presence:
+            return
+        if str(fromjid) == fromstripped:
+            # Presence sent to the bare JID reaches every resource.
+            for destination in sent.values():
+                destination[jid] = presence
+        sent.setdefault(str(fromjid), {})[jid] = presence
+
+        p = Presence(frm=jid, to=fromjid, typ=typ, show=show, status=status)
+        if batch is not None:
+            batch.append(p)
+        else:
+            self.send(p)
 
-    def send_presence_from_status(self, fromjid, jid, status='online'):
+    def send_presence_from_status(self, fromjid, jid, status='online', status_message=None, batch=None):
+        # The mood message of the contact is its status.
+        status_message = status_message or None
         if status == 'away':
-            self.send_presence(fromjid, jid, show='xa')
+            self.send_presence(fromjid, jid, show='xa', status=status_message, batch=batch)
         elif status == 'online':
-            self.send_presence(fromjid, jid)
+            self.send_presence(fromjid, jid, status=status_message, batch=batch)
         elif status == 'offline':
-            self.send_presence(fromjid, jid, typ='unavailable')
+            self.send_presence(fromjid, jid, typ='unavailable', batch=batch)
+
+    def forget_presences(self, jid):
+        """Forget the presence information sent to a resource, or to every resource of a bare JID."""
+        jid = JID(jid)
+        if jid.getResource():
+            self.presence_cache.get(jid.getStripped(), {}).pop(str(jid), None)
+            answered = self.probe_answers.get(jid.getStripped(), {})
+            for key in [key for key in answered if key[0] == str(jid)]:
+                del answered[key]
+        else:
+            self.presence_cache.pop(jid.getStripped(), None)
+            self.probe_answers.pop(jid.getStripped(), None)
 
     def handle_message(self, message):
         # Handle a message from the hangout thread.
         logger.debug("Handling message from hangouts: %r", message)
 
-        fromjid = message['jid']
+        fromjid = message.jid
         if fromjid not in self.userlist:
             # Thread user is not in the list:
             # do not process the message.
             return
 
-        if message['what'] == 'connected':
-            # Hangouts is connected. Send presence information of the transport.
-            self.jabber.send(Presence(frm=config.jid, to=fromjid))
-
-            # If we're connected, this means that the oauth code was used. Remove it.
-            if 'oauth_code' in self.userfile[fromjid]:
-                conf = self.userfile[fromjid]
-                del conf['oauth_code']
-                self.userfile[fromjid] = conf
-                self.userfile.sync()
+        handler = self.hangups_handlers.get(type(message))
+        if handler is None:
+            jh_hangups.hangups_manager.send_message(message.jid, {'what': 'test'})
+            return
+        start = time.monotonic()
+        try:
+            handler(self, message, fromjid, self.userlist[fromjid])
+        finally:
+            jh_stats.stats.observe('hangups_message', time.monotonic() - start, fromjid)
+
+    def hangups_connected(self, message, fromjid, hobj):
+        """Hangouts is connected. Send presence information of the transport."""
+        jh_stats.startup.mark('first session online')
+        hobj['connected_at'] = time.monotonic()
+        self.send(Presence(frm=config.jid, to=fromjid))
+
+        # If we're connected, this means that the oauth code was used. Remove it.
+        if 'oauth_code' in self.userfile[fromjid]:
+            conf = self.userfile[fromjid]
+            del conf['oauth_code']
+            self.userfile[fromjid] = conf
+            self.userfile.sync()
 
-        elif message['what'] == 'disconnected':
-            # Hangouts is disconnected.
+    def hangups_disconnected(self, message, fromjid, hobj):
+        """Hangouts is disconnected."""
+        if message.final:
             self.send_disconnected_presence_events(fromjid)
+            jh_stats.stats.forget_session(fromjid)
+            # The uploads of the session stopped with it.
+            for transfer_id, transfer in list(self.file_transfers.items()):
+                if transfer['jid'].getStripped() == fromjid:
+                    self.abort_file_transfer(transfer_id, notify_hangups=False)
+        else:
+            # The thread is reconnecting: contacts keep their presence until it knows better.
+            self.send(Presence(frm=config.jid, to=fromjid, typ='unavailable'))
+
+        thread = jh_hangups.hangups_manager.get_thread(fromjid)
+        if (message.final and thread is not None and thread.finished and not thread.stop_requested
+                and len(hobj['connected_jids']) > 0):
+            # The thread gave up reconnecting while the user is still connected: start a new one, waiting longer
+            # each time so that a session failing at every start does not keep taking login slots.
+            if hobj['connected_at'] is not None and time.monotonic() - hobj['connected_at'] > RESPAWN_RESET_SECS:
+                hobj['respawns'] = 0
+            hobj['connected_at'] = None
+            if hobj['respawns'] >= RESPAWN_MAX_ATTEMPTS:
+                logger.warning("Session of %s stopped %d times in a row: waiting for a new presence.",
+                               fromjid, hobj['respawns'])
+                for ajid in hobj['connected_jids']:
+                    self.send(Message(typ='error', frm=config.jid, to=ajid,
+                                      body='The Hangouts session keeps stopping. Go offline and online again to '
+                                           'restart it.'))
+                jh_hangups.hangups_manager.remove_thread(fromjid)
+                del self.userlist[fromjid]
+                self.forget_presences(fromjid)
+                return
+            delay = RESPAWN_DELAY_SECS * 2 ** hobj['respawns']
+            hobj['respawns'] += 1
+            logger.info("Starting the session of %s again in %d s.", fromjid, delay)
+            timer = threading.Timer(delay, self.respawn_session, args=(fromjid, hobj, thread))
+            timer.daemon = True
+            timer.start()
+
+    def respawn_session(self, fromjid, hobj, thread):
+        """Start again a session that stopped on its own, unless the user went offline or started a new one
+        meanwhile."""
+        with xmpp_lock:
+            if (self.userlist.get(fromjid) is hobj and len(hobj['connected_jids']) > 0
+                    and jh_hangups.hangups_manager.get_thread(fromjid) is thread):
+                jh_hangups.hangups_manager.spawn_thread(fromjid,
+                                                        xmpp_queue,
+                                                        self.get_refresh_token_filename(fromjid),
+                                                        priority=jh_hangups.LOGIN_PRIORITY_BACKGROUND)
+
+    def hangups_login_queued(self, message, fromjid, hobj):
+        """The Hangouts thread is waiting for its turn to log in."""
+        self.send(Presence(frm=config.jid, to=fromjid, show='away',
+                           status='Waiting to log in to Hangouts (position %d in queue).'
+                                  % (message.position,)))
+
+    def hangups_auth_failed(self, message, fromjid, hobj):
+        """Auth failed: warn the user and forget the session."""
+        error_node = Node('error', {'type': 'auth'})
+        error_node.addChild('not-authorized', namespace=NS_XMPP_STANZAS)
+
+        for ajid in hobj['connected_jids']:
+            p = Presence(frm=config.jid, to=ajid, typ='error', payload=[error_node])
+            m = Message(typ='error', frm=config.jid, to=ajid, body=message.reason, payload=[error_node])
+            self.send(p)
+            self.send(m)
+
+        jh_hangups.hangups_manager.remove_thread(fromjid)
+        del self.userlist[fromjid]
+        self.forget_presences(fromjid)
+
+    def hangups_user_list(self, message, fromjid, hobj):
+        """Receive the list of contacts: store it and send presence information."""
+        user_list = {sys.intern(gaia_id): Contact.from_dict(user) for gaia_id, user in message.user_list.items()}
+        for gaia_id, user in hobj['user_list'].items():
+            if gaia_id not in user_list or VCardCache.get_key(user_list[gaia_id]) != VCardCache.get_key(user):
+                # The profile of the contact changed: its card has to be rendered again.
+                self.vcard_cache.discard(user)
+        hobj['user_list'] = user_list
+
+        self.provision_roster(fromjid)
+        for user in hobj['user_list'].values():
+            self.send_presence_from_status(fromjid, '%s@%s' % (user.gaia_id, config.jid), user.status,
+                                           user.status_message)
+
+    def hangups_conv_list(self, message, fromjid, hobj):
+        """Receive the list of conversations: store it and initialize the list of connected resources for each."""
+        hobj['conv_list'] = {}
+        hobj['nicknames'] = {}
+        for conv_id in message.conv_list:
+            aliased_conv_id = self.gaia_id_to_conv_alias(conv_id, fromjid)
+            message.conv_list[conv_id]['conv_id'] = aliased_conv_id
+            set_members(message.conv_list[conv_id], hobj['nicknames'])
+            hobj['conv_list'][aliased_conv_id] = message.conv_list[conv_id]
+
+        for conv_id in message.conv_list:
+            conv = message.conv_list[conv_id]
+            conv['connected_jids'] = {}
+            conv['invited_jids'] = {}
 
-        if message['what'] == 'user_list':
-            # Receive the list of contacts:
-            # Store it and send presence information.
-            hobj = self.userlist[fromjid]
-            hobj['user_list'] = message['user_list']
-
-            for user_id in message['user_list']:
-                user = message['user_list'][user_id]
-                p = Presence(frm='%s@%s' % (user['gaia_id'], config.jid),
-                             to=fromjid,
-                             typ='subscribe',
-                             status='Hangouts contact')
-                p.addChild(node=Node(NODE_VCARDUPDATE, payload=[Node('nickname', payload=user['full_name'])]))
-                self.jabber.send(p)
-                self.send_presence_from_status(fromjid, '%s@%s' % (user['gaia_id'], config.jid), user['status'])
-
-        elif message['what'] == 'conv_list':
-            # Receive the list of conversation:
-            # Store it and initialize the list of connected resources for each.
-            hobj = self.userlist[fromjid]
-            hobj['conv_list'] = {}
-            for conv_id in message['conv_list']:
-                aliased_conv_id = self.gaia_id_to_conv_alias(conv_id, fromjid)
-                message['conv_list'][conv_id]['conv_id'] = aliased_conv_id
-                hobj['conv_list'][aliased_conv_id] = message['conv_list'][conv_id]
-
-            for conv_id in message['conv_list']:
-                conv = message['conv_list'][conv_id]
-                conv['connected_jids'] = {}
-                conv['invited_jids'] = {}
-
-        elif message['what'] == 'presence':
-            # Receive presence information of contact:
-            # Forward to XMPP.
-            if message['gaia_id'] in self.userlist[fromjid]['user_list']:
-                self.userlist[fromjid]['user_list'][message['gaia_id']]['status'] = message['status']
-            self.send_presence_from_status(fromjid, '%s@%s' % (message['gaia_id'], config.jid), message['status'])
-
-        elif message['what'] == 'chat_message':
-            # Receive a chat message.
-            if message['type'] == 'one_to_one':
-                # Message is between two people: send directly to XMPP contact.
-                m = Message(typ='chat',
-                            frm='%s@%s' % (message['gaia_id'], config.jid),
-                            to=JID(fromjid),
-                            body=message['message'])
-                m.setTag('active', namespace=NS_CHATSTATES)
-                self.jabber.send(m)
-
-            elif message['type'] == 'group':
-                # Message is from a multi-user chat.
-                message['conv_id'] = self.gaia_id_to_conv_alias(message['conv_id'], fromjid)
-                if message['conv_id'] in self.userlist[fromjid]['conv_list']:
-                    conv = self.userlist[fromjid]['conv_list'][message['conv_id']]
-                    if message['gaia_id'] in conv['user_list']:
-                        # Conversation exists:
-                        # Send the message to every connected resource.
-                        nick = conv['user_list'][message['gaia_id']]
-                        for ajid in conv['connected_jids']:
-                            m = Message(typ='groupchat',
-                                        frm='%s@%s/%s' % (message['conv_id'], config.jid, nick),
-                                        to=ajid,
-                                        body=message['message'])
-                            self.jabber.send(m)
-                        # Send an invitation to every resource that did not open the conversation.
-                        for ajid in self.userlist[fromjid]['connected_jids']:
-                            if ajid not in conv['connected_jids'] and ajid not in conv['invited_jids']:
-                                conv['invited_jids'][ajid] = True
-                                # See: XEP-0249: Direct MUC Invitations -> 2. How It Works -> Example 1:
-                                # http://xmpp.org/extensions/xep-0249.html
-                                node = Node('x', {'jid': '%s@%s' % (message['conv_id'], config.jid),
-                                                  'reason': 'New messages are in!'})
-                                node.setNamespace(NS_CONFERENCE)
-                                m = Message(frm=config.jid,
-                                            to=ajid,
-                                            payload=[node])
-                                self.jabber.send(m)
-
-        elif message['what'] == 'typing_notification':
-            # Receive a typing notification:
-            # Forward to XMPP.
-            if message['type'] == 'one_to_one':
-                m = Message(typ='chat',
-                            frm='%s@%s' % (message['gaia_id'], config.jid),
-                            to=JID(fromjid))
-                if message['state'] == 'started':
-                    m.setTag('composing', namespace=NS_CHATSTATES)
-                else:
-                    m.setTag('paused', namespace=NS_CHATSTATES)
-                self.jabber.send(m)
-
-        elif message['what'] == 'conversation_history':
-            message['conv_id'] = self.gaia_id_to_conv_alias(message['conv_id'], fromjid)
-            conv = self.userlist[fromjid]['conv_list'][message['conv_id']]
-            if message['recipient_jid'] in conv['connected_jids']:
-                for event in message['history']:
-                    # See: XEP-0045: Multi-User Chat ->7.2.14 Discussion History
-                    # -> Example 35. Delivery of Discussion History:
-                    # http://xmpp.org/extensions/xep-0045.html#enter-history
-                    if event['type'] == 'message':
-                        # Regular chat message
-                        if event['gaia_id'] in conv['user_list']:
-                            nick = conv['user_list'][event['gaia_id']]
-                        else:
-                            nick = 'Unknown (%s)' % (event['gaia_id'],)
-                        m = Message(typ='groupchat',
-                                    frm='%s@%s/%s' % (message['conv_id'], config.jid, nick),
-                                    to=message['recipient_jid'],
-                                    body=event['message'])
-                    elif event['type'] == 'rename':
-                        # Conversation was renamed
-                        m = Message(typ='groupchat',
-                                    frm='%s@%s' % (message['conv_id'], config.jid),
-                                    to=message['recipient_jid'],
-                                    body='Conversation was renamed to: %s.' % (event['new_name']))
-                    elif event['type'] == 'invite':
-                        # Member has joined
-                        m = Message(typ='groupchat',
-                                    frm='%s@%s' % (message['conv_id'], config.jid),
-                                    to=message['recipient_jid'],
-                                    body='%s has invited %s.' % (event['inviter'], event['invited']))
-                    elif event['type'] == 'departure':
-                        # Member has left
+    def hangups_presence(self, message, fromjid, hobj):
+        """Receive presence information of contact: forward it to XMPP."""
+        if message.gaia_id in hobj['user_list']:
+            hobj['user_list'][message.gaia_id].status = message.status
+            hobj['user_list'][message.gaia_id].status_message = message.status_message
+        # Only what changed since the last presence sent reaches XMPP.
+        self.send_presence_from_status(fromjid, '%s@%s' % (message.gaia_id, config.jid), message.status,
+                                       message.status_message)
+
+    def hangups_chat_message(self, message, fromjid, hobj):
+        """Receive a chat message."""
+        if message.type == 'one_to_one':
+            # Message is between two people: send directly to XMPP contact.
+            m = Message(typ='chat',
+                        frm='%s@%s' % (message.gaia_id, config.jid),
+                        to=JID(fromjid),
+                        body=message.message)
+            m.setTag('active', namespace=NS_CHATSTATES)
+            self.send(m)
+
+        elif message.type == 'group':
+            # Message is from a multi-user chat.
+            message.conv_id = self.gaia_id_to_conv_alias(message.conv_id, fromjid)
+            if message.conv_id in hobj['conv_list']:
+                conv = hobj['conv_list'][message.conv_id]
+                if message.gaia_id in conv['members']:
+                    # Conversation exists:
+                    # Send the message to every connected resource.
+                    nick = hobj['nicknames'][message.gaia_id]
+                    for ajid in conv['connected_jids']:
                         m = Message(typ='groupchat',
-                                    frm='%s@%s' % (message['conv_id'], config.jid),
-                                    to=message['recipient_jid'],
-                                    body='%s has left.' % (event['departed'],))
+                                    frm='%s@%s/%s' % (message.conv_id, config.jid, nick),
+                                    to=ajid,
+                                    body=message.message)
+                        self.send(m)
+                    # Send an invitation to every resource that did not open the conversation.
+                    for ajid in hobj['connected_jids']:
+                        if ajid not in conv['connected_jids'] and ajid not in conv['invited_jids']:
+                            conv['invited_jids'][ajid] = True
+                            # See: XEP-0249: Direct MUC Invitations -> 2. How It Works -> Example 1:
+                            # http://xmpp.org/extensions/xep-0249.html
+                            node = Node('x', {'jid': '%s@%s' % (message.conv_id, config.jid),
+                                              'reason': 'New messages are in!'})
+                            node.setNamespace(NS_CONFERENCE)
+                            m = Message(frm=config.jid,
+                                        to=ajid,
+                                        payload=[node])
+                            self.send(m)
+
+    def hangups_typing_notification(self, message, fromjid, hobj):
+        """Receive a typing notification: forward it to XMPP."""
+        if message.type == 'one_to_one':
+            m = Message(typ='chat',
+                        frm='%s@%s' % (message.gaia_id, config.jid),
+                        to=JID(fromjid))
+            if message.state == 'started':
+                m.setTag('composing', namespace=NS_CHATSTATES)
+            else:
+                m.setTag('paused', namespace=NS_CHATSTATES)
+            self.send(m)
+
+    def hangups_conversation_history(self, message, fromjid, hobj):
+        """The history of a conversation requested by a resource."""
+        message.conv_id = self.gaia_id_to_conv_alias(message.conv_id, fromjid)
+        conv = hobj['conv_list'][message.conv_id]
+        if message.recipient_jid in conv['connected_jids']:
+            for event in message.history:
+                # See: XEP-0045: Multi-User Chat ->7.2.14 Discussion History
+                # -> Example 35. Delivery of Discussion History:
+                # http://xmpp.org/extensions/xep-0045.html#enter-history
+                if event['type'] == 'message':
+                    # Regular chat message
+                    if event['gaia_id'] in conv['members']:
+                        nick = hobj['nicknames'][event['gaia_id']]
                     else:
-                        # Unknown
-                        m = Message(typ='groupchat',
-                                    frm='%s@%s' % (message['conv_id'], config.jid),
-                                    to=message['recipient_jid'],
-                                    body='[Unknown event]')
-
-                    m.addChild('delay',
-                               attrs={'from': '%s@%s' % (message['conv_id'], config.jid),
-                                      'stamp': event['timestamp'].isoformat()},
-                               namespace=NS_DELAY)
-                    self.jabber.send(m)
-
-                # The room subject can only be sent after the history. Send it here.
-                # See: XEP-0045: Multi-User Chat -> 7.2.16 Room Subject:
-                # http://xmpp.org/extensions/xep-0045.html#enter-subject
-                m = Message(typ='groupchat',
-                            frm='%s@%s' % (message['conv_id'], config.jid),
-                            to=message['recipient_jid'],
-                            subject=conv['topic'])
-                self.jabber.send(m)
-
-        elif message['what'] == 'conversation_rename':
-            # Group chat was renamed
-            message['conv_id'] = self.gaia_id_to_conv_alias(message['conv_id'], fromjid)
-            if message['conv_id'] in self.userlist[fromjid]['conv_list']:
-                conv = self.userlist[fromjid]['conv_list'][message['conv_id']]
-                if conv['topic'] != message['new_name']:
-                    conv['topic'] = message['new_name']
+                        nick = 'Unknown (%s)' % (event['gaia_id'],)
+                    m = Message(typ='groupchat',
+                                frm='%s@%s/%s' % (message.conv_id, config.jid, nick),
+                                to=message.recipient_jid,
+                                body=event['message'])
+                elif event['type'] == 'rename':
+                    # Conversation was renamed
+                    m = Message(typ='groupchat',
+                                frm='%s@%s' % (message.conv_id, config.jid),
+                                to=message.recipient_jid,
+                                body='Conversation was renamed to: %s.' % (event['new_name']))
+                elif event['type'] == 'invite':
+                    # Member has joined
+                    m = Message(typ='groupchat',
+                                frm='%s@%s' % (message.conv_id, config.jid),
+                                to=message.recipient_jid,
+                                body='%s has invited %s.' % (event['inviter'], event['invited']))
+                elif event['type'] == 'departure':
+                    # Member has left
+                    m = Message(typ='groupchat',
+                                frm='%s@%s' % (message.conv_id, config.jid),
+                                to=message.recipient_jid,
+                                body='%s has left.' % (event['departed'],))
+                else:
+                    # Unknown
+                    m = Message(typ='groupchat',
+                                frm='%s@%s' % (message.conv_id, config.jid),
+                                to=message.recipient_jid,
+                                body='[Unknown event]')
+
+                m.addChild('delay',
+                           attrs={'from': '%s@%s' % (message.conv_id, config.jid),
+                                  'stamp': event['timestamp'].isoformat()},
+                           namespace=NS_DELAY)
+                self.send(m)
+
+            # The room subject can only be sent after the history. Send it here.
+            # See: XEP-0045: Multi-User Chat -> 7.2.16 Room Subject:
+            # http://xmpp.org/extensions/xep-0045.html#enter-subject
+            m = Message(typ='groupchat',
+                        frm='%s@%s' % (message.conv_id, config.jid),
+                        to=message.recipient_jid,
+                        subject=conv['topic'])
+            self.send(m)
+
+    def hangups_conversation_rename(self, message, fromjid, hobj):
+        """Group chat was renamed."""
+        message.conv_id = self.gaia_id_to_conv_alias(message.conv_id, fromjid)
+        if message.conv_id in hobj['conv_list']:
+            conv = hobj['conv_list'][message.conv_id]
+            if conv['topic'] != message.new_name:
+                conv['topic'] = message.new_name
+                for ajid in conv['connected_jids']:
+                    m = Message(typ='groupchat',
+                                frm='%s@%s' % (message.conv_id, config.jid),
+                                to=ajid,
+                                subject=message.new_name)
+                    self.send(m)
+
+    def hangups_conversation_add(self, message, fromjid, hobj):
+        """Group chat was created/found: add it to the list."""
+        conv_id = message.conv['conv_id']
+        conv_id = self.gaia_id_to_conv_alias(conv_id, fromjid)
+
+        set_members(message.conv, hobj['nicknames'])
+        hobj['conv_list'][conv_id] = message.conv
+        conv = hobj['conv_list'][conv_id]
+        conv['connected_jids'] = {}
+        conv['invited_jids'] = {}
+
+    def hangups_conversation_membership_change(self, message, fromjid, hobj):
+        """Members were added or removed from group chat."""
+        message.conv_id = self.gaia_id_to_conv_alias(message.conv_id, fromjid)
+        if message.conv_id in hobj['conv_list']:
+            conv = hobj['conv_list'][message.conv_id]
+            if message.new_members is not None:
+                # Members were added
+                for gaia_id in message.new_members:
+                    gaia_id = sys.intern(gaia_id)
+                    if gaia_id not in conv['members']:
+                        conv['members'] += (gaia_id,)
+                    nick = hobj['nicknames'].setdefault(gaia_id, sys.intern(message.new_members[gaia_id]))
+
+                    # Send presence information to connected resources
+                    for ajid in conv['connected_jids']:
+                        p = Presence(frm='%s@%s/%s' % (message.conv_id, config.jid, nick),
+                                     to=ajid,
+                                     payload=[MucUser(role='participant',
+                                                      affiliation='member',
+                                                      jid='%s@%s' % (gaia_id, config.jid))])
+                        self.send(p)
+
+            if message.old_members is not None:
+                # Members were removed
+                conv['members'] = tuple(gaia_id for gaia_id in conv['members']
+                                        if gaia_id not in message.old_members)
+                for gaia_id in message.old_members:
+                    nick = hobj['nicknames'].get(gaia_id, message.old_members[gaia_id])
+
+                    # Send presence information to connected resources
+                    for ajid in conv['connected_jids']:
+                        p = Presence(frm='%s@%s/%s' % (message.conv_id, config.jid, nick),
+                                     typ='unavailable',
+                                     to=ajid,
+                                     payload=[MucUser(role='none',
+                                                      affiliation='member',
+                                                      jid='%s@%s' % (gaia_id, config.jid))])
+                        self.send(p)
+
+                if conv['self_id'] in message.old_members:
+                    # We are in the list of former members. This means that we left the conversation:
+                    # Send a message and delete the conversation.
                     for ajid in conv['connected_jids']:
                         m = Message(typ='groupchat',
-                                    frm='%s@%s' % (message['conv_id'], config.jid),
+                                    frm='%s@%s' % (message.conv_id, config.jid),
                                     to=ajid,
-                                    subject=message['new_name'])
-                        self.jabber.send(m)
-
-        elif message['what'] == 'conversation_add':
-            # Group chat was created/found: add it to the list
-            hobj = self.userlist[fromjid]
-            conv_id = message['conv']['conv_id']
-            conv_id = self.gaia_id_to_conv_alias(conv_id, fromjid)
+                                    body='You have left the conversation in another client.')
+                        self.send(m)
 
-            hobj['conv_list'][conv_id] = message['conv']
-            conv = hobj['conv_list'][conv_id]
-            conv['connected_jids'] = {}
-            conv['invited_jids'] = {}
-
-        elif message['what'] == 'conversation_membership_change':
-            # Members were added or removed from group chat
-            message['conv_id'] = self.gaia_id_to_conv_alias(message['conv_id'], fromjid)
-            if message['conv_id'] in self.userlist[fromjid]['conv_list']:
-                conv = self.userlist[fromjid]['conv_list'][message['conv_id']]
-                if 'new_members' in message:
-                    # Members were added
-                    for gaia_id in message['new_members']:
-                        conv['user_list'][gaia_id] = message['new_members'][gaia_id]
-
-                        # Send presence information to connected resources
-                        for ajid in conv['connected_jids']:
-                            p = Presence(frm='%s@%s/%s' % (message['conv_id'],
-                                                           config.jid, message['new_members'][gaia_id]),
-                                         to=ajid,
-                                         payload=[MucUser(role='participant',
-                                                          affiliation='member',
-                                                          jid='%s@%s' % (gaia_id, config.jid))])
-                            self.jabber.send(p)
-
-                if 'old_members' in message:
-                    # Members were removed
-                    for gaia_id in message['old_members']:
-                        if gaia_id in conv['user_list']:
-                            del conv['user_list'][gaia_id]
-
-                        # Send presence information to connected resources
-                        for ajid in conv['connected_jids']:
-                            p = Presence(frm='%s@%s/%s' % (message['conv_id'],
-                                                           config.jid, message['old_members'][gaia_id]),
-                                         typ='unavailable',
-                                         to=ajid,
-                                         payload=[MucUser(role='none',
-                                                          affiliation='member',
-                                                          jid='%s@%s' % (gaia_id, config.jid))])
-                            self.jabber.send(p)
-
-                    if conv['self_id'] in message['old_members']:
-                        # We are in the list of former members. This means that we left the conversation:
-                        # Send a message and delete the conversation.
-                        for ajid in conv['connected_jids']:
-                            m = Message(typ='groupchat',
-                                        frm='%s@%s' % (message['conv_id'], config.jid),
-                                        to=ajid,
-                                        body='You have left the conversation in another client.')
-                            self.jabber.send(m)
-
-                        # Remove the conversation from the list.
-                        del self.userlist[fromjid]['conv_list'][message['conv_id']]
-
-        elif message['what'] == 'chat_message_error':
-            # A chat message from XMPP was not delivered.
-            message['conv_id'] = self.gaia_id_to_conv_alias(message['conv_id'], fromjid)
-            if message['conv_id'] in self.userlist[fromjid]['conv_list']:
-                error_node = Node('error', {'type': 'cancel', 'code': 503})
-                error_node.addChild('service-unavailable', namespace=NS_XMPP_STANZAS)
-                if message['type'] == 'one_to_one':
-                    frm = '%s@%s' % (message['gaia_id'], config.jid)
-                else:
-                    frm = '%s@%s' % (message['conv_id'], config.jid)
-                m = Message(typ='error',
-                            frm=frm,
-                            to=message['recipient_jid'],
-                            body=message['message'], payload=[error_node])
-                self.jabber.send(m)
+                    # Remove the conversation from the list.
+                    del hobj['conv_list'][message.conv_id]
 
+    def hangups_chat_message_error(self, message, fromjid, hobj):
+        """A chat message from XMPP was not delivered."""
+        if message.type == 'one_to_one':
+            if message.gaia_id not in hobj['user_list']:
+                return
+            frm = '%s@%s' % (message.gaia_id, config.jid)
+        else:
+            message.conv_id = self.gaia_id_to_conv_alias(message.conv_id, fromjid)
+            if message.conv_id not in hobj['conv_list']:
+                return
+            frm = '%s@%s' % (message.conv_id, config.jid)
+        error_node = Node('error', {'type': 'cancel', 'code': 503})
+        error_node.addChild('service-unavailable', namespace=NS_XMPP_STANZAS)
+        m = Message(typ='error',
+                    frm=frm,
+                    to=message.recipient_jid,
+                    body=message.message, payload=[error_node])
+        self.send(m)
+
+    def hangups_file_transfer_ack(self, message, fromjid, hobj):
+        """A chunk of a file transfer was uploaded: let the sender send the next one."""
+        transfer = self.file_transfers.get(message.transfer_id)
+        if transfer is not None and transfer['acks']:
+            transfer['active'] = time.monotonic()
+            self.send(transfer['acks'].popleft().buildReply('result'))
+
+    def hangups_file_transfer_error(self, message, fromjid, hobj):
+        """A file could not be uploaded or sent to Hangouts."""
+        self.abort_file_transfer(message.transfer_id, notify_hangups=False)
+        self.hangups_chat_message_error(message, fromjid, hobj)
+
+    def hangups_memory_usage(self, message, fromjid, hobj):
+        """A Hangouts thread reported the memory used by its session: check the session against the quotas."""
+        transport_size = self.estimate_session_size(fromjid)
+        hobj['memory'] = {'hangups': message.size, 'transport': transport_size}
+        total = message.size + transport_size
+        if total > int(config.sessionMemorySoftQuota):
+            # Cached events are fetched again from Hangouts when needed.
+            jh_hangups.hangups_manager.send_message(fromjid, {'what': 'evict_caches'})
+        if total > int(config.sessionMemoryHardQuota):
+            if not hobj.get('memory_alert'):
+                hobj['memory_alert'] = True
+                self.alert_admins('The session of %s uses about %d bytes, over the hard quota of %s bytes.'
+                                  % (fromjid, total, config.sessionMemoryHardQuota))
         else:
-            jh_hangups.hangups_manager.send_message(message['jid'], {'what': 'test'})
+            hobj['memory_alert'] = False
+
+    def hangups_presence_stats(self, message, fromjid, hobj):
+        """A Hangouts thread reported the number of presence changes of its contacts forwarded and suppressed."""
+        hobj['presence_stats'] = {'forwarded': message.forwarded, 'suppressed': message.suppressed}
+
+    # Handlers of the messages from the Hangouts threads, by class.
+    hangups_handlers = {
+        jh_messages.Connected: hangups_connected,
+        jh_messages.Disconnected: hangups_disconnected,
+        jh_messages.LoginQueued: hangups_login_queued,
+        jh_messages.AuthFailed: hangups_auth_failed,
+        jh_messages.UserList: hangups_user_list,
+        jh_messages.ConvList: hangups_conv_list,
+        jh_messages.ContactPresence: hangups_presence,
+        jh_messages.ChatMessage: hangups_chat_message,
+        jh_messages.TypingNotification: hangups_typing_notification,
+        jh_messages.ConversationHistory: hangups_conversation_history,
+        jh_messages.ConversationRename: hangups_conversation_rename,
+        jh_messages.ConversationAdd: hangups_conversation_add,
+        jh_messages.ConversationMembershipChange: hangups_conversation_membership_change,
+        jh_messages.ChatMessageError: hangups_chat_message_error,
+        jh_messages.FileTransferAck: hangups_file_transfer_ack,
+        jh_messages.FileTransferError: hangups_file_transfer_error,
+        jh_messages.MemoryUsage: hangups_memory_usage,
+        jh_messages.PresenceStats: hangups_presence_stats,
+    }
 
 
 class XMPPQueueThread(threading.Thread):
@@ -1211,14 +1976,138 @@ class XMPPQueueThread(threading.Thread):
                 continue
 
             xmpp_lock.acquire()
+            start = time.monotonic()
             try:
-                self.transport.handle_message(message)
+                jh_stats.run_profiled(self.transport.handle_message, message)
             finally:
+                xmpp_queue.charge(message, time.monotonic() - start)
                 xmpp_lock.release()
 
         logger.info("Queue thread stopped.")
 
 
+class Contact:
+    """A Hangouts contact of a user.
+
+    The transport keeps one for every contact of every connected user: it has slots instead of a dict, and its gaia id
+    and name are interned, so that they are shared with the members and nicknames of the conversations."""
+    __slots__ = ('gaia_id', 'full_name', 'photo_url', 'emails', 'phones', 'status', 'status_message')
+
+    def __init__(self, gaia_id, full_name, photo_url, emails, phones, status, status_message):
+        self.gaia_id = gaia_id
+        self.full_name = full_name
+        self.photo_url = photo_url
+        self.emails = emails
+        self.phones = phones
+        self.status = status
+        self.status_message = status_message
+
+    @classmethod
+    def from_dict(cls, user):
+        """Create a contact from a dict sent by a Hangouts thread."""
+        return cls(sys.intern(user['gaia_id']),
+                   sys.intern(user['full_name']),
+                   user['photo_url'],
+                   tuple(user['emails']),
+                   tuple(user['phones']),
+                   user['status'],
+                   user['status_message'])
+
+
+def set_members(conv, nicknames):
+    """Replace the {gaia_id: nickname} dict of a conversation sent by a Hangouts thread by the 'members' tuple of
+    its interned gaia ids. The nicknames are kept once per session, in the nicknames dict: the first one seen for a
+    member stays, so that its nickname is the same in every conversation."""
+    names = conv.pop('user_list')
+    for gaia_id, name in names.items():
+        nicknames.setdefault(sys.intern(gaia_id), sys.intern(name))
+    conv['members'] = tuple(sys.intern(gaia_id) for gaia_id in names)
+
+
+def estimate_size(obj, seen):
+    """Return an estimate of the bytes retained by obj, following containers and the attributes of objects. Objects
+    whose id is in the set seen are not counted again."""
+    if id(obj) in seen:
+        return 0
+    seen.add(id(obj))
+    size = sys.getsizeof(obj)
+    if isinstance(obj, dict):
+        size += sum(estimate_size(key, seen) + estimate_size(value, seen) for key, value in obj.items())
+    elif isinstance(obj, (list, tuple, set, frozenset, collections.deque)):
+        size += sum(estimate_size(item, seen) for item in obj)
+    elif hasattr(obj, '__slots__'):
+        size += sum(estimate_size(getattr(obj, slot, None), seen) for slot in obj.__slots__)
+    elif hasattr(obj, '__dict__'):
+        size += estimate_size(vars(obj), seen)
+    return size
+
+
+class SerializedNode(Node):
+    """A node already serialized: its text is put as is in the stanza it is added to. It has no children of its own
+    for the lookups in the stanza."""
+    def __init__(self, name, namespace, text):
+        Node.__init__(self, name)
+        self.setNamespace(namespace)
+        self.text = text
+
+    def __str__(self, fancy=0):
+        return self.text
+
+
+class VCardCache:
+    """Cache of serialized contact vCards, bounded by their total size.
+
+    Entries are keyed by the profile fields the card is built from, so a card is never served once the contact
+    changed, and cards are evicted in least recently used order."""
+    def __init__(self, max_bytes):
+        self.max_bytes = max_bytes
+        self.size = 0
+        self.entries = collections.OrderedDict()  # {key: (serialized vcard, size)}
+
+    @staticmethod
+    def get_key(user):
+        """Return the fields of a contact a rendered vCard depends on."""
+        return (user.gaia_id,
+                user.full_name,
+                user.photo_url,
+                user.phones[0] if len(user.phones) > 0 else None,
+                user.emails[0] if len(user.emails) > 0 else None)
+
+    def get(self, user):
+        """Return the cached serialized vCard of a contact, or None."""
+        key = self.get_key(user)
+        if key not in self.entries:
+            return None
+        self.entries.move_to_end(key)
+        return self.entries[key][0]
+
+    def put(self, user, vcard):
+        """Serialize the vCard node of a contact and store it, evicting the oldest cards if the cache becomes too
+        large. Return the serialized vCard."""
+        self.discard(user)
+        vcard = str(vcard)
+        size = len(vcard.encode('utf-8'))
+        if size > self.max_bytes:
+            return vcard
+        self.entries[self.get_key(user)] = (vcard, size)
+        self.size += size
+        while self.size > self.max_bytes:
+            evicted_key, (evicted_vcard, evicted_size) = self.entries.popitem(last=False)
+            self.size -= evicted_size
+        return vcard
+
+    def discard(self, user):
+        """Remove the vCard of a contact from the cache."""
+        key = self.get_key(user)
+        if key in self.entries:
+            self.size -= self.entries.pop(key)[1]
+
+    def clear(self):
+        """Remove every vCard from the cache."""
+        self.entries.clear()
+        self.size = 0
+
+
 def download_url(url):
     """Download a file from an URL and return a binary"""
     if not url.startswith('http'):
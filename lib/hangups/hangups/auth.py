@@ -14,7 +14,10 @@ This code may be debugged by invoking it directly:
 """
 
 import requests
+import json
 import logging
+import os
+import time
 import urllib.parse
 
 logger = logging.getLogger(__name__)
@@ -35,6 +38,8 @@ OAUTH2_LOGIN_URL = 'https://accounts.google.com/o/oauth2/auth?{}'.format(
     ))
 )
 OAUTH2_TOKEN_REQUEST_URL = 'https://accounts.google.com/o/oauth2/token'
+# Maximum time session cookies are reused for when they are cached:
+SESSION_COOKIES_MAX_AGE_SECS = 24 * 3600
 
 
 class GoogleAuthError(Exception):
@@ -63,7 +68,43 @@ def _save_oauth2_refresh_token(refresh_token_filename, refresh_token):
     return refresh_token
 
 
-def get_auth(get_code_f, refresh_token_filename):
+def _load_session_cookies(cookies_filename):
+    """Return cached session cookies or None if missing or expired."""
+    try:
+        with open(cookies_filename) as f:
+            cache = json.load(f)
+    except (IOError, ValueError) as e:
+        logger.info('Failed to load session cookies: %s', e)
+        return None
+    if cache.get('expires', 0) <= time.time():
+        logger.info('Cached session cookies have expired')
+        return None
+    return cache.get('cookies')
+
+
+def _save_session_cookies(cookies_filename, cookies, expires):
+    """Save session cookies to file, ignoring failure."""
+    logger.info('Saving session cookies to \'%s\'', cookies_filename)
+    try:
+        # The cookies grant access to the account: keep them private.
+        fd = os.open(cookies_filename, os.O_WRONLY | os.O_CREAT | os.O_TRUNC,
+                     0o600)
+        with open(fd, 'w') as f:
+            json.dump({'expires': expires, 'cookies': cookies}, f)
+    except IOError as e:
+        logger.warning('Failed to save session cookies: %s', e)
+
+
+def clear_session_cookies(cookies_filename):
+    """Remove cached session cookies, ignoring failure."""
+    try:
+        os.remove(cookies_filename)
+    except OSError:
+        pass
+
+
+def get_auth(get_code_f, refresh_token_filename, cookies_filename=None,
+             cookies_max_age=SESSION_COOKIES_MAX_AGE_SECS):
     """Login into Google and return cookies as a dict.
 
     get_code_f() is called if authorization code is required to log in, and
@@ -72,8 +113,17 @@ def get_auth(get_code_f, refresh_token_filename):
     A refresh token is saved/loaded from refresh_token_filename if possible, so
     subsequent logins may not require re-authenticating.
 
+    If cookies_filename is specified, the session cookies are cached in this
+    file until they expire, or for at most cookies_max_age seconds. Logins
+    using cached cookies do not make any request.
+
     Raises GoogleAuthError on failure.
     """
+    if cookies_filename is not None:
+        cookies = _load_session_cookies(cookies_filename)
+        if cookies is not None:
+            logger.info('Using cached session cookies')
+            return cookies
     try:
         logger.info('Authenticating with refresh token')
         access_token = _auth_with_refresh_token(refresh_token_filename)
@@ -82,7 +132,11 @@ def get_auth(get_code_f, refresh_token_filename):
         logger.info('Authenticating with authorization code')
         access_token = _auth_with_code(get_code_f, refresh_token_filename)
     logger.info('Authentication successful')
-    return _get_session_cookies(access_token)
+    cookies, expires = _get_session_cookies(access_token)
+    if cookies_filename is not None:
+        _save_session_cookies(cookies_filename, cookies,
+                              min(expires, time.time() + cookies_max_age))
+    return cookies
 
 
 def _auth_with_code(get_code_f, refresh_token_filename):
@@ -151,7 +205,7 @@ def _auth_with_refresh_token(refresh_token_filename):
 def _get_session_cookies(access_token):
     """Use the access token to get session cookies.
 
-    Return dict of cookies.
+    Return dict of cookies and the timestamp of the earliest expiration.
     """
     # Prevent ResourceWarning by using context manager to close session
     # connection.
@@ -164,7 +218,10 @@ def _get_session_cookies(access_token):
                          'service=mail&'
                          'continue=http://www.google.com&uberauth={}')
                         .format(uberauth), headers=headers)
-        return session.cookies.get_dict(domain='.google.com')
+        expires = min([cookie.expires for cookie in session.cookies
+                       if cookie.domain == '.google.com' and cookie.expires],
+                      default=float('inf'))
+        return session.cookies.get_dict(domain='.google.com'), expires
 
 
 def get_auth_stdin(refresh_token_filename):
@@ -4,16 +4,19 @@ import aiohttp
 import asyncio
 import json
 import logging
+import io
 import random
 import time
 import os
 
 from hangups import (javascript, exceptions, http_utils, channel, event,
-                     hangouts_pb2, pblite, version)
+                     hangouts_pb2, pblite, ratelimit, version)
 
 logger = logging.getLogger(__name__)
 ORIGIN_URL = 'https://talkgadget.google.com'
 IMAGE_UPLOAD_URL = 'https://docs.google.com/upload/photos/resumable'
+# Size of the chunks in which image files are read while they are uploaded:
+IMAGE_UPLOAD_CHUNK_SIZE = 65536
 # Timeout to send for setactiveclient requests:
 ACTIVE_TIMEOUT_SECS = 120
 # Minimum timeout between subsequent setactiveclient requests:
@@ -26,10 +29,13 @@ class Client(object):
     Maintains a connections to the servers, emits events, and accepts commands.
     """
 
-    def __init__(self, cookies):
+    def __init__(self, cookies, rate_limiter=None):
         """Create new client.
 
         cookies is a dictionary of authentication cookies.
+
+        rate_limiter is the ratelimit.RateLimiter the chat API requests wait
+        for, instead of one with the default limits.
         """
 
         # Event fired when the client connects for the first time with
@@ -69,6 +75,10 @@ class Client(object):
         # String email address for this account (populated later):
         self._email = None
 
+        # RateLimiter the chat API requests wait for:
+        self._rate_limiter = (ratelimit.RateLimiter() if rate_limiter is None
+                              else rate_limiter)
+
         # Active client management parameters:
         # Time in seconds that the client as last set as active:
         self._last_active_secs = 0.0
@@ -202,7 +212,8 @@ class Client(object):
     def upload_image(self, image_file, filename=None):
         """Upload an image that can be later attached to a chat message.
 
-        image_file is a file-like object containing an image.
+        image_file is a file-like object containing an image. It is read and
+        sent in chunks, rather than loaded in memory at once.
 
         The name of the uploaded file may be changed by specifying the filename
         argument.
@@ -213,8 +224,42 @@ class Client(object):
         """
         image_filename = (filename if filename
                           else os.path.basename(image_file.name))
-        image_data = image_file.read()
+        try:
+            start = image_file.tell()
+            image_file.seek(0, os.SEEK_END)
+            size = image_file.tell() - start
+            image_file.seek(start)
+        except (AttributeError, OSError):
+            # The file cannot tell its size: read it whole.
+            image_data = image_file.read()
+            size = len(image_data)
+            image_file = io.BytesIO(image_data)
+            start = 0
+
+        def read_chunks():
+            # Each attempt of the upload reads the file again.
+            image_file.seek(start)
+            return _read_chunks(image_file, IMAGE_UPLOAD_CHUNK_SIZE)
+
+        return (yield from self.upload_image_stream(read_chunks,
+                                                    image_filename, size))
 
+    @asyncio.coroutine
+    def upload_image_stream(self, chunks, filename, size):
+        """Upload an image received progressively.
+
+        chunks is a generator yielding the size bytes of the image, in as many
+        bytes objects as needed. To wait for more data, it may also yield from
+        coroutines (the generator is consumed by aiohttp as a streaming request
+        body). Each chunk is written to the connection before the next one is
+        requested, so that only one chunk is held in memory at a time. The
+        upload is then attempted once. chunks may also be a callable returning
+        such a generator, called again for each attempt of the upload.
+
+        Raises hangups.NetworkError if the request fails.
+
+        Returns ID of uploaded image.
+        """
         # Create image and request upload URL
         res1 = yield from self._base_request(
             IMAGE_UPLOAD_URL,
@@ -226,9 +271,9 @@ class Client(object):
                     "fields": [{
                         "external": {
                             "name": "file",
-                            "filename": image_filename,
+                            "filename": filename,
                             "put": {},
-                            "size": len(image_data),
+                            "size": size,
                         }
                     }]
                 }
@@ -236,9 +281,12 @@ class Client(object):
         upload_url = (json.loads(res1.body.decode())['sessionStatus']
                       ['externalFieldTransfers'][0]['putInfo']['url'])
 
-        # Upload image data and get image ID
+        # Stream image data and get image ID. The length is known, so the body
+        # is not sent with chunked encoding. The generator decides how long it
+        # waits for its data.
         res2 = yield from self._base_request(
-            upload_url, 'application/octet-stream', 'json', image_data
+            upload_url, 'application/octet-stream', 'json', chunks,
+            content_length=size, timeout=None
         )
         return (json.loads(res2.body.decode())['sessionStatus']
                 ['additionalInfo']
@@ -312,6 +360,8 @@ class Client(object):
     def _pb_request(self, endpoint, request_pb, response_pb):
         """Send a Protocol Buffer formatted chat API request.
 
+        The request first waits for the rate limiter of the client.
+
         Args:
             endpoint (str): The chat API endpoint to use.
             request_pb: The request body as a Protocol Buffer message.
@@ -320,6 +370,7 @@ class Client(object):
         Raises:
             NetworkError: If the request fails.
         """
+        yield from self._rate_limiter.acquire(endpoint)
         logger.debug('Sending Protocol Buffer request %s:\n%s', endpoint,
                      request_pb)
         res = yield from self._base_request(
@@ -340,7 +391,8 @@ class Client(object):
             )
 
     @asyncio.coroutine
-    def _base_request(self, url, content_type, response_type, data):
+    def _base_request(self, url, content_type, response_type, data,
+                      content_length=None, timeout=http_utils.CONNECT_TIMEOUT):
         """Send a generic authenticated POST request.
 
         Args:
@@ -350,7 +402,11 @@ class Client(object):
                 are: 'json' (JSON), 'protojson' (pblite), and 'proto' (binary
                 Protocol Buffer). 'proto' requires manually setting an extra
                 header 'X-Goog-Encode-Response-If-Executable: base64'.
-            data (str): Request body data.
+            data (str): Request body data, a generator streaming it, or a
+                callable returning either for each attempt.
+            content_length (int): Length of the body, required when it is
+                streamed and the server does not accept chunked encoding.
+            timeout (float): Seconds allowed to send the request, or None.
 
         Returns:
             FetchResponse: Response containing HTTP code, cookies, and body.
@@ -361,6 +417,8 @@ class Client(object):
         sapisid_cookie = self._get_cookie('SAPISID')
         headers = channel.get_authorization_headers(sapisid_cookie)
         headers['content-type'] = content_type
+        if content_length is not None:
+            headers['content-length'] = str(content_length)
         required_cookies = ['SAPISID', 'HSID', 'SSID', 'APISID', 'SID']
         cookies = {cookie: self._get_cookie(cookie)
                    for cookie in required_cookies}
@@ -370,7 +428,7 @@ class Client(object):
         }
         res = yield from http_utils.fetch(
             'post', url, headers=headers, cookies=cookies, params=params,
-            data=data, connector=self._connector
+            data=data, connector=self._connector, connect_timeout=timeout
         )
         return res
 
@@ -553,3 +611,12 @@ class Client(object):
         yield from self._pb_request('conversations/updatewatermark',
                                     update_watermark_request, response)
         return response
+
+
+def _read_chunks(file_, chunk_size):
+    """Generate the content of a file-like object, chunk_size bytes at once."""
+    while True:
+        chunk = file_.read(chunk_size)
+        if not chunk:
+            return
+        yield chunk
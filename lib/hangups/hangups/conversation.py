@@ -10,6 +10,17 @@ from hangups import (parsers, event, user, conversation_event, exceptions,
 
 logger = logging.getLogger(__name__)
 
+# Maximum size of each page of events requested when syncing.
+SYNC_PAGE_SIZE_BYTES = 1048576  # 1 MB
+# Maximum number of pages requested by a single sync.
+MAX_SYNC_PAGES = 20
+# Approximate ratio between the memory retained by a parsed protobuf message
+# and its serialized size, used by the memory estimates.
+PROTO_MEMORY_RATIO = 4
+# Approximate memory retained by a ConversationEvent besides its protobuf
+# message (the wrapper object and its list and dict entries).
+EVENT_OVERHEAD_BYTES = 300
+
 
 @asyncio.coroutine
 def build_user_conversation_list(client):
@@ -86,6 +97,56 @@ def build_user_conversation_list(client):
     return (user_list, conversation_list)
 
 
+def snapshot_user_conversation_list(user_list, conversation_list):
+    """Return a snapshot of a UserList and its ConversationList.
+
+    The snapshot is a dict of serialized protocol buffers, holding the users,
+    the last event of each conversation, and the sync timestamp, from which
+    build_user_conversation_list_from_snapshot can rebuild both lists without
+    requesting them again.
+    """
+    self_entity, entities = user_list.get_entities()
+    return {
+        'self_entity': self_entity.SerializeToString(),
+        'entities': [entity.SerializeToString() for entity in entities],
+        'conv_states': [conv_state.SerializeToString() for conv_state
+                        in conversation_list.get_conversation_states()],
+        'sync_timestamp': parsers.to_timestamp(
+            conversation_list._sync_timestamp
+        ),
+    }
+
+
+def build_user_conversation_list_from_snapshot(client, snapshot):
+    """Return UserList and ConversationList from a snapshot.
+
+    The events that happened since the snapshot was taken are not included:
+    ConversationList._sync has to be called to receive them.
+    """
+    self_entity = hangouts_pb2.Entity()
+    self_entity.ParseFromString(snapshot['self_entity'])
+    entities = []
+    for data in snapshot['entities']:
+        entity = hangouts_pb2.Entity()
+        entity.ParseFromString(data)
+        entities.append(entity)
+    conv_states = []
+    for data in snapshot['conv_states']:
+        conv_state = hangouts_pb2.ConversationState()
+        conv_state.ParseFromString(data)
+        conv_states.append(conv_state)
+    sync_timestamp = parsers.from_timestamp(snapshot['sync_timestamp'])
+
+    conv_part_list = []
+    for conv_state in conv_states:
+        conv_part_list.extend(conv_state.conversation.participant_data)
+
+    user_list = user.UserList(client, self_entity, entities, conv_part_list)
+    conversation_list = ConversationList(client, conv_states, user_list,
+                                         sync_timestamp)
+    return (user_list, conversation_list)
+
+
 class Conversation(object):
 
     """Wrapper around Client for working with a single chat conversation."""
@@ -462,6 +523,29 @@ class Conversation(object):
         return self._events[-1*n:]
 
 
+    def estimate_size(self):
+        """Return an estimate of the bytes retained by the conversation and
+        its events."""
+        size = self._conversation.ByteSize() * PROTO_MEMORY_RATIO
+        for conv_event in self._events:
+            size += (conv_event._event.ByteSize() * PROTO_MEMORY_RATIO +
+                     EVENT_OVERHEAD_BYTES)
+        return size
+
+    def evict_events(self, keep=1):
+        """Forget all but the keep latest events.
+
+        Forgotten events can be fetched again with get_events. At least one
+        event is kept, to fetch the older ones from.
+
+        Returns the number of events forgotten.
+        """
+        evicted = self._events[:-max(keep, 1)]
+        for conv_event in evicted:
+            del self._events_dict[conv_event.id_]
+        del self._events[:len(evicted)]
+        return len(evicted)
+
     def next_event(self, event_id, prev=False):
         """Return ConversationEvent following the event with given event_id.
 
@@ -595,6 +679,11 @@ class ConversationList(object):
         self.on_watermark_notification = event.Event(
             'ConversationList.on_watermark_notification'
         )
+        # Event fired when the timestamp up to which events were received is
+        # updated with arguments (datetime).
+        self.on_sync_timestamp_update = event.Event(
+            'ConversationList.on_sync_timestamp_update'
+        )
 
     def get_all(self, include_archived=False):
         """Return list of all Conversations.
@@ -611,6 +700,30 @@ class ConversationList(object):
         """
         return self._conv_dict[conv_id]
 
+    def get_conversation_states(self):
+        """Return a ConversationState with the last event of every
+        Conversation, archived ones included."""
+        return [
+            hangouts_pb2.ConversationState(
+                conversation_id=conv._conversation.conversation_id,
+                conversation=conv._conversation,
+                event=[conv_event._event for conv_event in conv._events[-1:]],
+            )
+            for conv in self._conv_dict.values()
+        ]
+
+    def estimate_size(self):
+        """Return an estimate of the bytes retained by all Conversations."""
+        return sum(conv.estimate_size() for conv in self._conv_dict.values())
+
+    def evict_events(self, keep=1):
+        """Forget all but the keep latest events of every Conversation.
+
+        Returns the number of events forgotten.
+        """
+        return sum(conv.evict_events(keep)
+                   for conv in self._conv_dict.values())
+
     def get_one_to_one_with_user(self, gaia_id):
         for conv in self._conv_dict.values():
             if conv._conversation.type != hangouts_pb2.CONVERSATION_TYPE_ONE_TO_ONE:
@@ -670,6 +783,7 @@ class ConversationList(object):
     def _on_event(self, event_):
         """Receive a hangouts_pb2.Event and fan out to Conversations."""
         self._sync_timestamp = parsers.from_timestamp(event_.timestamp)
+        yield from self.on_sync_timestamp_update.fire(self._sync_timestamp)
         try:
             conv = self._conv_dict[event_.conversation_id.id]
         except KeyError:
@@ -719,22 +833,32 @@ class ConversationList(object):
 
     @asyncio.coroutine
     def _sync(self):
-        """Sync conversation state and events that could have been missed."""
-        logger.info('Syncing events since {}'.format(self._sync_timestamp))
-        try:
-            res = yield from self._client.sync_all_new_events(
-                hangouts_pb2.SyncAllNewEventsRequest(
-                    request_header=self._client.get_request_header(),
-                    last_sync_timestamp=parsers.to_timestamp(
-                        self._sync_timestamp
-                    ),
-                    max_response_size_bytes=1048576,  # 1 MB
+        """Sync conversation state and events that could have been missed.
+
+        The events are requested in pages of at most SYNC_PAGE_SIZE_BYTES,
+        each page starting after the newest event of the previous one, until
+        a page brings no new event or MAX_SYNC_PAGES have been requested.
+        """
+        for page in range(MAX_SYNC_PAGES):
+            logger.info('Syncing events since {} (page {})'
+                        .format(self._sync_timestamp, page + 1))
+            try:
+                res = yield from self._client.sync_all_new_events(
+                    hangouts_pb2.SyncAllNewEventsRequest(
+                        request_header=self._client.get_request_header(),
+                        last_sync_timestamp=parsers.to_timestamp(
+                            self._sync_timestamp
+                        ),
+                        max_response_size_bytes=SYNC_PAGE_SIZE_BYTES,
+                    )
                 )
-            )
-        except exceptions.NetworkError as e:
-            logger.warning('Failed to sync events, some events may be lost: {}'
-                           .format(e))
-        else:
+            except exceptions.NetworkError as e:
+                logger.warning('Failed to sync events, some events may be '
+                               'lost: {}'.format(e))
+                return
+
+            previous_sync_timestamp = self._sync_timestamp
+            newest_timestamp = previous_sync_timestamp
             for conv_state in res.conversation_state:
                 conv_id = conv_state.conversation_id.id
                 conv = self._conv_dict.get(conv_id, None)
@@ -749,3 +873,26 @@ class ConversationList(object):
                 else:
                     self.add_conversation(conv_state.conversation,
                                           conv_state.event)
+                for event_ in conv_state.event:
+                    newest_timestamp = max(
+                        newest_timestamp,
+                        parsers.from_timestamp(event_.timestamp)
+                    )
+
+            if newest_timestamp <= previous_sync_timestamp:
+                # Nothing new: the backlog is exhausted.
+                if res.sync_timestamp:
+                    self._sync_timestamp = max(
+                        self._sync_timestamp,
+                        parsers.from_timestamp(res.sync_timestamp)
+                    )
+                    yield from self.on_sync_timestamp_update.fire(
+                        self._sync_timestamp
+                    )
+                return
+
+            self._sync_timestamp = max(self._sync_timestamp, newest_timestamp)
+            yield from self.on_sync_timestamp_update.fire(self._sync_timestamp)
+
+        logger.warning('Stopped syncing events after {} pages, some events '
+                       'may be lost'.format(MAX_SYNC_PAGES))
@@ -115,9 +115,21 @@ class ChatMessageEvent(ConversationEvent):
     Corresponds to hangouts_pb2.ChatMessage.
     """
 
+    def __init__(self, event):
+        super().__init__(event)
+        # The message never changes: text and segments are computed once.
+        self._text = None
+        self._segments = None
+
     @property
     def text(self):
         """A textual representation of the message."""
+        if self._text is None:
+            self._text = self._build_text()
+        return self._text
+
+    def _build_text(self):
+        """Join the segments and attachments of the message."""
         lines = ['']
         for segment in self.segments:
             if segment.type_ == hangouts_pb2.SEGMENT_TYPE_TEXT:
@@ -135,8 +147,11 @@ class ChatMessageEvent(ConversationEvent):
     @property
     def segments(self):
         """List of hangouts_pb2.Segment in the message."""
-        seg_list = self._event.chat_message.message_content.segment
-        return [ChatMessageSegment.deserialize(seg) for seg in seg_list]
+        if self._segments is None:
+            seg_list = self._event.chat_message.message_content.segment
+            self._segments = [ChatMessageSegment.deserialize(seg)
+                              for seg in seg_list]
+        return self._segments
 
     @property
     def attachments(self):
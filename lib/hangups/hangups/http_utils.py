@@ -4,6 +4,7 @@ import aiohttp
 import asyncio
 import collections
 import logging
+import types
 
 from hangups import exceptions
 
@@ -18,22 +19,30 @@ FetchResponse = collections.namedtuple('FetchResponse', ['code', 'body',
 
 @asyncio.coroutine
 def fetch(method, url, params=None, headers=None, cookies=None, data=None,
-          connector=None):
+          connector=None, connect_timeout=CONNECT_TIMEOUT):
     """Make an HTTP request.
 
     If the request times out or a encounters a connection issue, it will be
     retried MAX_RETRIES times before finally raising hangups.NetworkError.
 
+    data may be a generator streaming the body, as accepted by aiohttp: the
+    request is then only attempted once, since the body cannot be replayed.
+    It may also be a callable returning the body, called again for each
+    attempt, to retry a streamed body that can be read again. connect_timeout
+    covers sending the body, and may be None to wait for a streamed body as
+    long as it takes.
+
     Returns FetchResponse.
     """
     logger.debug('Sending request %s %s:\n%r', method, url, data)
     error_msg = None
-    for retry_num in range(MAX_RETRIES):
+    max_retries = 1 if isinstance(data, types.GeneratorType) else MAX_RETRIES
+    for retry_num in range(max_retries):
         try:
             res = yield from asyncio.wait_for(aiohttp.request(
                 method, url, params=params, headers=headers, cookies=cookies,
-                data=data, connector=connector
-            ), CONNECT_TIMEOUT)
+                data=data() if callable(data) else data, connector=connector
+            ), connect_timeout)
             body = yield from asyncio.wait_for(res.read(), REQUEST_TIMEOUT)
             logger.debug('Received response %d %s:\n%r', res.status,
                          res.reason, body)
@@ -48,7 +57,7 @@ def fetch(method, url, params=None, headers=None, cookies=None, data=None,
             break
         logger.info('Request attempt %d failed: %s', retry_num, error_msg)
     if error_msg:
-        logger.info('Request failed after %d attempts', MAX_RETRIES)
+        logger.info('Request failed after %d attempts', max_retries)
         raise exceptions.NetworkError(error_msg)
     if res.status > 200 or res.status < 200:
         logger.info('Request returned unexpected status: %d %s', res.status,
@@ -5,11 +5,20 @@ API responses. This is only as complete as necessary to parse the responses
 we're getting.
 """
 
+import appdirs
+import hashlib
+import json
 import logging
+import os
 import purplex
+from purplex.parse import ParserBase
 
 logger = logging.getLogger(__name__)
 
+# File keeping the parser tables, so that they are not computed at every start:
+_TABLES_FILENAME = os.path.join(appdirs.user_cache_dir('hangups', 'hangups'),
+                                'javascript_tables.json')
+
 
 def loads(string):
     """Parse simple JavaScript types from string into Python types.
@@ -111,7 +120,68 @@ class JavaScriptLexer(purplex.Lexer):
     WHITESPACE = purplex.TokenDef(r'[\s\n]+', ignore=True)
 
 
-class JavaScriptParser(purplex.Parser):
+def _get_grammar_key(productions, grammar, precedence):
+    """Return a digest identifying the tables of a grammar."""
+    return hashlib.sha1(repr((
+        sorted(productions), sorted(grammar.terminals),
+        sorted((str(symbol), level) for symbol, level in precedence.items()),
+    )).encode()).hexdigest()
+
+
+class _CachedParserBase(ParserBase):
+
+    """Parser metaclass loading the ACTION and GOTO tables from a file.
+
+    The tables are only computed, then written to the file, when the grammar
+    changed.
+    """
+
+    @classmethod
+    def make_tables(cls, grammar, precedence):
+        productions = {str(production): production
+                       for nonterminal in grammar.nonterminals.values()
+                       for production in nonterminal}
+        key = _get_grammar_key(productions, grammar, precedence)
+        try:
+            with open(_TABLES_FILENAME) as tables_file:
+                cached = json.load(tables_file)
+            if cached['key'] == key:
+                action = {(label, lookahead): (
+                    (kind, productions[arg]) if kind == 'reduce' else
+                    (kind, arg) if kind == 'shift' else (kind,)
+                ) for label, lookahead, kind, arg in cached['action']}
+                goto = {(label, symbol): state
+                        for label, symbol, state in cached['goto']}
+                return cached['initial_state'], action, goto
+        except (OSError, ValueError, KeyError) as e:
+            logger.debug('Parser tables not loaded: {}'.format(e))
+
+        initial_state, action, goto = super().make_tables(grammar,
+                                                          precedence)
+        cached = {
+            'key': key,
+            'initial_state': initial_state,
+            'action': [
+                [label, lookahead, value[0],
+                 str(value[1]) if value[0] == 'reduce' else
+                 value[1] if value[0] == 'shift' else None]
+                for (label, lookahead), value in action.items()
+            ],
+            'goto': [[label, symbol, state]
+                     for (label, symbol), state in goto.items()],
+        }
+        try:
+            os.makedirs(os.path.dirname(_TABLES_FILENAME), exist_ok=True)
+            temp_filename = '{}.{}'.format(_TABLES_FILENAME, os.getpid())
+            with open(temp_filename, 'w') as tables_file:
+                json.dump(cached, tables_file)
+            os.replace(temp_filename, _TABLES_FILENAME)
+        except OSError as e:
+            logger.warning('Failed to cache parser tables: {}'.format(e))
+        return initial_state, action, goto
+
+
+class JavaScriptParser(purplex.Parser, metaclass=_CachedParserBase):
     """Parser for a subset of JavaScript."""
 
     # pylint: disable=C0111,R0201,W0613,R0913
@@ -2,7 +2,7 @@
 
 import re
 
-from reparser import Parser, Token, MatchGroup
+from reparser import Parser, Token, MatchGroup, Segment
 
 from hangups import hangouts_pb2
 
@@ -40,6 +40,10 @@ url_proto_regex = re.compile(r'(?i)^[a-z][\w-]+:/{1,3}')
 # Precompiled regex for removing backslash before escaped Markdown tags
 markdown_unescape_regex = re.compile(r'\\([*_~=`\[])')
 
+# Precompiled regex for finding text that some token could match: Markdown and
+# HTML tags, line breaks, escapes and links (which contain ':', '/' or 'www')
+markup_regex = re.compile(r'[*_~=`\[<\n\r\\:/]|[wW][wW][wW]')
+
 
 def markdown(tag):
     """Return start and end regex pattern sequences for simple Markdown tag."""
@@ -107,6 +111,13 @@ class ChatMessageParser(Parser):
     def __init__(self, tokens=Tokens.markdown + Tokens.html + Tokens.basic):
         super().__init__(tokens)
 
+    def parse(self, text):
+        """Parse text to obtain list of Segments"""
+        if text and not markup_regex.search(text):
+            # Plain text: no token can match it, so it is a single segment.
+            return iter([Segment(self.preprocess(text))])
+        return super().parse(text)
+
     def preprocess(self, text):
         """Preprocess text before parsing"""
         # Replace two consecutive spaces with space and non-breakable space
@@ -0,0 +1,172 @@
+"""Token bucket rate limiting of chat API requests."""
+
+import asyncio
+import collections
+import itertools
+import logging
+import time
+
+logger = logging.getLogger(__name__)
+
+# Limit of a kind of request: requests per second, and burst size.
+Limit = collections.namedtuple('Limit', ['rate', 'burst'])
+
+# Limit of all the requests of a client:
+GLOBAL_LIMIT = Limit(10, 20)
+# Limit of each endpoint without a limit of its own:
+DEFAULT_LIMIT = Limit(5, 10)
+ENDPOINT_LIMITS = {
+    'conversations/sendchatmessage': Limit(5, 10),
+    'conversations/getconversation': Limit(2, 5),
+    'conversations/settyping': Limit(1, 3),
+    'conversations/setfocus': Limit(1, 3),
+    'conversations/updatewatermark': Limit(1, 5),
+    'presence/querypresence': Limit(2, 5),
+}
+
+# Priority of each endpoint, the lowest first:
+DEFAULT_PRIORITY = 1
+ENDPOINT_PRIORITIES = {
+    'conversations/sendchatmessage': 0,
+    'conversations/getconversation': 2,
+    'conversations/updatewatermark': 2,
+    'presence/querypresence': 2,
+    'conversations/settyping': 3,
+    'conversations/setfocus': 3,
+}
+
+
+class TokenBucket(object):
+
+    """Bucket of tokens refilled at a constant rate."""
+
+    def __init__(self, limit):
+        """Create a full bucket for a Limit."""
+        self._rate = limit.rate
+        self._burst = limit.burst
+        self._tokens = float(limit.burst)
+        self._updated = time.monotonic()
+
+    def _refill(self, now):
+        self._tokens = min(self._burst,
+                           self._tokens + (now - self._updated) * self._rate)
+        self._updated = now
+
+    def get_delay(self, now):
+        """Return the seconds until a token is available."""
+        self._refill(now)
+        return max(0.0, (1 - self._tokens) / self._rate)
+
+    def take(self, now):
+        """Take a token. The bucket must have one."""
+        self._refill(now)
+        self._tokens -= 1
+
+
+class RateLimiter(object):
+
+    """Queue of the requests of a client, let through within rate limits.
+
+    Each endpoint has its own token bucket, and all the requests share a
+    global one. When requests are waiting, the global tokens go to the
+    requests of the endpoints with the highest priority (the lowest number),
+    so that chat messages are not delayed by typing notifications. Requests
+    of the same endpoint are let through in order.
+    """
+
+    def __init__(self, global_limit=GLOBAL_LIMIT, limits=None,
+                 priorities=None, on_wait=None):
+        """Create a new rate limiter.
+
+        Args:
+            global_limit (Limit): Limit of all the requests.
+            limits (dict): Limit of each endpoint, instead of ENDPOINT_LIMITS.
+            priorities (dict): Priority of each endpoint, instead of
+                ENDPOINT_PRIORITIES.
+            on_wait: Function called with the endpoint and the seconds a
+                request waited, for every request.
+        """
+        self._global_bucket = TokenBucket(global_limit)
+        self._limits = ENDPOINT_LIMITS if limits is None else limits
+        self._priorities = (ENDPOINT_PRIORITIES if priorities is None
+                            else priorities)
+        self._on_wait = on_wait
+        self._buckets = {}  # {endpoint: TokenBucket}
+        # [(priority, sequence number, endpoint, future)]:
+        self._waiters = []
+        self._sequence = itertools.count()
+        self._timer = None
+
+    @asyncio.coroutine
+    def acquire(self, endpoint):
+        """Wait until a request to an endpoint may be sent.
+
+        Returns the seconds waited.
+        """
+        start = time.monotonic()
+        if not self._waiters and self._try_take(endpoint, start):
+            waited = 0.0
+        else:
+            future = asyncio.Future()
+            self._waiters.append((
+                self._priorities.get(endpoint, DEFAULT_PRIORITY),
+                next(self._sequence), endpoint, future
+            ))
+            self._waiters.sort(key=lambda waiter: waiter[:2])
+            self._schedule()
+            yield from future
+            waited = time.monotonic() - start
+            logger.debug('Request %s waited %.3f s', endpoint, waited)
+        if self._on_wait is not None:
+            self._on_wait(endpoint, waited)
+        return waited
+
+    def _get_bucket(self, endpoint):
+        bucket = self._buckets.get(endpoint)
+        if bucket is None:
+            bucket = self._buckets[endpoint] = TokenBucket(
+                self._limits.get(endpoint, DEFAULT_LIMIT)
+            )
+        return bucket
+
+    def _try_take(self, endpoint, now):
+        """Take tokens for a request if both buckets have one."""
+        bucket = self._get_bucket(endpoint)
+        if bucket.get_delay(now) or self._global_bucket.get_delay(now):
+            return False
+        bucket.take(now)
+        self._global_bucket.take(now)
+        return True
+
+    def _schedule(self):
+        """Let the waiting requests through, and wait for the next tokens."""
+        if self._timer is not None:
+            self._timer.cancel()
+            self._timer = None
+        now = time.monotonic()
+        delays = []
+        blocked_endpoints = set()
+        for waiter in list(self._waiters):
+            endpoint, future = waiter[2:]
+            if future.done():
+                # The request was cancelled.
+                self._waiters.remove(waiter)
+                continue
+            if endpoint in blocked_endpoints:
+                continue
+            global_delay = self._global_bucket.get_delay(now)
+            if global_delay:
+                # The global tokens are kept for this request.
+                delays.append(global_delay)
+                break
+            delay = self._get_bucket(endpoint).get_delay(now)
+            if delay:
+                blocked_endpoints.add(endpoint)
+                delays.append(delay)
+                continue
+            self._try_take(endpoint, now)
+            self._waiters.remove(waiter)
+            future.set_result(None)
+        if delays:
+            self._timer = asyncio.get_event_loop().call_later(min(delays),
+                                                              self._schedule)
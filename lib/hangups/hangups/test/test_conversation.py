@@ -0,0 +1,148 @@
+"""Tests for ConversationList snapshots and syncing."""
+
+import asyncio
+
+from hangups import conversation, event, hangouts_pb2, parsers, user
+
+
+class FakeClient(object):
+
+    """Client with only the events the lists observe."""
+
+    def __init__(self):
+        self.on_state_update = event.Event('FakeClient.on_state_update')
+        self.on_connect = event.Event('FakeClient.on_connect')
+        self.on_reconnect = event.Event('FakeClient.on_reconnect')
+        self.sync_pages = []
+        self.sync_requests = []
+
+    def get_request_header(self):
+        return hangouts_pb2.RequestHeader()
+
+    @asyncio.coroutine
+    def sync_all_new_events(self, request):
+        self.sync_requests.append(request.last_sync_timestamp)
+        return self.sync_pages.pop(0)
+
+
+def make_entity(gaia_id, display_name):
+    return hangouts_pb2.Entity(
+        id=hangouts_pb2.ParticipantId(chat_id=gaia_id, gaia_id=gaia_id),
+        properties=hangouts_pb2.EntityProperties(
+            display_name=display_name,
+            first_name=display_name.split()[0],
+            email=[gaia_id + '@example.com'],
+        ),
+    )
+
+
+def make_conv_state(conv_id, gaia_ids, timestamps):
+    return hangouts_pb2.ConversationState(
+        conversation_id=hangouts_pb2.ConversationId(id=conv_id),
+        conversation=hangouts_pb2.Conversation(
+            conversation_id=hangouts_pb2.ConversationId(id=conv_id),
+            type=hangouts_pb2.CONVERSATION_TYPE_GROUP,
+            participant_data=[
+                hangouts_pb2.ConversationParticipantData(
+                    id=hangouts_pb2.ParticipantId(chat_id=gaia_id,
+                                                  gaia_id=gaia_id),
+                    fallback_name='Fallback ' + gaia_id,
+                )
+                for gaia_id in gaia_ids
+            ],
+        ),
+        event=[
+            hangouts_pb2.Event(
+                conversation_id=hangouts_pb2.ConversationId(id=conv_id),
+                sender_id=hangouts_pb2.ParticipantId(chat_id=gaia_ids[0],
+                                                     gaia_id=gaia_ids[0]),
+                timestamp=timestamp,
+                event_id='event' + str(timestamp),
+            )
+            for timestamp in timestamps
+        ],
+    )
+
+
+def test_snapshot_round_trip():
+    client = FakeClient()
+    user_list = user.UserList(
+        client, make_entity('1', 'Self User'),
+        [make_entity('2', 'Alice Smith')],
+        make_conv_state('c1', ['1', '2', '3'], []).conversation.participant_data
+    )
+    conv_list = conversation.ConversationList(
+        client, [make_conv_state('c1', ['1', '2', '3'], [10, 20])], user_list,
+        parsers.from_timestamp(30)
+    )
+
+    snapshot = conversation.snapshot_user_conversation_list(user_list,
+                                                            conv_list)
+    restored_users, restored_convs = (
+        conversation.build_user_conversation_list_from_snapshot(FakeClient(),
+                                                                snapshot)
+    )
+
+    assert restored_users._self_user.id_.gaia_id == '1'
+    alice = restored_users.get_user(user.UserID(chat_id='2', gaia_id='2'))
+    assert alice.full_name == 'Alice Smith'
+    assert list(alice.emails) == ['2@example.com']
+    # Users only known from the participants are rebuilt from the conversation.
+    fallback = restored_users.get_user(user.UserID(chat_id='3', gaia_id='3'))
+    assert fallback.full_name == 'Fallback 3'
+    assert fallback.participant_type == 'unknown'
+
+    conv = restored_convs.get('c1')
+    # Only the last event is kept.
+    assert [conv_event.id_ for conv_event in conv.events] == ['event20']
+    assert restored_convs._sync_timestamp == conv_list._sync_timestamp
+
+
+def test_sync_pages_until_exhausted():
+    client = FakeClient()
+    user_list = user.UserList(client, make_entity('1', 'Self User'), [], [])
+    conv_list = conversation.ConversationList(
+        client, [make_conv_state('c1', ['1'], [10])], user_list,
+        parsers.from_timestamp(30)
+    )
+    client.sync_pages = [
+        hangouts_pb2.SyncAllNewEventsResponse(
+            conversation_state=[make_conv_state('c1', ['1'], [40, 100])]
+        ),
+        hangouts_pb2.SyncAllNewEventsResponse(
+            conversation_state=[make_conv_state('c1', ['1'], [200])]
+        ),
+        hangouts_pb2.SyncAllNewEventsResponse(sync_timestamp=300),
+    ]
+    received = []
+    conv_list.on_event.add_observer(
+        lambda conv_event: received.append(conv_event.id_)
+    )
+    updates = []
+    conv_list.on_sync_timestamp_update.add_observer(updates.append)
+
+    asyncio.new_event_loop().run_until_complete(conv_list._sync())
+
+    assert client.sync_requests == [30, 100, 200]
+    assert received == ['event40', 'event100', 'event200']
+    assert parsers.to_timestamp(conv_list._sync_timestamp) == 300
+    assert parsers.to_timestamp(updates[-1]) == 300
+
+
+def test_evict_events():
+    client = FakeClient()
+    user_list = user.UserList(client, make_entity('1', 'Self User'), [], [])
+    conv_list = conversation.ConversationList(
+        client, [make_conv_state('c1', ['1'], [10, 20, 30])], user_list,
+        parsers.from_timestamp(30)
+    )
+    size = conv_list.estimate_size()
+
+    assert conv_list.evict_events(keep=1) == 2
+    conv = conv_list.get('c1')
+    assert [conv_event.id_ for conv_event in conv.events] == ['event30']
+    assert 'event10' not in conv._events_dict
+    assert conv_list.estimate_size() < size
+    # The latest event is always kept, to fetch the older ones from.
+    assert conv_list.evict_events(keep=0) == 0
+    assert len(conv.events) == 1
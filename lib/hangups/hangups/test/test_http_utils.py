@@ -0,0 +1,192 @@
+"""Tests for HTTP requests with streamed bodies, and image uploads."""
+
+import asyncio
+import io
+import json
+import types
+
+import aiohttp
+import pytest
+
+from hangups import client, exceptions, http_utils
+
+COOKIES = {name: 'cookie' for name in ['SAPISID', 'HSID', 'SSID', 'APISID',
+                                       'SID']}
+
+
+def run(coroutine):
+    """Run a coroutine on a new loop and return its result."""
+    loop = asyncio.new_event_loop()
+    asyncio.set_event_loop(loop)
+    try:
+        return loop.run_until_complete(coroutine)
+    finally:
+        asyncio.set_event_loop(None)
+        loop.close()
+
+
+class FakeResponse(object):
+
+    def __init__(self, body):
+        self.status = 200
+        self.reason = 'OK'
+        self.cookies = {}
+        self.body = body
+
+    @asyncio.coroutine
+    def read(self):
+        return self.body
+
+
+class FakeServer(object):
+    """Replace aiohttp.request: read the bodies of the requests like aiohttp
+    does, and answer them with the responses given for their URL. A response
+    may be an exception, raised after fail_after bytes of the body were
+    read."""
+
+    def __init__(self, monkeypatch, responses, fail_after=0):
+        self.responses = responses
+        self.fail_after = fail_after
+        self.requests = []  # [(url, body)]
+        monkeypatch.setattr(aiohttp, 'request', self.request)
+
+    @asyncio.coroutine
+    def request(self, method, url, params=None, headers=None, cookies=None,
+                data=None, connector=None):
+        body = yield from self.read_body(url, data)
+        self.requests.append((url, body))
+        response = self.responses[url].pop(0)
+        if isinstance(response, Exception):
+            raise response
+        return FakeResponse(response)
+
+    @asyncio.coroutine
+    def read_body(self, url, data):
+        if not isinstance(data, types.GeneratorType):
+            return data
+        failing = isinstance(self.responses[url][0], Exception)
+        # A streamed body yields its chunks, and the futures it waits for.
+        body = b''
+        value = None
+        while True:
+            try:
+                item = data.send(value)
+            except StopIteration:
+                return body
+            value = None
+            if isinstance(item, asyncio.Future):
+                yield from asyncio.wait([item])
+                value = item.result()
+            else:
+                body += item
+                if failing and len(body) > self.fail_after:
+                    return body
+
+
+def test_fetch_streamed_body_waits_for_data(monkeypatch):
+    server = FakeServer(monkeypatch, {'url': [b'done']})
+    chunks = []
+
+    def stream():
+        while True:
+            chunks.append(asyncio.Future())
+            chunk = yield from chunks[-1]
+            if chunk is None:
+                return
+            yield chunk
+
+    @asyncio.coroutine
+    def send():
+        for chunk in [b'ab', b'cd', None]:
+            yield from asyncio.sleep(0.01)
+            chunks[-1].set_result(chunk)
+
+    @asyncio.coroutine
+    def fetch():
+        asyncio.async(send())
+        return (yield from http_utils.fetch('post', 'url', data=stream(),
+                                            connect_timeout=None))
+
+    res = run(fetch())
+    assert res.body == b'done'
+    assert server.requests == [('url', b'abcd')]
+
+
+def test_fetch_streamed_body_attempted_once(monkeypatch):
+    server = FakeServer(monkeypatch, {
+        'url': [aiohttp.ClientError('reset'), b'done'],
+    })
+    with pytest.raises(exceptions.NetworkError):
+        run(http_utils.fetch('post', 'url', data=(c for c in [b'ab'])))
+    assert len(server.requests) == 1
+
+
+def test_fetch_retries_body_read_again(monkeypatch):
+    server = FakeServer(monkeypatch, {
+        'url': [aiohttp.ClientError('reset'), b'done'],
+    }, fail_after=1)
+
+    def read_body():
+        return (chunk for chunk in [b'ab', b'cd'])
+
+    res = run(http_utils.fetch('post', 'url', data=read_body))
+    assert res.body == b'done'
+    # The first attempt failed after a chunk, the second sent the whole body.
+    assert server.requests == [('url', b'ab'), ('url', b'abcd')]
+
+
+def make_upload_server(monkeypatch, put_responses, fail_after=0):
+    return FakeServer(monkeypatch, {
+        'put': put_responses,
+        client.IMAGE_UPLOAD_URL: [json.dumps({'sessionStatus': {
+            'externalFieldTransfers': [{'putInfo': {'url': 'put'}}]
+        }}).encode()] * 2,
+    }, fail_after=fail_after)
+
+
+def make_photo_response(photo_id):
+    return json.dumps({'sessionStatus': {'additionalInfo': {
+        'uploader_service.GoogleRupioAdditionalInfo': {
+            'completionInfo': {'customerSpecificInfo': {'photoid': photo_id}}
+        }
+    }}}).encode()
+
+
+@asyncio.coroutine
+def upload_stream(chunks, size):
+    return (yield from client.Client(COOKIES).upload_image_stream(
+        chunks, 'image.png', size
+    ))
+
+
+def test_upload_image_stream(monkeypatch):
+    server = make_upload_server(monkeypatch, [make_photo_response('photo')])
+    chunks = (chunk for chunk in [b'ab', b'cd'])
+    assert run(upload_stream(chunks, 4)) == 'photo'
+    url, body = server.requests[0]
+    assert url == client.IMAGE_UPLOAD_URL
+    assert json.loads(body)['createSessionRequest']['fields'][0] == {
+        'external': {'name': 'file', 'filename': 'image.png', 'put': {},
+                     'size': 4}
+    }
+    assert server.requests[1] == ('put', b'abcd')
+
+
+def test_upload_image_retries_file(monkeypatch):
+    monkeypatch.setattr(client, 'IMAGE_UPLOAD_CHUNK_SIZE', 2)
+    server = make_upload_server(monkeypatch, [
+        aiohttp.ClientError('reset'), make_photo_response('photo'),
+    ], fail_after=1)
+    image_file = io.BytesIO(b'xxabcdef')
+    image_file.seek(2)
+
+    @asyncio.coroutine
+    def upload():
+        return (yield from client.Client(COOKIES).upload_image(
+            image_file, filename='image.png'
+        ))
+
+    assert run(upload()) == 'photo'
+    # The file is read again from where it started for the second attempt.
+    assert [body for url, body in server.requests if url == 'put'] == \
+        [b'ab', b'abcdef']
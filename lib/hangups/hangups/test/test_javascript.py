@@ -1,5 +1,6 @@
 """Tests for the JavaScript parser."""
 
+from purplex.parse import ParserBase
 import pytest
 
 from hangups import javascript
@@ -76,3 +77,19 @@ def test_loads_parse_error():
     """Test loading invalid JS that fails parsing."""
     with pytest.raises(ValueError):
         javascript.loads('{"foo": 1}}')
+
+
+def test_cached_tables(tmpdir, monkeypatch):
+    """Test loading the parser tables written by a previous start."""
+    monkeypatch.setattr(javascript, '_TABLES_FILENAME',
+                        str(tmpdir.join('tables.json')))
+    parser = javascript.JavaScriptParser
+    productions = set()
+    for attr in vars(parser).values():
+        productions |= getattr(attr, 'productions', set())
+    precedence = ParserBase.compute_precedence(parser.grammar.terminals,
+                                               productions, ())
+    make_tables = javascript._CachedParserBase.make_tables
+    computed = make_tables(parser.grammar, precedence)
+    assert tmpdir.join('tables.json').check()
+    assert make_tables(parser.grammar, precedence) == computed
@@ -75,3 +75,21 @@ def test_parse_html():
           'Wikipedia-logo-v2.svg'})
     ]
     assert expected == parse_text(text)
+
+
+def test_parse_plain_text():
+    parser = message_parser.ChatMessageParser()
+    for text in ['Hello, how are you? Fine (thanks)!', 'two  spaces', 'x']:
+        expected = [(s.text, s.params)
+                    for s in super(message_parser.ChatMessageParser,
+                                   parser).parse(text)]
+        assert expected == parse_text(text)
+    assert [('two \xa0spaces', {})] == parse_text('two  spaces')
+    assert [] == parse_text('')
+
+
+def test_parse_plain_text_keeps_links():
+    text = 'see WWW.google.com'
+    expected = [('see ', {}),
+                ('WWW.google.com', {'link_target': 'http://WWW.google.com'})]
+    assert expected == parse_text(text)
@@ -0,0 +1,58 @@
+"""Tests for the rate limiting of chat API requests."""
+
+import asyncio
+
+from hangups import ratelimit
+
+
+def run(coroutines):
+    """Run coroutines concurrently on a new loop and return their results."""
+    loop = asyncio.new_event_loop()
+    asyncio.set_event_loop(loop)
+    try:
+        return loop.run_until_complete(asyncio.gather(*coroutines))
+    finally:
+        asyncio.set_event_loop(None)
+        loop.close()
+
+
+def test_burst_then_wait():
+    waits = []
+    limiter = ratelimit.RateLimiter(
+        global_limit=ratelimit.Limit(1000, 1000),
+        limits={'a': ratelimit.Limit(20, 2)},
+        on_wait=lambda endpoint, seconds: waits.append((endpoint, seconds))
+    )
+    waited = run([limiter.acquire('a') for _ in range(3)])
+    assert waited[:2] == [0.0, 0.0]
+    # The third request waits for a token to be refilled.
+    assert 0.03 < waited[2] < 0.5
+    assert [endpoint for endpoint, seconds in waits] == ['a', 'a', 'a']
+
+
+def test_priorities():
+    order = []
+    limiter = ratelimit.RateLimiter(
+        global_limit=ratelimit.Limit(20, 1),
+        limits={},
+        priorities={'high': 0, 'low': 1},
+        on_wait=lambda endpoint, seconds: order.append(endpoint)
+    )
+    run([limiter.acquire('low'), limiter.acquire('low'),
+         limiter.acquire('high')])
+    # The first request takes the only token, then the waiting request with
+    # the highest priority goes first.
+    assert order == ['low', 'high', 'low']
+
+
+def test_blocked_endpoint_does_not_block_others():
+    order = []
+    limiter = ratelimit.RateLimiter(
+        global_limit=ratelimit.Limit(1000, 1000),
+        limits={'typing': ratelimit.Limit(20, 1)},
+        priorities={'typing': 0, 'message': 1},
+        on_wait=lambda endpoint, seconds: order.append(endpoint)
+    )
+    run([limiter.acquire('typing'), limiter.acquire('typing'),
+         limiter.acquire('message')])
+    assert order == ['typing', 'message', 'typing']
@@ -0,0 +1,52 @@
+"""Tests for User objects."""
+
+from hangups import user
+
+
+def test_unique_name_registry():
+    registry = user.UniqueNameRegistry()
+    alice_1 = user.UserID(chat_id='1', gaia_id='1')
+    alice_2 = user.UserID(chat_id='2', gaia_id='2')
+    alice_3 = user.UserID(chat_id='3', gaia_id='3')
+    assert registry.allocate('Alice', alice_1) == 'Alice'
+    assert registry.allocate('Alice', alice_2) == 'Alice (2)'
+    assert registry.allocate('Alice', alice_3) == 'Alice (3)'
+    # A user keeps the name it was first given.
+    assert registry.allocate('Alice', alice_2) == 'Alice (2)'
+    assert registry.allocate('Alice Renamed', alice_1) == 'Alice'
+    assert len(registry) == 3
+
+
+def test_unique_name_registry_skips_taken_suffix():
+    registry = user.UniqueNameRegistry()
+    bob_1 = user.UserID(chat_id='1', gaia_id='1')
+    bob_2 = user.UserID(chat_id='2', gaia_id='2')
+    bob_3 = user.UserID(chat_id='3', gaia_id='3')
+    assert registry.allocate('Bob (2)', bob_1) == 'Bob (2)'
+    assert registry.allocate('Bob', bob_2) == 'Bob'
+    assert registry.allocate('Bob', bob_3) == 'Bob (3)'
+
+
+def test_unique_name_registry_clear():
+    registry = user.UniqueNameRegistry()
+    carol_1 = user.UserID(chat_id='1', gaia_id='1')
+    carol_2 = user.UserID(chat_id='2', gaia_id='2')
+    registry.allocate('Carol', carol_1)
+    registry.clear()
+    assert len(registry) == 0
+    assert registry.allocate('Carol', carol_2) == 'Carol'
+
+
+def test_user_names_are_scoped_to_registry():
+    user_id = user.UserID(chat_id='1', gaia_id='1')
+    other_id = user.UserID(chat_id='2', gaia_id='2')
+    first = user.UniqueNameRegistry()
+    second = user.UniqueNameRegistry()
+    user.User(user_id, 'Dave', None, None, None, None, False, None, None,
+              first)
+    dave = user.User(other_id, 'Dave', None, None, None, None, False, None,
+                     None, second)
+    assert dave.unique_full_name == 'Dave'
+    unregistered = user.User(other_id, 'Dave', None, None, None, None, False,
+                             None, None)
+    assert unregistered.unique_full_name == 'Dave'
@@ -9,6 +9,8 @@ from . import hangouts_pb2
 
 logger = logging.getLogger(__name__)
 DEFAULT_NAME = 'Unknown'
+# Approximate memory retained by a User besides its strings.
+USER_OVERHEAD_BYTES = 500
 
 UserID = namedtuple('UserID', ['chat_id', 'gaia_id'])
 Presence = namedtuple('Presence', ['reachable', 'available', 'device_status', 'mood_setting'])
@@ -16,25 +18,73 @@ DeviceStatus = namedtuple('DeviceStatus', ['mobile', 'desktop', 'tablet'])
 MoodSetting = namedtuple('MoodSetting', ['mood_message'])
 
 
+class UniqueNameRegistry(object):
+
+    """Allocate full names that are unique within a UserList.
+
+    A user keeps the same unique name for as long as the registry lives.
+    Homonyms get a numbered suffix, "Name (2)", "Name (3)"..., the next free
+    number of each base name being remembered so that allocation does not
+    have to probe every taken suffix.
+    """
+
+    def __init__(self):
+        """Initialize an empty registry."""
+        self._names = {}  # {unique name: UserID}
+        self._user_names = {}  # {UserID: unique name}
+        self._next_suffix = {}  # {base name: next suffix to try}
+
+    def allocate(self, full_name, user_id):
+        """Return the unique name of a user, allocating it if needed."""
+        if user_id in self._user_names:
+            return self._user_names[user_id]
+
+        unique_name = full_name
+        if unique_name in self._names:
+            # Full name is already taken: use the next free suffix.
+            n = self._next_suffix.get(full_name, 2)
+            unique_name = '%s (%d)' % (full_name, n)
+            while unique_name in self._names:
+                n += 1
+                unique_name = '%s (%d)' % (full_name, n)
+            self._next_suffix[full_name] = n + 1
+
+        self._names[unique_name] = user_id
+        self._user_names[user_id] = unique_name
+        return unique_name
+
+    def clear(self):
+        """Free every allocated name."""
+        self._names.clear()
+        self._user_names.clear()
+        self._next_suffix.clear()
+
+    def __len__(self):
+        return len(self._names)
+
+
 class User(object):
 
     """A chat user.
 
     Handles full_name or first_name being None by creating an approximate
     first_name from the full_name, or setting both to DEFAULT_NAME.
-    """
 
-    # We maintain a list of full names, to be able to assign new User objects a unique one.
-    full_name_list = {}
+    If a UniqueNameRegistry is given, unique_full_name is allocated from it,
+    otherwise it is the same as full_name.
+    """
 
     def __init__(self, user_id, full_name, first_name, photo_url, emails, phones,
-                 is_self, presence, participant_type):
+                 is_self, presence, participant_type, name_registry=None):
         """Initialize a User."""
         self.id_ = user_id
         self.full_name = full_name if full_name != '' else DEFAULT_NAME
         self.first_name = (first_name if first_name != ''
                            else self.full_name.split()[0])
-        self.unique_full_name = self.create_unique_full_name()
+        self.unique_full_name = (
+            name_registry.allocate(self.full_name, self.id_)
+            if name_registry is not None else self.full_name
+        )
         self.photo_url = photo_url
         self.emails = emails
         self.phones = phones
@@ -42,37 +92,8 @@ class User(object):
         self.presence = presence
         self.participant_type = 'gaia' if participant_type == hangouts_pb2.PARTICIPANT_TYPE_GAIA else 'unknown'
 
-    def create_unique_full_name(self):
-        """Create a full name that is unique across every user met so far."""
-        if self.full_name in self.full_name_list:
-            if self.full_name_list[self.full_name] == self.id_:
-                # We are already in the list.
-                return self.full_name
-        else:
-            self.full_name_list[self.full_name] = self.id_
-            return self.full_name
-
-        # Full name is already taken:
-        # Increment a number until we find an empty slot:
-        # 1: Xavier Pichard (2)
-        # 2: Xavier Pichard (3)
-        # 3: Xavier Pichard (4)
-        # ...
-        n = 1
-        while True:
-            n += 1
-            full_name = '%s (%d)' % (self.full_name, n)
-            if full_name in self.full_name_list:
-                if self.full_name_list[full_name] == self.id_:
-                    # We are already in the list.
-                    return full_name
-            else:
-                # Empty slot.
-                self.full_name_list[full_name] = self.id_
-                return full_name
-
     @staticmethod
-    def from_entity(entity, self_user_id):
+    def from_entity(entity, self_user_id, name_registry=None):
         """Initialize from a Entity.
 
         If self_user_id is None, assume this is the self user.
@@ -92,10 +113,10 @@ class User(object):
                     entity.properties.email,
                     entity.properties.phone,
                     (self_user_id == user_id) or (self_user_id is None),
-                    presence, hangouts_pb2.PARTICIPANT_TYPE_GAIA)
+                    presence, hangouts_pb2.PARTICIPANT_TYPE_GAIA, name_registry)
 
     @staticmethod
-    def from_conv_part_data(conv_part_data, self_user_id):
+    def from_conv_part_data(conv_part_data, self_user_id, name_registry=None):
         """Initialize from ConversationParticipantData.
 
         If self_user_id is None, assume this is the self user.
@@ -103,7 +124,8 @@ class User(object):
         user_id = UserID(chat_id=conv_part_data.id.chat_id,
                          gaia_id=conv_part_data.id.gaia_id)
         return User(user_id, conv_part_data.fallback_name, None, None, None, None,
-                    (self_user_id == user_id) or (self_user_id is None), None, conv_part_data.participant_type)
+                    (self_user_id == user_id) or (self_user_id is None), None, conv_part_data.participant_type,
+                    name_registry)
 
     def set_presence(self, pb2_presence):
         self.presence = Presence(reachable=pb2_presence.reachable,
@@ -135,12 +157,17 @@ class UserList(object):
         self.on_presence = event.Event('UserList.on_presence')
 
         self._client = client
-        self._self_user = User.from_entity(self_entity, None)
+        # Unique names are scoped to this list, so that they do not depend on
+        # other lists living in the same process.
+        self._name_registry = UniqueNameRegistry()
+        self._self_user = User.from_entity(self_entity, None,
+                                           self._name_registry)
         # {UserID: User}
         self._user_dict = {self._self_user.id_: self._self_user}
         # Add each entity as a new User.
         for entity in entities:
-            user_ = User.from_entity(entity, self._self_user.id_)
+            user_ = User.from_entity(entity, self._self_user.id_,
+                                     self._name_registry)
             self._user_dict[user_.id_] = user_
         # Add each conversation participant as a new User if we didn't already
         # add them from an entity.
@@ -170,12 +197,59 @@ class UserList(object):
 
     def add_user_from_conv_part(self, conv_part):
         """Add new User from ConversationParticipantData"""
-        user_ = User.from_conv_part_data(conv_part, self._self_user.id_)
-        if user_.id_ not in self._user_dict:
-            logging.warning('Adding fallback User: {}'.format(user_))
-            self._user_dict[user_.id_] = user_
+        user_id = UserID(chat_id=conv_part.id.chat_id,
+                         gaia_id=conv_part.id.gaia_id)
+        if user_id in self._user_dict:
+            return self._user_dict[user_id]
+        user_ = User.from_conv_part_data(conv_part, self._self_user.id_,
+                                         self._name_registry)
+        logging.warning('Adding fallback User: {}'.format(user_))
+        self._user_dict[user_.id_] = user_
         return user_
 
+    def get_entities(self):
+        """Return the self Entity and the Entities of the other users.
+
+        Users only known from conversation participant data are not included,
+        as they are rebuilt from the conversations.
+        """
+        entities = []
+        self_entity = None
+        for user_ in self._user_dict.values():
+            if user_.participant_type != 'gaia':
+                continue
+            entity = hangouts_pb2.Entity(
+                id=hangouts_pb2.ParticipantId(chat_id=user_.id_.chat_id,
+                                              gaia_id=user_.id_.gaia_id),
+                properties=hangouts_pb2.EntityProperties(
+                    display_name=user_.full_name,
+                    first_name=user_.first_name,
+                    photo_url=user_.photo_url,
+                    email=user_.emails if user_.emails is not None else [],
+                    phone=user_.phones if user_.phones is not None else [],
+                ),
+            )
+            if user_ is self._self_user:
+                self_entity = entity
+            else:
+                entities.append(entity)
+        return (self_entity, entities)
+
+    def estimate_size(self):
+        """Return an estimate of the bytes retained by the users."""
+        size = 0
+        for user_ in self._user_dict.values():
+            size += USER_OVERHEAD_BYTES + sum(
+                len(value) for value in
+                [user_.full_name, user_.first_name, user_.photo_url or ''] +
+                list(user_.emails or []) + list(user_.phones or [])
+            )
+        return size
+
+    def close(self):
+        """Release the unique names allocated by this list."""
+        self._name_registry.clear()
+
     def set_presence_from_presence_result(self, presence_result):
         user_id = UserID(chat_id=presence_result.user_id.chat_id,
                          gaia_id=presence_result.user_id.gaia_id)
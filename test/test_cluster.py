@@ -0,0 +1,76 @@
+"""Tests for the leases of the sessions shared by the nodes of a cluster."""
+
+import threading
+
+import jh_cluster
+
+JID = 'user@example.net'
+
+
+class FakeTransport:
+    def __init__(self, sessions):
+        self.userlist = {jid: {} for jid in sessions}
+        self.dropped = []
+        self.sent = []
+
+    def drop_session(self, jid):
+        self.dropped.append(jid)
+        del self.userlist[jid]
+
+    def send(self, stanza):
+        self.sent.append(stanza)
+
+
+def renew_once(cluster, monkeypatch):
+    """Run one round of the renewal of the leases of a node."""
+    def sleep(seconds):
+        cluster.running = False
+    monkeypatch.setattr(jh_cluster.time, 'sleep', sleep)
+    cluster.running = True
+    cluster.renew()
+
+
+def test_leases_renewed_or_lost(tmpdir):
+    store = jh_cluster.UserStore(str(tmpdir.join('users.sqlite')))
+    assert store.acquire_lease(JID, 'node1', 30) == 'node1'
+    assert store.renew_leases('node1', [JID], 30) == []
+    # node1 missed its renewals, and node2 took the lease over.
+    store.query('UPDATE leases SET expires = 0')
+    assert store.acquire_lease(JID, 'node2', 30) == 'node2'
+    assert store.renew_leases('node1', [JID], 30) == [JID]
+    assert store.get_lease_owner(JID) == 'node2'
+
+
+def test_free_lease_taken_again(tmpdir):
+    store = jh_cluster.UserStore(str(tmpdir.join('users.sqlite')))
+    assert store.renew_leases('node1', [JID], 30) == []
+    assert store.get_lease_owner(JID) == 'node1'
+
+
+def test_session_stopped_when_lease_lost(tmpdir, monkeypatch):
+    store = jh_cluster.UserStore(str(tmpdir.join('users.sqlite')))
+    other = 'other@example.net'
+    store.acquire_lease(JID, 'node2', 30)
+    store.acquire_lease(other, 'node1', 30)
+    transport = FakeTransport([JID, other])
+    cluster = jh_cluster.Cluster(transport, store, 'node1', '127.0.0.1:0', 30, threading.RLock())
+    renew_once(cluster, monkeypatch)
+    assert transport.dropped == [JID]
+    assert set(transport.userlist) == {other}
+    assert store.get_leases('node1') == [other]
+
+
+def test_lease_taken_during_renewal_kept(tmpdir, monkeypatch):
+    store = jh_cluster.UserStore(str(tmpdir.join('users.sqlite')))
+    old = 'old@example.net'
+    store.acquire_lease(old, 'node1', 30)
+    cluster = jh_cluster.Cluster(FakeTransport([]), store, 'node1', '127.0.0.1:0', 30, threading.RLock())
+    get_leases = store.get_leases
+
+    def acquire_then_get_leases(node):
+        # The dispatcher takes a lease after the renewal looked at the sessions.
+        store.acquire_lease(JID, 'node1', 30)
+        return get_leases(node)
+    monkeypatch.setattr(store, 'get_leases', acquire_then_get_leases)
+    renew_once(cluster, monkeypatch)
+    assert get_leases('node1') == [JID]
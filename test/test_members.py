@@ -0,0 +1,50 @@
+"""Tests for the members of the group conversations kept by the transport."""
+
+import jh_messages
+import jh_xmpp
+
+JID = 'user@example.net'
+RESOURCE = JID + '/phone'
+
+
+class FakeTransport(jh_xmpp.Transport):
+    """A transport keeping the stanzas it sends."""
+    def __init__(self):
+        self.userfile = {JID: {'conv_aliases': {}}}
+        self.sent = []
+
+    def send(self, stanza):
+        self.sent.append(stanza)
+
+
+def make_session():
+    return {'user_list': {}, 'conv_list': {}, 'nicknames': {}, 'connected_jids': {}}
+
+
+def add_conversation(transport, hobj, user_list):
+    conv = {'conv_id': 'conv', 'topic': 'Topic', 'user_list': user_list, 'self_id': '1'}
+    transport.hangups_conversation_add(jh_messages.ConversationAdd(conv, jid=JID), JID, hobj)
+    return hobj['conv_list']['conv']
+
+
+def test_members_kept_as_gaia_ids():
+    transport = FakeTransport()
+    hobj = make_session()
+    conv = add_conversation(transport, hobj, {'1': 'Me', '2': 'Alice'})
+    assert conv['members'] == ('1', '2')
+    assert 'user_list' not in conv
+    assert hobj['nicknames'] == {'1': 'Me', '2': 'Alice'}
+
+
+def test_nickname_shared_by_conversations():
+    transport = FakeTransport()
+    hobj = make_session()
+    conv = add_conversation(transport, hobj, {'1': 'Me', '2': 'Alice'})
+    conv['connected_jids'][RESOURCE] = True
+    transport.hangups_conversation_membership_change(
+        jh_messages.ConversationMembershipChange('conv', new_members={'3': 'Bob'}, old_members={'2': 'Alice B.'},
+                                                 jid=JID), JID, hobj)
+    assert conv['members'] == ('1', '3')
+    # The presences use the nickname the members have in every conversation.
+    assert [str(stanza.getFrom()) for stanza in transport.sent] == ['conv@%s/Bob' % (jh_xmpp.config.jid,),
+                                                                    'conv@%s/Alice' % (jh_xmpp.config.jid,)]
@@ -0,0 +1,262 @@
+"""Tests for the queueing, retries and persistence of the chat messages sent to Hangouts."""
+
+import asyncio
+import os
+import time
+
+import jh_hangups
+import jh_messages
+
+
+class NetworkError(Exception):
+    pass
+
+
+class ChatMessageSegment:
+    @staticmethod
+    def from_str(text):
+        return [text]
+
+
+class FakeHangups:
+    ChatMessageSegment = ChatMessageSegment
+
+
+class FakeClient:
+    @asyncio.coroutine
+    def set_active(self):
+        pass
+
+
+class FakeConversation:
+    """A conversation whose send_message fails with the errors of failures, then blocks if block is set."""
+    def __init__(self, failures=(), block=False):
+        self.id_ = 'conv'
+        self.failures = list(failures)
+        self.block = block
+        self.sent = []
+
+    @asyncio.coroutine
+    def send_message(self, segments, image_id=None):
+        if self.failures:
+            raise self.failures.pop(0)
+        if self.block:
+            yield from asyncio.Future()
+        self.sent.append(segments[0])
+
+    @asyncio.coroutine
+    def update_read_timestamp(self):
+        pass
+
+
+class FakeConversationList:
+    def __init__(self, conv):
+        self.conv = conv
+
+    def get_one_to_one_with_user(self, gaia_id):
+        return self.conv
+
+
+class FakeQueue:
+    def __init__(self):
+        self.messages = []
+
+    def put(self, message):
+        self.messages.append(message)
+
+
+def run(coroutine):
+    """Run a coroutine on a new loop and return its result. The tasks it left are cancelled."""
+    loop = asyncio.new_event_loop()
+    asyncio.set_event_loop(loop)
+    try:
+        return loop.run_until_complete(coroutine)
+    finally:
+        tasks = asyncio.Task.all_tasks(loop)
+        for task in tasks:
+            task.cancel()
+        loop.run_until_complete(asyncio.gather(*tasks, return_exceptions=True))
+        asyncio.set_event_loop(None)
+        loop.close()
+
+
+def make_thread(tmpdir, monkeypatch, conv=None):
+    monkeypatch.setattr(jh_hangups, 'hangups', FakeHangups)
+    monkeypatch.setattr(jh_hangups, 'NetworkError', NetworkError)
+    monkeypatch.setattr(jh_hangups, 'SEND_RETRY_DELAYS', (0, 0))
+    monkeypatch.setattr(jh_hangups, 'SEND_DRAIN_SECS', 0.05)
+    thread = jh_hangups.HangupsThread('user@example.net', FakeQueue(), str(tmpdir.join('token')))
+    thread.client = FakeClient()
+    if conv is not None:
+        thread.conv_list = FakeConversationList(conv)
+    return thread
+
+
+def make_message(text):
+    return {'what': 'chat_message', 'type': 'one_to_one', 'gaia_id': '42', 'message': text,
+            'sender_jid': 'user@example.net/phone'}
+
+
+@asyncio.coroutine
+def settle():
+    """Let the tasks of the loop run until they wait."""
+    for _ in range(10):
+        yield from asyncio.sleep(0)
+
+
+def test_outbox_round_trip(tmpdir):
+    filename = str(tmpdir.join('outbox'))
+    jh_hangups.save_outbox(filename, [make_message('a'), make_message('b')])
+    assert os.stat(filename).st_mode & 0o777 == 0o600
+    assert [message['message'] for message in jh_hangups.load_outbox(filename, 60)] == ['a', 'b']
+    # The messages are read once.
+    assert not os.path.exists(filename)
+    assert jh_hangups.load_outbox(filename, 60) == []
+
+
+def test_outbox_too_old(tmpdir, monkeypatch):
+    filename = str(tmpdir.join('outbox'))
+    jh_hangups.save_outbox(filename, [make_message('a')])
+    now = time.time()
+    monkeypatch.setattr(time, 'time', lambda: now + 120)
+    assert jh_hangups.load_outbox(filename, 60) == []
+
+
+def test_empty_outbox_removes_file(tmpdir):
+    filename = str(tmpdir.join('outbox'))
+    jh_hangups.save_outbox(filename, [make_message('a')])
+    jh_hangups.save_outbox(filename, [])
+    assert not os.path.exists(filename)
+
+
+def test_messages_sent_in_order_after_retries(tmpdir, monkeypatch):
+    conv = FakeConversation(failures=[NetworkError('reconnecting')])
+    thread = make_thread(tmpdir, monkeypatch, conv)
+
+    @asyncio.coroutine
+    def send():
+        thread.chat_message(make_message('a'))
+        thread.chat_message(make_message('b'))
+        yield from settle()
+
+    run(send())
+    assert conv.sent == ['a', 'b']
+    assert thread.outbox == {}
+    assert thread.xmpp_queue.messages == []
+
+
+def test_message_bounced_after_last_retry(tmpdir, monkeypatch):
+    conv = FakeConversation(failures=[NetworkError('refused')] * 3)
+    thread = make_thread(tmpdir, monkeypatch, conv)
+
+    @asyncio.coroutine
+    def send():
+        thread.chat_message(make_message('a'))
+        thread.chat_message(make_message('b'))
+        yield from settle()
+
+    run(send())
+    # The next message is sent once the previous one is given up.
+    assert conv.sent == ['b']
+    error, = thread.xmpp_queue.messages
+    assert isinstance(error, jh_messages.ChatMessageError)
+    assert (error.gaia_id, error.recipient_jid) == ('42', 'user@example.net/phone')
+
+
+def test_message_bounced_on_unexpected_error(tmpdir, monkeypatch):
+    conv = FakeConversation(failures=[ValueError('invalid')])
+    thread = make_thread(tmpdir, monkeypatch, conv)
+
+    @asyncio.coroutine
+    def send():
+        thread.chat_message(make_message('a'))
+        thread.chat_message(make_message('b'))
+        yield from settle()
+        thread.chat_message(make_message('c'))
+        yield from settle()
+
+    run(send())
+    assert conv.sent == ['b', 'c']
+    assert thread.outbox == {}
+    error, = thread.xmpp_queue.messages
+    assert isinstance(error, jh_messages.ChatMessageError)
+
+
+def test_messages_left_bounced_when_sending_fails(tmpdir, monkeypatch):
+    conv = FakeConversation()
+    thread = make_thread(tmpdir, monkeypatch, conv)
+
+    def from_str(text):
+        if text == 'a':
+            raise ValueError('invalid')
+        return [text]
+    monkeypatch.setattr(ChatMessageSegment, 'from_str', staticmethod(from_str))
+
+    @asyncio.coroutine
+    def send():
+        thread.chat_message(make_message('a'))
+        thread.chat_message(make_message('b'))
+        yield from settle()
+        # The conversation is not stuck: later messages are sent.
+        thread.chat_message(make_message('c'))
+        yield from settle()
+
+    run(send())
+    assert conv.sent == ['c']
+    assert thread.outbox == {}
+    assert [type(message) for message in thread.xmpp_queue.messages] == [jh_messages.ChatMessageError] * 2
+
+
+def test_unsent_messages_saved_but_not_the_one_being_sent(tmpdir, monkeypatch):
+    conv = FakeConversation(block=True)
+    thread = make_thread(tmpdir, monkeypatch, conv)
+    thread.outbox_loaded = True
+
+    @asyncio.coroutine
+    def stop():
+        thread.chat_message(make_message('a'))
+        thread.chat_message(make_message('b'))
+        yield from settle()
+        yield from thread.save_unsent_messages()
+
+    run(stop())
+    # 'a' may have reached Hangouts: it is bounced rather than sent again by the next session.
+    error, = thread.xmpp_queue.messages
+    assert isinstance(error, jh_messages.ChatMessageError)
+    assert [message['message'] for message in jh_hangups.load_outbox(thread.outbox_filename, 60)] == ['b']
+
+
+def test_failed_send_saved(tmpdir, monkeypatch):
+    conv = FakeConversation(failures=[NetworkError('reconnecting')], block=True)
+    thread = make_thread(tmpdir, monkeypatch, conv)
+    thread.outbox_loaded = True
+    monkeypatch.setattr(jh_hangups, 'SEND_RETRY_DELAYS', (10, 10))
+
+    @asyncio.coroutine
+    def stop():
+        thread.chat_message(make_message('a'))
+        yield from settle()
+        yield from thread.save_unsent_messages()
+
+    run(stop())
+    assert thread.xmpp_queue.messages == []
+    assert [message['message'] for message in jh_hangups.load_outbox(thread.outbox_filename, 60)] == ['a']
+
+
+def test_messages_held_while_connecting_saved(tmpdir, monkeypatch):
+    thread = make_thread(tmpdir, monkeypatch)
+    jh_hangups.save_outbox(thread.outbox_filename, [make_message('previous')])
+
+    @asyncio.coroutine
+    def stop():
+        thread.chat_message(make_message('early'))
+        yield from thread.save_unsent_messages()
+        # The session stopped: later messages are bounced.
+        thread.chat_message(make_message('late'))
+
+    run(stop())
+    # The messages of the previous session were not sent either.
+    assert [message['message'] for message in jh_hangups.load_outbox(thread.outbox_filename, 60)] == \
+        ['previous', 'early']
+    error, = thread.xmpp_queue.messages
+    assert isinstance(error, jh_messages.ChatMessageError)
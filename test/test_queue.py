@@ -0,0 +1,146 @@
+"""Tests for the queue of the messages sent by the Hangouts threads to the transport."""
+
+import queue
+
+import pytest
+
+import jh_messages
+import jh_queue
+
+JID = 'user@example.net'
+
+
+def make_queue(shed_threshold=100, typing_max_age=60, user_limit=100, quantum=1, weights=None):
+    return jh_queue.MessageQueue(shed_threshold, typing_max_age, user_limit, quantum, weights)
+
+
+def presence(gaia_id, status='available', jid=JID):
+    return jh_messages.ContactPresence(gaia_id, status, '', jid=jid)
+
+
+def typing(gaia_id, state, jid=JID):
+    return jh_messages.TypingNotification('one_to_one', gaia_id, state, jid=jid)
+
+
+def chat(text, jid=JID):
+    return jh_messages.ChatMessage('one_to_one', '42', text, jid=jid)
+
+
+def drain(message_queue):
+    messages = []
+    while True:
+        try:
+            messages.append(message_queue.get(block=False))
+        except queue.Empty:
+            return messages
+
+
+@pytest.mark.parametrize('control', [jh_messages.Disconnected(final=True, jid=JID), jh_messages.Disconnected(jid=JID),
+                                     jh_messages.Connected(jid=JID)])
+def test_presences_not_handled_after_connection_change(control):
+    message_queue = make_queue()
+    message_queue.put(presence('1'))
+    message_queue.put(typing('1', 'started'))
+    message_queue.put(control)
+    # The presences sent after the change are handled after it.
+    newer = presence('1', 'away')
+    message_queue.put(newer)
+    assert drain(message_queue) == [control, newer]
+
+
+def test_pauses_kept_on_connection_change():
+    message_queue = make_queue()
+    pause = typing('1', 'paused')
+    message_queue.put(pause)
+    message_queue.put(jh_messages.Disconnected(jid=JID))
+    assert drain(message_queue)[1:] == [pause]
+
+
+def test_other_users_not_invalidated():
+    message_queue = make_queue()
+    other = presence('1', jid='other@example.net')
+    message_queue.put(other)
+    message_queue.put(jh_messages.Disconnected(final=True, jid=JID))
+    assert drain(message_queue)[1:] == [other]
+
+
+def test_only_started_typing_shed_under_load():
+    message_queue = make_queue(shed_threshold=1)
+    message = chat('hello')
+    message_queue.put(message)
+    message_queue.put(typing('1', 'started'))
+    stop = typing('2', 'stopped')
+    message_queue.put(stop)
+    assert drain(message_queue) == [message, stop]
+    assert message_queue.get_stats()['typing']['shed'] == 1
+
+
+def test_only_started_typing_shed_when_late():
+    message_queue = make_queue(typing_max_age=-1)
+    message_queue.put(typing('1', 'started'))
+    pause = typing('2', 'paused')
+    message_queue.put(pause)
+    assert drain(message_queue) == [pause]
+
+
+def test_users_served_in_turn_by_handling_time():
+    message_queue = make_queue(quantum=1)
+    first, second, third = chat('1'), chat('2'), chat('3')
+    other = chat('other', jid='other@example.net')
+    for message in (first, second, third, other):
+        message_queue.put(message)
+    assert message_queue.get(block=False) is first
+    # The user spent more than its quantum: the other user is served before it is again.
+    message_queue.charge(first, 2)
+    assert message_queue.get(block=False) is other
+    message_queue.charge(other, 0.1)
+    assert drain(message_queue) == [second, third]
+
+
+def test_weighted_user_served_longer():
+    message_queue = make_queue(quantum=1, weights={JID: 3})
+    messages = [chat(str(i)) for i in range(3)]
+    other = chat('other', jid='other@example.net')
+    for message in messages + [other]:
+        message_queue.put(message)
+    served = []
+    for _ in range(4):
+        served.append(message_queue.get(block=False))
+        message_queue.charge(served[-1], 1)
+    assert served == messages + [other]
+
+
+def test_users_forgotten_when_idle():
+    message_queue = make_queue()
+    message = chat('hello')
+    message_queue.put(message)
+    message_queue.get(block=False)
+    message_queue.charge(message, 5)
+    assert message_queue.deficits == {}
+    assert message_queue.pending == {}
+
+
+def test_newer_presence_replaces_queued_one():
+    message_queue = make_queue()
+    message = chat('hello')
+    message_queue.put(presence('1'))
+    message_queue.put(message)
+    newer = presence('1', 'away')
+    message_queue.put(newer)
+    assert message_queue.qsize() == 2
+    assert drain(message_queue) == [message, newer]
+    assert message_queue.get_stats()['presence']['coalesced'] == 1
+
+
+def test_typing_shed_over_user_limit():
+    message_queue = make_queue(user_limit=1)
+    message = chat('hello')
+    message_queue.put(message)
+    message_queue.put(typing('1', 'started'))
+    assert drain(message_queue) == [message]
+    assert message_queue.get_stats()['typing']['shed'] == 1
+
+
+def test_get_waits_for_timeout():
+    with pytest.raises(queue.Empty):
+        make_queue().get(timeout=0.01)
@@ -0,0 +1,58 @@
+"""Tests for the replay of the sessions once the transport reconnected to the server."""
+
+import collections
+
+from xmpp.protocol import Message
+
+import jh_xmpp
+
+
+class FakeTransport(jh_xmpp.Transport):
+    """A transport whose connection is lost after sending lose_after stanzas."""
+    def __init__(self, userlist, outbox, lose_after=None):
+        self.userlist = userlist
+        self.outbox = {jid: collections.deque(stanzas) for jid, stanzas in outbox.items()}
+        self.connected = True
+        self.lose_after = lose_after
+        self.sent = []
+        self.presence_cache = {}
+        self.probe_answers = {}
+
+    def send(self, stanza):
+        if self.connected:
+            self.sent.append(stanza)
+            if len(self.sent) == self.lose_after:
+                self.connected = False
+        elif isinstance(stanza, Message):
+            self.outbox.setdefault(stanza.getTo().getStripped(), collections.deque()).append(stanza)
+
+
+def make_message(jid, text):
+    return Message(to=jid, body=text)
+
+
+def make_session():
+    return {'user_list': {}}
+
+
+def test_stanzas_of_users_gone_dropped():
+    kept = make_message('user@example.net', 'kept')
+    transport = FakeTransport({'user@example.net': make_session()}, {
+        'user@example.net': [kept],
+        'gone@example.net': [make_message('gone@example.net', 'dropped')],
+    })
+    transport.replay_sessions()
+    assert kept in transport.sent
+    assert transport.outbox == {}
+
+
+def test_stanzas_kept_when_connection_lost_again():
+    first = make_message('first@example.net', 'first')
+    second = make_message('second@example.net', 'second')
+    # The connection is lost after the presence of the transport is sent to the first user.
+    transport = FakeTransport(collections.OrderedDict([('first@example.net', make_session()),
+                                                       ('second@example.net', make_session())]),
+                              {'first@example.net': [first], 'second@example.net': [second]}, lose_after=1)
+    transport.replay_sessions()
+    assert {jid: list(stanzas) for jid, stanzas in transport.outbox.items()} == {'first@example.net': [first],
+                                                                                 'second@example.net': [second]}
@@ -0,0 +1,37 @@
+"""Tests for the cache of the serialized vCards of the contacts."""
+
+from xmpp.protocol import Iq, NS_VCARD
+
+import jh_xmpp
+
+
+def make_contact(full_name='Alice'):
+    return jh_xmpp.Contact('1', full_name, '', ('alice@example.net',), (), 'online', '')
+
+
+def test_serialized_vcard_spliced_in_replies():
+    cache = jh_xmpp.VCardCache(10000)
+    user = make_contact()
+    vcard = cache.put(user, jh_xmpp.Transport.build_contact_vcard(user))
+    assert cache.get(user) == vcard
+    for iq_id in ('1', '2'):
+        m = Iq(to='user@example.net', typ='result')
+        m.setID(iq_id)
+        m.addChild(node=jh_xmpp.SerializedNode('vCard', NS_VCARD, cache.get(user)))
+        assert str(m).count(vcard) == 1
+    assert '<FN>Alice</FN>' in vcard and 'xmlns="vcard-temp"' in vcard
+
+
+def test_changed_contact_not_served():
+    cache = jh_xmpp.VCardCache(10000)
+    user = make_contact()
+    cache.put(user, jh_xmpp.Transport.build_contact_vcard(user))
+    assert cache.get(make_contact('Alice B.')) is None
+
+
+def test_too_large_vcard_not_kept():
+    cache = jh_xmpp.VCardCache(10)
+    user = make_contact()
+    assert cache.put(user, jh_xmpp.Transport.build_contact_vcard(user)).startswith('<vCard')
+    assert cache.get(user) is None
+    assert cache.size == 0
@@ -0,0 +1,168 @@
+"""Run two nodes of the transport sharing their users against the stub XMPP server, and check that the session of a
+user is owned by one node at a time:
+
+- both nodes connect, under the same component JID;
+- the available presence of a user gives the lease of its session to the node receiving it;
+- the stanzas of the user received by the other node are forwarded to that node, which answers them;
+- once that node is killed, the other one takes the lease over and probes the presence of the user.
+
+The nodes run in a temporary directory, with their logs, left for inspection with --keep or when a check fails. The
+sessions cannot log in to Hangouts without the refresh token of an account, which the checks do not need.
+
+Usage: python3 tools/run_cluster.py [--lease-time SECONDS] [--keep]"""
+import argparse
+import os
+import shutil
+import socket
+import sqlite3
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+
+from stub_xmpp_server import StubServer, local_name
+
+REPO_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+TRANSPORT_JID = 'hangups.localhost'
+USER_JID = 'user@example.net/stub'
+SECRET = 'secret'
+NODES = ['node1', 'node2']
+# Seconds given to a node to start and connect:
+START_TIMEOUT_SECS = 30
+# Seconds given to a node to answer a stanza:
+REPLY_TIMEOUT_SECS = 10
+
+CONFIG = """<?xml version="1.0" ?>
+<jabberhangouts>
+    <jid>%(jid)s</jid>
+    <mainServer>127.0.0.1</mainServer>
+    <port>%(port)d</port>
+    <secret>%(secret)s</secret>
+    <logFile>%(directory)s/transport.log</logFile>
+    <debugTransport/>
+    <spoolFile>%(directory)s/spoolfile</spoolFile>
+    <refreshTokenDirectory>%(directory)s/refresh_tokens</refreshTokenDirectory>
+    <clusterNode>%(node)s</clusterNode>
+    <clusterStore>%(store)s</clusterStore>
+    <clusterAddress>127.0.0.1:%(cluster_port)d</clusterAddress>
+    <clusterLeaseTime>%(lease_time)d</clusterLeaseTime>
+</jabberhangouts>
+"""
+
+
+def get_free_port():
+    with socket.socket() as sock:
+        sock.bind(('127.0.0.1', 0))
+        return sock.getsockname()[1]
+
+
+def start_node(node, directory, port, store, lease_time):
+    """Start a node of the transport in its own directory, where it finds its config.xml. Return its process."""
+    os.makedirs(os.path.join(directory, 'refresh_tokens'))
+    with open(os.path.join(directory, 'config.xml'), 'w') as config_file:
+        config_file.write(CONFIG % {'jid': TRANSPORT_JID, 'port': port, 'secret': SECRET, 'directory': directory,
+                                    'node': node, 'store': store, 'cluster_port': get_free_port(),
+                                    'lease_time': lease_time})
+    output = open(os.path.join(directory, 'output.log'), 'w')
+    return subprocess.Popen([sys.executable, REPO_DIR], cwd=directory, stdout=output, stderr=subprocess.STDOUT)
+
+
+def query(store, sql, *args):
+    db = sqlite3.connect(store)
+    try:
+        return db.execute(sql, args).fetchall()
+    except sqlite3.OperationalError:
+        # The nodes did not create the tables yet.
+        return []
+    finally:
+        db.close()
+
+
+def get_lease_owner(store, jid):
+    rows = query(store, 'SELECT node FROM leases WHERE jid = ? AND expires > ?', jid, time.time())
+    return rows[0][0] if rows else None
+
+
+def wait_until(predicate, timeout):
+    """Return whether predicate() became true within timeout seconds."""
+    deadline = time.monotonic() + timeout
+    while not predicate():
+        if time.monotonic() > deadline:
+            return False
+        time.sleep(0.1)
+    return True
+
+
+def check(name, ok):
+    print('%-60s %s' % (name, 'ok' if ok else 'FAILED'))
+    return ok
+
+
+def run_checks(server, processes, store, lease_time):
+    """Run the checks against the nodes started in turn. Return whether they all passed."""
+    bare_jid = USER_JID.partition('/')[0]
+    components = server.wait_components(len(NODES), START_TIMEOUT_SECS)
+    if not check('the nodes connected', components is not None and
+                 wait_until(lambda: len(query(store, 'SELECT node FROM nodes')) == len(NODES), START_TIMEOUT_SECS)):
+        return False
+    first, second = components
+
+    server.send("<presence from='%s' to='%s'/>" % (USER_JID, TRANSPORT_JID), first)
+    if not check('the node receiving the presence of the user took its lease',
+                 wait_until(lambda: get_lease_owner(store, bare_jid) == NODES[0], REPLY_TIMEOUT_SECS)):
+        return False
+
+    server.send("<iq type='get' id='forwarded' from='%s' to='%s'><query xmlns='http://jabber.org/protocol/disco#info'/>"
+                "</iq>" % (USER_JID, TRANSPORT_JID), second)
+    reply = server.wait_for(lambda component, element: local_name(element) == 'iq'
+                            and element.get('id') == 'forwarded', REPLY_TIMEOUT_SECS)
+    if not check('the other node forwarded the stanzas of the user to it', reply is not None and reply[0] is first):
+        return False
+
+    processes[0].kill()
+    probe = server.wait_for(lambda component, element: local_name(element) == 'presence'
+                            and element.get('type') == 'probe' and element.get('to') == bare_jid,
+                            2 * lease_time + REPLY_TIMEOUT_SECS)
+    return check('the other node took the session over once it was killed',
+                 probe is not None and probe[0] is second and get_lease_owner(store, bare_jid) == NODES[1])
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Check the ownership of the sessions by the nodes of a cluster.")
+    parser.add_argument('--lease-time', type=int, default=6, help="clusterLeaseTime of the nodes, in seconds")
+    parser.add_argument('--keep', action='store_true', help="keep the directory of the nodes")
+    args = parser.parse_args()
+
+    directory = tempfile.mkdtemp(prefix='jabberhangouts-cluster-')
+    store = os.path.join(directory, 'users.sqlite')
+    server = StubServer(('127.0.0.1', 0), SECRET)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    processes = []
+    try:
+        for index, node in enumerate(NODES):
+            processes.append(start_node(node, os.path.join(directory, node), server.server_address[1], store,
+                                        args.lease_time))
+            # The nodes are started in turn, so that the components connect in the order of NODES.
+            if server.wait_components(index + 1, START_TIMEOUT_SECS) is None:
+                break
+        passed = run_checks(server, processes, store, args.lease_time)
+    finally:
+        for process in processes:
+            process.terminate()
+        for process in processes:
+            try:
+                process.wait(10)
+            except subprocess.TimeoutExpired:
+                process.kill()
+        server.shutdown()
+        server.server_close()
+    if passed and not args.keep:
+        shutil.rmtree(directory)
+    else:
+        print("The configuration and logs of the nodes are in %s." % (directory,))
+    return 0 if passed else 1
+
+
+if __name__ == '__main__':
+    sys.exit(main())
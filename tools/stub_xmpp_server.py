@@ -0,0 +1,164 @@
+"""Minimal XMPP server accepting the connections of components, to run transport nodes locally.
+
+It only speaks the component protocol (XEP-0114): each connection opens a stream to the JID of its component and
+authenticates with the handshake of the shared secret. Several connections may authenticate as the same component,
+like with the servers balancing a component over several connections: stanzas for the component are delivered to
+one of them in turn, or to a given one. The stanzas the components send are kept with the connection they came from,
+for the caller to check. There are no users: the caller sends their stanzas itself.
+
+Run it alone with: python3 tools/stub_xmpp_server.py [--port PORT] [--secret SECRET]"""
+import argparse
+import hashlib
+import itertools
+import queue
+import socketserver
+import threading
+import time
+import uuid
+from xml.etree import ElementTree
+
+NS_STREAMS = 'http://etherx.jabber.org/streams'
+NS_COMPONENT_ACCEPT = 'jabber:component:accept'
+
+
+def local_name(element):
+    """Return the name of an element without its namespace."""
+    return element.tag.rpartition('}')[2]
+
+
+class ComponentHandler(socketserver.BaseRequestHandler):
+    """A connection of a component."""
+    def setup(self):
+        self.jid = None
+        self.stream_id = uuid.uuid4().hex
+        self.authenticated = False
+        self.write_lock = threading.Lock()
+
+    def write(self, text):
+        with self.write_lock:
+            self.request.sendall(text.encode('utf-8'))
+
+    def handle(self):
+        parser = ElementTree.XMLPullParser(events=('start', 'end'))
+        depth = 0
+        stream = None
+        while True:
+            try:
+                data = self.request.recv(4096)
+            except OSError:
+                data = b''
+            if not data:
+                return
+            parser.feed(data)
+            for event, element in parser.read_events():
+                if event == 'start':
+                    depth += 1
+                    if depth == 1:
+                        stream = element
+                        self.jid = element.get('to')
+                        self.write("<?xml version='1.0'?><stream:stream xmlns:stream='%s' xmlns='%s' from='%s' "
+                                   "id='%s'>" % (NS_STREAMS, NS_COMPONENT_ACCEPT, self.jid, self.stream_id))
+                    continue
+                depth -= 1
+                if depth == 0:
+                    return
+                if depth == 1:
+                    stream.remove(element)
+                    if self.authenticated:
+                        self.server.received.put((self, element))
+                    elif not self.authenticate(element):
+                        return
+
+    def authenticate(self, element):
+        """Check the handshake of the component. Return False if the connection has to be closed."""
+        expected = hashlib.sha1((self.stream_id + self.server.secret).encode('utf-8')).hexdigest()
+        if local_name(element) != 'handshake' or (element.text or '').strip() != expected:
+            self.write("<stream:error><not-authorized xmlns='urn:ietf:params:xml:ns:xmpp-streams'/></stream:error>"
+                       "</stream:stream>")
+            return False
+        self.authenticated = True
+        self.write('<handshake/>')
+        self.server.add_component(self)
+        return True
+
+    def finish(self):
+        self.server.remove_component(self)
+
+
+class StubServer(socketserver.ThreadingMixIn, socketserver.TCPServer):
+    """The server, listening on address, accepting the components authenticated with secret."""
+    daemon_threads = True
+    allow_reuse_address = True
+
+    def __init__(self, address, secret):
+        super().__init__(address, ComponentHandler)
+        self.secret = secret
+        self.lock = threading.Condition()
+        self.components = []  # ComponentHandler, in the order they authenticated.
+        self.turns = itertools.count()
+        self.received = queue.Queue()  # (ComponentHandler, stanza element)
+
+    def add_component(self, component):
+        with self.lock:
+            self.components.append(component)
+            self.lock.notify_all()
+
+    def remove_component(self, component):
+        with self.lock:
+            if component in self.components:
+                self.components.remove(component)
+            self.lock.notify_all()
+
+    def wait_components(self, count, timeout):
+        """Wait until count components are connected. Return them, or None after timeout seconds."""
+        deadline = time.monotonic() + timeout
+        with self.lock:
+            while len(self.components) < count:
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    return None
+                self.lock.wait(remaining)
+            return list(self.components)
+
+    def send(self, stanza, component=None):
+        """Deliver a stanza, as text, to a component, or to the next one in turn."""
+        if component is None:
+            with self.lock:
+                component = self.components[next(self.turns) % len(self.components)]
+        component.write(stanza)
+
+    def wait_for(self, predicate, timeout):
+        """Return the next (component, stanza element) received for which predicate(component, element) is true,
+        or None after timeout seconds. The stanzas before it are dropped."""
+        deadline = time.monotonic() + timeout
+        while True:
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                return None
+            try:
+                component, element = self.received.get(timeout=remaining)
+            except queue.Empty:
+                return None
+            if predicate(component, element):
+                return component, element
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Accept the connections of XMPP components, and print the stanzas "
+                                                 "they send.")
+    parser.add_argument('--port', type=int, default=5347)
+    parser.add_argument('--secret', default='secret')
+    args = parser.parse_args()
+    server = StubServer(('127.0.0.1', args.port), args.secret)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    print("Listening on port %d." % (args.port,))
+    try:
+        while True:
+            component, element = server.received.get()
+            print("%s: %s" % (component.jid, ElementTree.tostring(element, encoding='unicode')))
+    except KeyboardInterrupt:
+        server.shutdown()
+
+
+if __name__ == '__main__':
+    main()